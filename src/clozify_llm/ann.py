@@ -0,0 +1,188 @@
+"""ann.py Approximate nearest neighbour index of vocab embeddings
+"""
+import json
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from clozify_llm.constants import (
+    DEFAULT_KMEANS_ITERS,
+    DEFAULT_N_PROBE,
+    DEFAULT_SIM_BLOCK_BYTES,
+    DEFAULT_TOP_K,
+)
+from clozify_llm.similarity import merge_top_k, normalize_rows, top_k_cosine
+
+# Number of queries scored together when searching
+SEARCH_BLOCK_ROWS = 1024
+
+
+class IVFIndex:
+    """Inverted file index for cosine similarity search
+
+    Vectors are clustered with spherical k-means and stored grouped by cluster ("list"). A search compares each query
+    with the cluster centroids and then only scores the vectors in the `n_probe` closest lists, so cost grows with
+    n_probe rather than with the number of vectors. Larger n_probe gives higher recall at lower speed; n_probe equal to
+    n_lists is an exact search.
+
+    Sample usage
+    ```
+    index = IVFIndex.build(word_embs)
+    index.save("vocab.index")
+    indices, scores = IVFIndex.load("vocab.index").search(cloze_embs, k=1, n_probe=8)
+    ```
+
+    Parameters
+    ----------
+    centroids : np.ndarray
+      Unit-length centroid of each list.
+    vectors : np.ndarray
+      Unit-length vectors, ordered by list.
+    ids : np.ndarray
+      Row of each vector in the original embedding matrix.
+    offsets : np.ndarray
+      Vectors of list i are vectors[offsets[i]:offsets[i + 1]].
+    vocab_fingerprint : str, optional
+      Fingerprint of the vocab rows the vectors belong to (see `join.vocab_fingerprint`), checked before matching.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        vocab_fingerprint: Optional[str] = None,
+    ):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.vocab_fingerprint = vocab_fingerprint
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        embs: np.ndarray,
+        n_lists: Optional[int] = None,
+        n_iter: int = DEFAULT_KMEANS_ITERS,
+        seed: int = 0,
+        vocab_fingerprint: Optional[str] = None,
+    ) -> "IVFIndex":
+        """Cluster embs into n_lists lists (default sqrt of number of rows). Empty lists are dropped."""
+        vectors = normalize_rows(embs)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = top_k_cosine(vectors, centroids, k=1, Y_normalized=True)[0][:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            counts = np.bincount(assignment, minlength=n_lists)
+            # Re-seed empty lists with random vectors
+            empty = counts == 0
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        assignment = top_k_cosine(vectors, centroids, k=1, Y_normalized=True)[0][:, 0]
+        counts = np.bincount(assignment, minlength=n_lists)
+        keep = counts > 0
+        assignment = np.cumsum(keep)[assignment] - 1
+        ids = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(counts[keep])])
+        return cls(centroids[keep], vectors[ids], ids, offsets, vocab_fingerprint=vocab_fingerprint)
+
+    def save(self, index_dir: Union[str, Path]):
+        """Write index as .npy files in index_dir"""
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        for name in ("centroids", "vectors", "ids", "offsets"):
+            np.save(index_dir / f"{name}.npy", getattr(self, name))
+        with open(index_dir / "meta.json", "w") as f:
+            meta = {
+                "n_vectors": len(self),
+                "n_lists": self.n_lists,
+                "dim": self.centroids.shape[1],
+                "vocab_fingerprint": self.vocab_fingerprint,
+            }
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, index_dir: Union[str, Path]) -> "IVFIndex":
+        """Read index written by save(), memory-mapping the vectors"""
+        index_dir = Path(index_dir)
+        with open(index_dir / "meta.json") as f:
+            meta = json.load(f)
+        return cls(
+            centroids=np.load(index_dir / "centroids.npy"),
+            vectors=np.load(index_dir / "vectors.npy", mmap_mode="r"),
+            ids=np.load(index_dir / "ids.npy"),
+            offsets=np.load(index_dir / "offsets.npy"),
+            vocab_fingerprint=meta.get("vocab_fingerprint"),
+        )
+
+    def search(
+        self,
+        X: np.ndarray,
+        k: int = DEFAULT_TOP_K,
+        n_probe: int = DEFAULT_N_PROBE,
+        max_block_bytes: int = DEFAULT_SIM_BLOCK_BYTES,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Find approximately the k most cosine-similar indexed vectors to each row of X
+
+        Returns indices into the original embedding matrix and similarities, each of shape (len(X), k), best match
+        first. If the probed lists hold fewer than k vectors, the remaining indices are -1 with score -inf.
+        """
+        n_probe = min(n_probe, self.n_lists)
+        probes = top_k_cosine(X, self.centroids, k=n_probe, max_block_bytes=max_block_bytes, Y_normalized=True)[0]
+        indices = np.empty((len(X), k), dtype=np.int64)
+        scores = np.empty((len(X), k), dtype=np.float32)
+        for start in range(0, len(X), SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, len(X))
+            indices[start:stop], scores[start:stop] = self._search_block(
+                normalize_rows(X[start:stop]), probes[start:stop], k
+            )
+        return indices, scores
+
+    def _search_block(self, X_norm: np.ndarray, probes: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        best_idx = np.full((len(X_norm), k), -1, dtype=np.int64)
+        best_scores = np.full((len(X_norm), k), -np.inf, dtype=np.float32)
+        # Group (query, list) pairs by list so each list's vectors are read once per block
+        order = np.argsort(probes, axis=None, kind="stable")
+        probed_lists = probes.ravel()[order]
+        query_rows = order // probes.shape[1]
+        bounds = np.searchsorted(probed_lists, np.arange(self.n_lists + 1))
+        for list_id in np.unique(probed_lists):
+            rows = query_rows[bounds[list_id] : bounds[list_id + 1]]
+            lo, hi = self.offsets[list_id], self.offsets[list_id + 1]
+            sims = X_norm[rows] @ np.asarray(self.vectors[lo:hi]).T
+            if k < hi - lo:
+                cand = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            else:
+                cand = np.broadcast_to(np.arange(hi - lo), sims.shape)
+            best_idx[rows], best_scores[rows] = merge_top_k(
+                best_idx[rows], best_scores[rows], self.ids[lo + cand], np.take_along_axis(sims, cand, axis=1), k
+            )
+        return best_idx, best_scores
+
+
+def count_recall_misses(
+    index: IVFIndex,
+    X: np.ndarray,
+    Y: np.ndarray,
+    n_probe: int = DEFAULT_N_PROBE,
+    max_block_bytes: int = DEFAULT_SIM_BLOCK_BYTES,
+) -> int:
+    """Number of rows of X whose best match from the index differs from the exact best match in Y"""
+    approx = index.search(X, k=1, n_probe=n_probe, max_block_bytes=max_block_bytes)[0][:, 0]
+    exact = top_k_cosine(X, Y, k=1, max_block_bytes=max_block_bytes)[0][:, 0]
+    return int((approx != exact).sum())
@@ -0,0 +1,207 @@
+"""batch.py Crash-safe file-based batch jobs
+
+A batch job is a requests JSONL file with one API request per line, created by `write_requests()`. `BatchRunner`
+executes the requests with bounded concurrency and appends one line per attempt to a results JSONL file. Requests
+that already succeeded according to the results file are skipped, so an interrupted job resumes where it stopped
+when run again.
+"""
+import asyncio
+import json
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import Optional
+
+from clozify_llm.constants import DEFAULT_BATCH_MAX_ATTEMPTS, DEFAULT_CONCURRENCY
+from clozify_llm.predict import (
+    ChatCompleter,
+    Completer,
+    GenericCompleter,
+    ResponseCache,
+)
+from clozify_llm.utils import format_prompt
+
+CHAT_ENDPOINT = "chat"
+COMPLETION_ENDPOINT = "completion"
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+
+def make_request(completer: GenericCompleter, word: str, defn: str) -> dict:
+    """Build one batch request line using the same request parameters as completer would send"""
+    if isinstance(completer, ChatCompleter):
+        endpoint = CHAT_ENDPOINT
+        params = completer._make_chat_params(input_word=word)
+    elif isinstance(completer, Completer):
+        endpoint = COMPLETION_ENDPOINT
+        params = completer._make_completion_params(format_prompt(word, defn))
+    else:
+        raise ValueError(f"unsupported completer type {type(completer).__name__}")
+    return {"id": ResponseCache.make_key(params), "word": word, "defn": defn, "endpoint": endpoint, "params": params}
+
+
+def write_requests(completer: GenericCompleter, inputs: Iterable[tuple[str, str]], requests_path: str) -> int:
+    """Write one request per (word, defn) input to requests_path. Returns number of requests written."""
+    n_written = 0
+    with open(requests_path, "w", encoding="utf-8") as f:
+        for word, defn in inputs:
+            f.write(json.dumps(make_request(completer, word, defn), ensure_ascii=False) + "\n")
+            n_written += 1
+    return n_written
+
+
+def read_jsonl(path: str, strict: bool = False) -> Iterator[dict]:
+    """Lazily read JSONL file, skipping a truncated line left by a crash mid-write
+
+    If strict, a malformed line raises ValueError with its line number instead, as for requests files, which are
+    written in one go and should not silently lose requests.
+    """
+    if not Path(path).exists():
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                if strict:
+                    raise ValueError(f"malformed line {line_number} of {path}: {e}") from e
+
+
+def request_models(requests_path: str) -> set[str]:
+    """Models that requests in requests_path are sent to"""
+    return {request["params"]["model"] for request in read_jsonl(requests_path, strict=True)}
+
+
+def _ensure_trailing_newline(path: str):
+    """Terminate a truncated last line so lines appended afterwards stay parseable"""
+    if not Path(path).exists() or Path(path).stat().st_size == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, 2)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def read_results(results_path: str) -> dict[str, dict]:
+    """Summarize results file as {id: result}, using the successful result if any, otherwise the latest attempt
+
+    Each line's attempts count includes earlier runs, so the latest line has the total.
+    """
+    results: dict[str, dict] = {}
+    for result in read_jsonl(results_path):
+        previous = results.get(result["id"])
+        if previous is not None and previous["status"] == STATUS_OK:
+            continue
+        results[result["id"]] = result
+    return results
+
+
+class BatchRunner:
+    """Execute a requests JSONL file, appending outcomes to a results JSONL file
+
+    Each results line records the request id, word, status ("ok" or "error"), number of attempts so far, and either
+    the extracted text, raw response and usage, or the error message. Results are flushed line by line, so the file
+    is always a valid record of completed work.
+
+    Parameters
+    ----------
+    requests_path : str
+      JSONL file written by `write_requests()`.
+    results_path : str
+      Append-only JSONL file of results. Created if it does not exist.
+    concurrency : int
+      Maximum number of simultaneous requests.
+    max_attempts : int
+      Requests that have failed this many times (over all runs) are not attempted again.
+    cache : ResponseCache, optional
+      Response cache passed to completers.
+    """
+
+    def __init__(
+        self,
+        requests_path: str,
+        results_path: str,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_attempts: int = DEFAULT_BATCH_MAX_ATTEMPTS,
+        cache: Optional[ResponseCache] = None,
+    ):
+        self.requests_path = requests_path
+        self.results_path = results_path
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.cache = cache
+        self._completers: dict[tuple[str, str], GenericCompleter] = {}
+
+    def _get_completer(self, endpoint: str, model: str) -> GenericCompleter:
+        key = (endpoint, model)
+        if key not in self._completers:
+            if endpoint == CHAT_ENDPOINT:
+                self._completers[key] = ChatCompleter(model_id=model, cache=self.cache)
+            elif endpoint == COMPLETION_ENDPOINT:
+                self._completers[key] = Completer(model_id=model, cache=self.cache)
+            else:
+                raise ValueError(f"unknown endpoint {endpoint}")
+        return self._completers[key]
+
+    def run(self) -> dict[str, int]:
+        """Run all requests that have not yet succeeded, returning counts of "ok", "error" and "skipped" requests"""
+        return asyncio.run(self.arun())
+
+    async def arun(self) -> dict[str, int]:
+        """Async version of run()"""
+        previous = read_results(self.results_path)
+        counts = {STATUS_OK: 0, STATUS_ERROR: 0, "skipped": 0}
+        seen: set[str] = set()
+
+        def pending_requests() -> Iterator[tuple[dict, int]]:
+            for request in read_jsonl(self.requests_path, strict=True):
+                result = previous.get(request["id"])
+                attempts = result["attempts"] if result else 0
+                if request["id"] in seen or (result and result["status"] == STATUS_OK):
+                    counts["skipped"] += 1
+                elif attempts >= self.max_attempts:
+                    counts["skipped"] += 1
+                else:
+                    seen.add(request["id"])
+                    yield request, attempts
+
+        requests = pending_requests()
+        _ensure_trailing_newline(self.results_path)
+        with open(self.results_path, "a", encoding="utf-8") as results_file:
+
+            async def worker():
+                # Workers share a single lazy iterator, so at most `concurrency` requests are in flight
+                for request, attempts in requests:
+                    result = await self._attempt(request, attempts + 1)
+                    results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    results_file.flush()
+                    counts[result["status"]] += 1
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return counts
+
+    async def _attempt(self, request: dict, attempts: int) -> dict:
+        result = {"id": request["id"], "word": request["word"], "attempts": attempts}
+        completer = self._get_completer(request["endpoint"], request["params"]["model"])
+        try:
+            response = await completer.acreate(**request["params"])
+        except Exception as e:
+            # Any failure (after completer's own retries) is recorded, and attempted again on the next run
+            print(f"request for {request['word']} failed on attempt {attempts}: {e}")
+            return {**result, "status": STATUS_ERROR, "error": f"{type(e).__name__}: {e}"}
+        print(f"response for {request['word']} received, total usage {response['usage']['total_tokens']}")
+        return {
+            **result,
+            "status": STATUS_OK,
+            "text": completer.extract_text_from_response(response),
+            "usage": response["usage"],
+            "response": response,
+        }
+
+
+def export_results(requests_path: str, results_path: str) -> Iterator[str]:
+    """Yield successful result texts in request order, skipping requests without a successful result"""
+    results = read_results(results_path)
+    for request in read_jsonl(requests_path, strict=True):
+        result = results.get(request["id"])
+        if result is not None and result["status"] == STATUS_OK:
+            yield result["text"]
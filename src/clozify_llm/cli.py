@@ -1,19 +1,59 @@
-import json
+"""cli.py Command line interface
+
+Commands import the modules they use when they run, so that startup (e.g. `clozify --help`) stays fast and commands
+that do not need them work without pandas, scikit-learn and the other optional "prep" dependencies installed.
+"""
+import glob
 import os
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
 from getpass import getpass
+from itertools import islice
 from pathlib import Path
 
 import click
-import openai
-import pandas as pd
 
-from clozify_llm.constants import DEFN_COL, WORD_COL
-from clozify_llm.embed import add_emb
-from clozify_llm.extract.extract_cloze import extract_cloze
-from clozify_llm.extract.extract_wortschatz import get_all_vocab_from_course_request
-from clozify_llm.finetune import FineTuner
-from clozify_llm.join import Joiner
-from clozify_llm.predict import ChatCompleter, Completer
+from clozify_llm.constants import (
+    CLOZE_COL,
+    DEFAULT_BATCH_MAX_ATTEMPTS,
+    DEFAULT_CHAT_MODEL,
+    DEFAULT_COMPLETION_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_CSV_CHUNK_SIZE,
+    DEFAULT_EMB_CACHE_DIR,
+    DEFAULT_EMB_ENG,
+    DEFAULT_FETCH_CONCURRENCY,
+    DEFAULT_FETCH_TIMEOUT,
+    DEFAULT_N_PROBE,
+    DEFAULT_PARSE_CHUNK_ROWS,
+    DEFAULT_REDUCED_DIMS,
+    DEFAULT_REPORT_DIMS,
+    DEFAULT_RESPONSE_CACHE_PATH,
+    DEFAULT_SIM_BLOCK_BYTES,
+    DEFAULT_TOP_K,
+    DEFAULT_UPLOAD_LEDGER_PATH,
+    DEFN_COL,
+    EMBEDDING_BACKENDS,
+    OUTPUT_FORMATS,
+    REDUCTION_METHODS,
+    WORD_COL,
+)
+
+
+def ensure_api_key():
+    """Prompt for OpenAI API key if it is not set in the environment"""
+    if os.getenv("OPENAI_API_KEY") is None:
+        import openai
+
+        openai.api_key = getpass()
+
+
+def rate_limit_options(f):
+    """Add --rpm and --tpm options to override the client-side rate limit of the model used by a command"""
+    f = click.option("--tpm", type=click.IntRange(min=1), default=None, help="Tokens per minute limit")(f)
+    f = click.option("--rpm", type=click.IntRange(min=1), default=None, help="Requests per minute limit")(f)
+    return f
 
 
 @click.group()
@@ -24,30 +64,36 @@ def cli():
 
 @cli.command()
 @click.argument("word", required=False)
-@click.option("-f", "--file", type=click.Path(exists=True), required=False, help="Read input from file")
+@click.option(
+    "-f", "--file", type=click.Path(exists=True, allow_dash=True), required=False, help="Read input from file"
+)
 @click.option("-o", "--output", type=click.Path(allow_dash=True), default="-", help="Output location")
-def chat(word, file, output):
+@click.option(
+    "-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max simultaneous requests"
+)
+@click.option("--cache/--no-cache", default=False, help="Reuse responses saved in local response cache")
+@rate_limit_options
+def chat(word, file, output, concurrency, cache, rpm, tpm):
     """Generate clozes using a chat model
 
     Read WORD or each line in FILE, generate a cloze, and write to OUTPUT.
+
+    FILE is read lazily and each cloze is written as soon as it is ready, in input order, so FILE and OUTPUT can
+    be `-` to use as part of a pipeline.
     """
-    if os.getenv("OPENAI_API_KEY") is None:
-        openai.api_key = getpass()
-    completer = ChatCompleter()
-    if word:
-        inputs = [word]
-    elif file:
-        with click.open_file(file, "r") as f:
-            inputs = f.read().splitlines()
-    else:
-        click.echo("No input provided. Please provide either an input string or a file path")
-    responses = []
-    for input_word in inputs:
-        completion = completer.get_cloze_text(input_word, defn="")
-        responses.append(completion)
+    if not (word or file):
+        click.echo("No input provided. Please provide either an input string or a file path", err=True)
+        return
+    from clozify_llm.predict import ChatCompleter, ResponseCache
+    from clozify_llm.ratelimit import configure_rate_limit
 
-    write_output(responses, output)
-    click.echo(f"wrote {len(responses)} responses to {output}")
+    ensure_api_key()
+    if rpm or tpm:
+        configure_rate_limit(DEFAULT_CHAT_MODEL, rpm, tpm)
+    completer = ChatCompleter(cache=ResponseCache() if cache else None)
+    inputs = iter_chat_inputs(word, file)
+    n_written = write_output(iter_cloze_texts(completer, inputs, concurrency, chunk_size=1), output)
+    click.echo(f"wrote {n_written} responses to {output}", err=True)
 
 
 @cli.group()
@@ -57,66 +103,453 @@ def prep():
 
 
 @prep.command()
-@click.argument("url")
+@click.argument("urls", nargs=-1, required=True)
 @click.option("--output", default="wortschatz.csv", help="Output location.")
 @click.option("--staging", default="tmp", help="Directory to save intermediate html.")
-def fetch(url, output, staging):
-    """Get vocabulary from a course"""
-    words = get_all_vocab_from_course_request(url, staging)
+@click.option(
+    "-c",
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_FETCH_CONCURRENCY,
+    help="Max simultaneous lesson requests",
+)
+@click.option("--timeout", type=float, default=DEFAULT_FETCH_TIMEOUT, help="Seconds to wait for each response.")
+@click.option("--refresh", is_flag=True, help="Check all staged lessons for changes, only downloading changed ones.")
+@click.option("--max-age-days", type=float, default=None, help="Check staged lessons older than this for changes.")
+def fetch(urls, output, staging, concurrency, timeout, refresh, max_age_days):
+    """Get vocabulary from one or more courses
+
+    Lessons linked from several of the course URLS are only fetched once. Lessons are staged compressed, and are
+    reused without any request unless --refresh or --max-age-days is given, in which case a conditional request
+    checks whether each lesson changed.
+    """
+    from clozify_llm.extract.extract_wortschatz import get_all_vocab_from_course_request
+
+    max_age = 0 if refresh else max_age_days * 24 * 3600 if max_age_days is not None else None
+    words = get_all_vocab_from_course_request(
+        list(urls), staging, concurrency=concurrency, timeout=timeout, max_age=max_age
+    )
+    words.to_csv(output, index=False)
+    print(f"wrote {len(words)} to {output}")
+
+
+@prep.command(name="parse-lessons")
+@click.argument("staging", type=click.Path(exists=True, file_okay=False))
+@click.option("--output", default="wortschatz.csv", help="Output location.")
+@click.option("--workers", type=click.IntRange(min=1), default=1, help="Processes parsing lessons in parallel.")
+def parse_lessons(staging, output, workers):
+    """Get vocabulary from lessons already saved in STAGING by `prep fetch`, without any requests"""
+    from clozify_llm.extract.extract_wortschatz import words_from_staging_dir
+
+    words = words_from_staging_dir(staging, n_workers=workers)
     words.to_csv(output, index=False)
     print(f"wrote {len(words)} to {output}")
 
 
 @prep.command()
 @click.argument("json_file")
-@click.option("--output", default="output.csv", help="Output CSV file.")
-def parse(json_file, output):
+@click.option("--output", default="output.csv", help="Output CSV (or Parquet) file.")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(OUTPUT_FORMATS),
+    default=None,
+    help="Output format. Defaults to parquet for a .parquet output, otherwise csv.",
+)
+@click.option("--chunk-rows", type=click.IntRange(min=1), default=DEFAULT_PARSE_CHUNK_ROWS, help="Rows per write.")
+def parse(json_file, output, output_format, chunk_rows):
     """Extract clozes from scraped json data
 
-    Used as part of the training data generation process
+    Used as part of the training data generation process. JSON_FILE (a JSON array of collection pages, or one page
+    per line) is read one page at a time and clozes are written in chunks, so memory use does not grow with its size.
     """
+    from clozify_llm.extract.extract_cloze import (
+        iter_cloze_records,
+        iter_json_values,
+        write_cloze_chunks,
+    )
+
+    if output_format is None:
+        output_format = "parquet" if Path(output).suffix == ".parquet" else "csv"
     with click.open_file(json_file, "r") as f:
-        data = json.load(f)
-    clozes = extract_cloze(data)
-    clozes.to_csv(output, index=False)
-    print(f"wrote {len(clozes)} to {output}")
+        n_written = write_cloze_chunks(
+            iter_cloze_records(iter_json_values(f)), output, output_format=output_format, chunk_rows=chunk_rows
+        )
+    print(f"wrote {n_written} to {output}")
 
 
 @prep.command()
 @click.argument("csv_files", nargs=-1, type=click.Path(exists=True))
 @click.option("--output", default="output", help="Output dir.")
-def embed(csv_files, output):
+@click.option("--cache/--no-cache", default=False, help="Reuse embeddings saved in local embedding cache")
+@click.option("--cache-dir", default=DEFAULT_EMB_CACHE_DIR, help="Embedding cache location.")
+@click.option(
+    "--format",
+    "emb_format",
+    type=click.Choice(["csv", "npy"]),
+    default="csv",
+    help="Write embeddings into the CSV, or to a binary .npy sidecar next to it.",
+)
+@click.option(
+    "--int8/--no-int8",
+    "quantize",
+    default=False,
+    help="Quantize .npy sidecar embeddings to int8 with per-row scales, a quarter of the float32 size.",
+)
+@click.option(
+    "--lexical-vocab",
+    type=click.Path(exists=True),
+    default=None,
+    help="Vocab CSV. Clozes matching a vocab entry by word form are not embedded (see `prep match --lexical`).",
+)
+@rate_limit_options
+def embed(csv_files, output, cache, cache_dir, emb_format, quantize, lexical_vocab, rpm, tpm):
     """Get embeddings for the word or cloze in the input
 
     Used as part of the training data generation process
     """
-    if os.getenv("OPENAI_API_KEY") is None:
-        openai.api_key = getpass()
+    if quantize and emb_format != "npy":
+        raise click.UsageError("--int8 requires --format npy")
+    import pandas as pd
+
+    from clozify_llm.embed import (
+        add_emb,
+        emb_input_col,
+        emb_sidecar_path,
+        embed_matrix,
+        write_emb_output,
+    )
+    from clozify_llm.embed_cache import EmbeddingCache
+    from clozify_llm.lexical import LexicalMatcher
+    from clozify_llm.ratelimit import configure_rate_limit
+
+    ensure_api_key()
+    if rpm or tpm:
+        configure_rate_limit(DEFAULT_EMB_ENG, rpm, tpm)
+    emb_cache = EmbeddingCache(cache_dir) if cache else None
+    lexical_matcher = LexicalMatcher(pd.read_csv(lexical_vocab)[WORD_COL]) if lexical_vocab is not None else None
     Path(output).mkdir(exist_ok=True, parents=True)
     for csv_file in csv_files:
         csv_path = Path(csv_file)
         df = pd.read_csv(csv_path)
-        df_emb = add_emb(df)
+        skip = None
+        if lexical_matcher is not None and WORD_COL not in df.columns and CLOZE_COL in df.columns:
+            skip = lexical_matcher.match_many(df[CLOZE_COL]) >= 0
+            print(f"skipping {skip.sum()} clozes matched by word form")
         output_csv = Path(output) / f"{csv_path.stem}-embeds.csv"
-        df_emb.to_csv(output_csv, index=False)
-        print(f"wrote {len(df_emb)} to {output_csv}")
+        if emb_format == "npy":
+            # Keep embeddings in one contiguous matrix all the way to the sidecar
+            embs = embed_matrix(df, cache=emb_cache, skip=skip)
+            if quantize:
+                embs = embs.quantize()
+            df.to_csv(output_csv, index=False)
+            embs.save(emb_sidecar_path(output_csv, f"{emb_input_col(df)}_embedding"))
+        else:
+            df_emb = add_emb(df, cache=emb_cache, skip=skip)
+            emb_cols = [col for col in df_emb.columns if col not in df.columns]
+            write_emb_output(df_emb, output_csv, emb_cols, emb_format)
+        print(f"wrote {len(df)} to {output_csv}")
+
+
+def expand_paths(patterns: tuple[str, ...]) -> list[str]:
+    """Expand glob patterns (e.g. quoted "dumps/*.csv"), checking every path exists"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches or not all(Path(path).exists() for path in matches):
+            raise click.BadParameter(f"no file matches {pattern}", param_hint="CLOZE_CSVS")
+        paths.extend(matches)
+    return paths
 
 
 @prep.command()
-@click.argument("cloze_csv", type=click.Path(exists=True))
+@click.argument("cloze_csvs", nargs=-1, required=True)
 @click.argument("vocab_csv", type=click.Path(exists=True))
 @click.option("--output", default="output.csv", help="Output CSV file.")
-def match(cloze_csv, vocab_csv, output):
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Write one output per cloze CSV to this directory instead of a single output.",
+)
+@click.option("-k", "--top-k", default=DEFAULT_TOP_K, help="Number of candidate vocab matches to output per cloze.")
+@click.option("--threads", default=1, help="Number of threads computing similarities.")
+@click.option("--workers", default=1, help="Number of processes computing similarities.")
+@click.option(
+    "--max-block-mb",
+    default=DEFAULT_SIM_BLOCK_BYTES // 2**20,
+    help="Memory budget in MB for each block of similarities.",
+)
+@click.option(
+    "--index", "index_dir", type=click.Path(exists=True), default=None, help="Vocab index built by `prep index build`."
+)
+@click.option(
+    "--n-probe", default=DEFAULT_N_PROBE, help="Index lists searched per cloze. Higher is slower but exacter."
+)
+@click.option("--check-recall", is_flag=True, help="Also run exact matching and report how many index matches differ.")
+@click.option(
+    "--previous",
+    type=click.Path(exists=True),
+    default=None,
+    help="Earlier candidate join output. Only new or changed clozes and new vocab are scored.",
+)
+@click.option("--lexical", is_flag=True, help="Match clozes to vocab by word form first, then by embeddings.")
+@click.option(
+    "--backend",
+    type=click.Choice(EMBEDDING_BACKENDS),
+    default="openai",
+    help="Match by embeddings from `prep embed` (openai), or by local character n-gram vectors (local).",
+)
+@click.option(
+    "--check-agreement",
+    is_flag=True,
+    help="With local backend, also match by embeddings and report how many matches agree.",
+)
+def match(
+    cloze_csvs,
+    vocab_csv,
+    output,
+    output_dir,
+    top_k,
+    threads,
+    workers,
+    max_block_mb,
+    index_dir,
+    n_probe,
+    check_recall,
+    previous,
+    lexical,
+    backend,
+    check_agreement,
+):
     """Join cloze and vocab data based on embedding similarities
 
-    Used as part of the training data generation process
+    Used as part of the training data generation process. Matches each of CLOZE_CSVS (file names or glob patterns)
+    against VOCAB_CSV, which is read and prepared only once. With several cloze CSVs, the joins are combined into one
+    output with a cloze_file column, or written to --output-dir as one {name}-match.csv per input.
+
+    Embeddings are loaded from .npy sidecars next to the input CSVs if present, otherwise from embedding columns in
+    the CSVs. The matches are also saved next to each output file written for a single cloze CSV, so a later run can
+    pass that output as --previous.
     """
+    import numpy as np
+    import pandas as pd
+
+    from clozify_llm.ann import IVFIndex, count_recall_misses
+    from clozify_llm.emb_matrix import EmbeddingMatrix
+    from clozify_llm.embed import load_emb_sidecar, read_emb_matrix
+    from clozify_llm.join import Joiner, MatchState, match_state_path, vocab_fingerprint
+    from clozify_llm.reduce import saved_projection_fingerprint
+    from clozify_llm.similarity import normalize_rows
+
+    cloze_paths = expand_paths(cloze_csvs)
+    combined = len(cloze_paths) > 1 and output_dir is None
+    if backend == "local" and (index_dir is not None or previous is not None):
+        raise click.UsageError("--index and --previous cannot be used with --backend local")
+    if previous is not None and len(cloze_paths) > 1:
+        raise click.UsageError("--previous can only be used with a single cloze CSV")
+    previous_state = None
+    if previous is not None:
+        if not match_state_path(previous).exists():
+            raise click.UsageError(f"no saved matches {match_state_path(previous)} for {previous}")
+        previous_state = MatchState.load(match_state_path(previous))
+    # The local backend only needs embeddings to check agreement with embedding matches
+    uses_embeddings = backend == "openai" or check_agreement
+    vocab_projection = None
+    if uses_embeddings:
+        vocab_projection = saved_projection_fingerprint(vocab_csv)
+        for cloze_csv in cloze_paths:
+            if saved_projection_fingerprint(cloze_csv) != vocab_projection:
+                raise click.UsageError(f"embeddings of {cloze_csv} and {vocab_csv} were not reduced the same way")
+    if output_dir is not None:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    df_vocab = pd.read_csv(vocab_csv)
+    index = IVFIndex.load(index_dir) if index_dir is not None else None
+    if index is not None and index.vocab_fingerprint != vocab_fingerprint(df_vocab):
+        raise click.UsageError(f"index {index_dir} was not built from the rows of {vocab_csv}, rebuild the index")
+    # An index stands in for vocab embeddings, which are then only needed to check its recall
+    uses_word_embs = uses_embeddings and (index is None or check_recall)
+    word_emb_col = f"{WORD_COL}_embedding"
+    word_embs = load_emb_sidecar(vocab_csv, word_emb_col, index=df_vocab.index) if uses_word_embs else None
+    if uses_word_embs and word_embs is None and word_emb_col in df_vocab.columns:
+        word_embs = EmbeddingMatrix.from_column(df_vocab[word_emb_col])
+    # Normalize vocab once for all cloze files
+    word_embs_normalized = word_embs is not None
+    if word_embs_normalized:
+        word_embs = normalize_rows(word_embs)
+
+    joins = []
+    for cloze_csv in cloze_paths:
+        start_time = time.perf_counter()
+        df_cloze = pd.read_csv(cloze_csv)
+        cloze_embs = load_emb_sidecar(cloze_csv, f"{CLOZE_COL}_embedding", index=df_cloze.index)
+        joiner = Joiner(
+            df_cloze,
+            df_vocab,
+            cloze_embs=cloze_embs,
+            word_embs=word_embs,
+            word_embs_normalized=word_embs_normalized,
+            projection_fingerprint=vocab_projection,
+        )
+        joined = joiner.join_emb_sim(
+            top_k=top_k,
+            max_block_bytes=max_block_mb * 2**20,
+            n_threads=threads,
+            n_workers=workers,
+            index=index,
+            n_probe=n_probe,
+            previous=previous_state,
+            lexical=lexical,
+            backend=backend,
+        )
+        if combined:
+            joins.append(joined.assign(cloze_file=cloze_csv))
+        else:
+            file_output = output if output_dir is None else Path(output_dir) / f"{Path(cloze_csv).stem}-match.csv"
+            joined.to_csv(file_output, index=False)
+            joiner.match_state.save(match_state_path(file_output))
+            print(f"wrote candidate join len {len(joined)} to {file_output}")
+        if len(cloze_paths) > 1:
+            print(f"matched {len(joined)} clozes from {cloze_csv} in {time.perf_counter() - start_time:.2f}s")
+        if previous_state is not None:
+            print(f"scored {joiner.n_rescored} new or changed of {len(joined)} clozes against all vocab")
+        if backend == "local" and check_agreement:
+            reference = joiner.join_emb_sim(
+                max_block_bytes=max_block_mb * 2**20, n_threads=threads, n_workers=workers, lexical=lexical
+            )
+            n_agree = int((joined["vocab_idx"].to_numpy() == reference["vocab_idx"].to_numpy()).sum())
+            print(f"local backend agrees with embedding match on {n_agree} of {len(joined)} clozes")
+        if index is not None and check_recall:
+            X = read_emb_matrix(cloze_csv, df_cloze, f"{CLOZE_COL}_embedding")
+            # Clozes skipped by `prep embed --lexical-vocab` have no embedding
+            X = X[~np.isnan(X).any(axis=1)]
+            n_misses = count_recall_misses(index, X, word_embs, n_probe=n_probe, max_block_bytes=max_block_mb * 2**20)
+            print(f"{n_misses} of {len(X)} index matches differ from exact matching")
+    if combined:
+        joined = pd.concat(joins, ignore_index=True)
+        joined.to_csv(output, index=False)
+        print(f"wrote candidate join len {len(joined)} to {output}")
+
+
+@prep.group(name="index")
+def index_group():
+    """Build approximate nearest neighbour index of vocab embeddings."""
+    pass
+
+
+@index_group.command(name="build")
+@click.argument("vocab_csv", type=click.Path(exists=True))
+@click.argument("index_dir", type=click.Path())
+@click.option("--n-lists", type=int, default=None, help="Number of clusters. Defaults to sqrt of vocab size.")
+@click.option("--seed", default=0, help="Random seed for clustering.")
+def index_build(vocab_csv, index_dir, n_lists, seed):
+    """Build index of embeddings in VOCAB_CSV (or its .npy sidecar) and save it to INDEX_DIR
+
+    Use with `prep match --index INDEX_DIR`. Rebuild the index whenever VOCAB_CSV changes, which `prep match` checks.
+    """
+    import pandas as pd
+
+    from clozify_llm.ann import IVFIndex
+    from clozify_llm.embed import read_emb_matrix
+    from clozify_llm.join import vocab_fingerprint
+
+    df_vocab = pd.read_csv(vocab_csv)
+    index = IVFIndex.build(
+        read_emb_matrix(vocab_csv, df_vocab, f"{WORD_COL}_embedding"),
+        n_lists=n_lists,
+        seed=seed,
+        vocab_fingerprint=vocab_fingerprint(df_vocab),
+    )
+    index.save(index_dir)
+    print(f"wrote index of {len(index)} vectors in {index.n_lists} lists to {index_dir}")
+
+
+@prep.group(name="reduce")
+def reduce_group():
+    """Reduce dimensionality of embeddings."""
+    pass
+
+
+@reduce_group.command(name="fit")
+@click.argument("vocab_csv", type=click.Path(exists=True))
+@click.argument("projection_file", type=click.Path())
+@click.option("--dims", default=DEFAULT_REDUCED_DIMS, help="Number of dimensions to reduce to.")
+@click.option("--method", type=click.Choice(REDUCTION_METHODS), default="pca", help="Reduction method.")
+@click.option("--seed", default=0, help="Random seed of random projection.")
+def reduce_fit(vocab_csv, projection_file, dims, method, seed):
+    """Fit projection to embeddings in VOCAB_CSV (or its .npy sidecar) and save it to PROJECTION_FILE (.npz)
+
+    Use `prep reduce apply` with the same PROJECTION_FILE for the vocab and every cloze file to be matched to it.
+    """
+    import pandas as pd
+
+    from clozify_llm.embed import read_emb_matrix
+    from clozify_llm.reduce import Projection
+
+    df_vocab = pd.read_csv(vocab_csv)
+    projection = Projection.fit(
+        read_emb_matrix(vocab_csv, df_vocab, f"{WORD_COL}_embedding"), n_dims=dims, method=method, seed=seed
+    )
+    projection.save(projection_file)
+    print(f"wrote {method} projection from {projection.dim} to {projection.n_dims} dims to {projection_file}")
+
+
+@reduce_group.command(name="apply")
+@click.argument("projection_file", type=click.Path(exists=True))
+@click.argument("csv_files", nargs=-1, type=click.Path(exists=True))
+@click.option("--output", default="output", help="Output dir.")
+def reduce_apply(projection_file, csv_files, output):
+    """Reduce embeddings of each of CSV_FILES with the projection in PROJECTION_FILE
+
+    Writes {name}-reduced.csv with a .npy sidecar of reduced embeddings and a copy of the projection, which
+    `prep match` checks is the same for the cloze and vocab files.
+    """
+    import pandas as pd
+
+    from clozify_llm.embed import emb_input_col, emb_sidecar_path, read_emb_matrix
+    from clozify_llm.reduce import Projection, projection_path
+
+    projection = Projection.load(projection_file)
+    Path(output).mkdir(exist_ok=True, parents=True)
+    for csv_file in csv_files:
+        df = pd.read_csv(csv_file)
+        emb_col = f"{emb_input_col(df)}_embedding"
+        reduced = projection.transform(read_emb_matrix(csv_file, df, emb_col))
+        output_csv = Path(output) / f"{Path(csv_file).stem}-reduced.csv"
+        df.drop(columns=[emb_col], errors="ignore").to_csv(output_csv, index=False)
+        reduced.save(emb_sidecar_path(output_csv, emb_col))
+        projection.save(projection_path(output_csv))
+        print(f"wrote {len(df)} with {projection.n_dims} dim embeddings to {output_csv}")
+
+
+@reduce_group.command(name="report")
+@click.argument("cloze_csv", type=click.Path(exists=True))
+@click.argument("vocab_csv", type=click.Path(exists=True))
+@click.option(
+    "--dims", multiple=True, type=int, default=DEFAULT_REPORT_DIMS, help="Number of dimensions to try. Repeatable."
+)
+@click.option("--method", type=click.Choice(REDUCTION_METHODS), default="pca", help="Reduction method.")
+@click.option("--seed", default=0, help="Random seed of random projection.")
+@click.option("--max-block-mb", default=DEFAULT_SIM_BLOCK_BYTES // 2**20, help="Memory budget per similarity block.")
+def reduce_report(cloze_csv, vocab_csv, dims, method, seed, max_block_mb):
+    """Report how many matches of CLOZE_CSV to VOCAB_CSV change when matching at each of --dims dimensions"""
+    import pandas as pd
+
+    from clozify_llm.embed import read_emb_matrix
+    from clozify_llm.reduce import reduction_report
+
     df_cloze = pd.read_csv(cloze_csv)
     df_vocab = pd.read_csv(vocab_csv)
-    joiner = Joiner(df_cloze, df_vocab)
-    joined = joiner.join_emb_sim()
-    joined.to_csv(output, index=False)
-    print(f"wrote candidate join len {len(joined)} to {output}")
+    report = reduction_report(
+        read_emb_matrix(cloze_csv, df_cloze, f"{CLOZE_COL}_embedding"),
+        read_emb_matrix(vocab_csv, df_vocab, f"{WORD_COL}_embedding"),
+        dims=sorted(dims),
+        method=method,
+        seed=seed,
+        max_block_bytes=max_block_mb * 2**20,
+    )
+    print(report.to_string(index=False, float_format="{:.2f}".format))
 
 
 @prep.command()
@@ -129,6 +562,10 @@ def fix(candidate_join, manual_review, vocab_csv, output):
 
     Used as part of the training data generation process
     """
+    import pandas as pd
+
+    from clozify_llm.join import Joiner
+
     df_candidate = pd.read_csv(candidate_join)
     df_manual = pd.read_csv(manual_review)
     df_vocab = pd.read_csv(vocab_csv)
@@ -141,17 +578,23 @@ def fix(candidate_join, manual_review, vocab_csv, output):
 @cli.command()
 @click.argument("csv_file", type=click.Path(exists=True))
 @click.argument("training_data_output")
-def finetune(csv_file, training_data_output):
+@click.option("--ledger", default=DEFAULT_UPLOAD_LEDGER_PATH, help="Record of uploaded training data files.")
+@click.option("--dry-run", is_flag=True, help="Write training data and estimate cost without uploading.")
+def finetune(csv_file, training_data_output, ledger, dry_run):
     """
     Start completion model fine-tuning from training data
 
     Start model fine-tuning using data in CSV_FILE written to TRAINING_DATA_OUTPUT in the format
     that is uploaded for fine-tuning. Details of the FineTune job is printed.
     """
-    if os.getenv("OPENAI_API_KEY") is None:
-        openai.api_key = getpass()
-    df = pd.read_csv(csv_file)
-    fine_tuner = FineTuner(df, training_data_output)
+    from clozify_llm.finetune import FineTuner, UploadLedger
+
+    # A dry run uploads nothing, so must not create the ledger
+    fine_tuner = FineTuner.from_csv(csv_file, training_data_output, ledger=None if dry_run else UploadLedger(ledger))
+    if dry_run:
+        fine_tuner.prepare_upload()
+        return
+    ensure_api_key()
     ft_response = fine_tuner.start_finetuning()
     click.echo("FineTune job created")
     click.echo(ft_response)
@@ -160,40 +603,242 @@ def finetune(csv_file, training_data_output):
 @cli.command()
 @click.argument("word", required=False)
 @click.argument("defn", required=False)
-@click.option("-f", "--file", type=click.Path(exists=True), required=False, help="Input CSV file")
+@click.option("-f", "--file", type=click.Path(exists=True, allow_dash=True), required=False, help="Input CSV file")
 @click.option("-m", "--model_id", required=True, help="Fine tuned completion model")
 @click.option("-o", "--output", type=click.Path(allow_dash=True), default="-", help="Output CSV file.")
-def complete(word, defn, file, model_id, output):
+@click.option(
+    "-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max simultaneous requests"
+)
+@click.option(
+    "-b", "--batch-size", type=click.IntRange(min=1), default=DEFAULT_COMPLETION_BATCH_SIZE, help="Prompts per request"
+)
+@click.option("--cache/--no-cache", default=False, help="Reuse responses saved in local response cache")
+@rate_limit_options
+def complete(word, defn, file, model_id, output, concurrency, batch_size, cache, rpm, tpm):
     """Generate clozes using a completion model
 
     Read WORD and DEFN or each line in FILE, provide to fine-tuned MODEL_ID, and write to OUTPUT.
+
+    FILE is read in chunks and clozes are written as soon as each request is done, in input order, so FILE and OUTPUT
+    can be `-` to use as part of a pipeline.
     """
-    if os.getenv("OPENAI_API_KEY") is None:
-        openai.api_key = getpass()
-    completer = Completer(model_id)
-    if word and defn:
-        df_inputs = pd.DataFrame({WORD_COL: [word], DEFN_COL: [defn]})
-    elif file:
-        df_inputs = pd.read_csv(file)
+    if not ((word and defn) or file):
+        click.echo("No input provided. Please provide either an input word and defn or a file path", err=True)
+        return
+    from clozify_llm.predict import Completer, ResponseCache
+    from clozify_llm.ratelimit import configure_rate_limit
+
+    ensure_api_key()
+    if rpm or tpm:
+        configure_rate_limit(model_id, rpm, tpm)
+    completer = Completer(model_id, cache=ResponseCache() if cache else None)
+    inputs = iter_complete_inputs(word, defn, file)
+    cloze_texts = iter_cloze_texts(completer, inputs, concurrency, chunk_size=batch_size, batch_size=batch_size)
+    n_written = write_output(cloze_texts, output)
+    click.echo(f"wrote {n_written} to {output}", err=True)
+
+
+@cli.group()
+def batch():
+    """Run large jobs as resumable, file-based batches."""
+    pass
+
+
+@batch.command()
+@click.argument("file", type=click.Path(exists=True, allow_dash=True))
+@click.argument("requests_file", type=click.Path())
+@click.option("-m", "--model_id", default=None, help="Fine tuned completion model. If not set, use chat model.")
+def create(file, requests_file, model_id):
+    """Write one request per input in FILE to REQUESTS_FILE
+
+    FILE is a list of words (one per line) for the chat model, or a CSV of words and definitions if MODEL_ID is set.
+    """
+    from clozify_llm.batch import write_requests
+    from clozify_llm.predict import ChatCompleter, Completer
+
+    if model_id is None:
+        n_written = write_requests(ChatCompleter(), iter_chat_inputs(None, file), requests_file)
     else:
-        click.echo("No input provided. Please provide either an input word and defn or a file path")
-    cloze_texts = []
-    for row in df_inputs.itertuples():
-        word = getattr(row, WORD_COL)
-        defn = getattr(row, DEFN_COL)
-        completion = completer.get_cloze_text(word, defn)
-        cloze_texts.append(completion)
-    write_output(cloze_texts, output)
-    click.echo(f"wrote {len(cloze_texts)} to {output}")
+        n_written = write_requests(Completer(model_id), iter_complete_inputs(None, None, file), requests_file)
+    click.echo(f"wrote {n_written} requests to {requests_file}")
+
+
+@batch.command()
+@click.argument("requests_file", type=click.Path(exists=True))
+@click.argument("results_file", type=click.Path())
+@click.option(
+    "-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max simultaneous requests"
+)
+@click.option(
+    "--max-attempts",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BATCH_MAX_ATTEMPTS,
+    help="Stop retrying a request after this many failed attempts",
+)
+@click.option("--cache/--no-cache", default=False, help="Reuse responses saved in local response cache")
+@rate_limit_options
+def run(requests_file, results_file, concurrency, max_attempts, cache, rpm, tpm):
+    """Process requests in REQUESTS_FILE, appending outcomes to RESULTS_FILE
+
+    Requests that already succeeded in RESULTS_FILE are skipped, so an interrupted run can be resumed by running the
+    same command again. --rpm and --tpm apply to each model the requests are sent to.
+    """
+    from clozify_llm.batch import BatchRunner, request_models
+    from clozify_llm.predict import ResponseCache
+    from clozify_llm.ratelimit import configure_rate_limit
+
+    ensure_api_key()
+    if rpm or tpm:
+        for model in request_models(requests_file):
+            configure_rate_limit(model, rpm, tpm)
+    runner = BatchRunner(
+        requests_file,
+        results_file,
+        concurrency=concurrency,
+        max_attempts=max_attempts,
+        cache=ResponseCache() if cache else None,
+    )
+    counts = runner.run()
+    click.echo(f"succeeded {counts['ok']}, failed {counts['error']}, skipped {counts['skipped']}")
+
+
+@batch.command()
+@click.argument("requests_file", type=click.Path(exists=True))
+@click.argument("results_file", type=click.Path(exists=True))
+@click.option("-o", "--output", type=click.Path(allow_dash=True), default="-", help="Output CSV file.")
+def export(requests_file, results_file, output):
+    """Write successful clozes from RESULTS_FILE to OUTPUT, in REQUESTS_FILE order"""
+    from clozify_llm.batch import export_results
+
+    n_written = write_output(export_results(requests_file, results_file), output)
+    click.echo(f"wrote {n_written} to {output}", err=True)
+
+
+@cli.group(name="cache")
+def cache_group():
+    """Manage the local response and embedding caches."""
+    pass
+
+
+@cache_group.command()
+@click.option("--path", default=DEFAULT_RESPONSE_CACHE_PATH, help="Response cache location.")
+def stats(path):
+    """Show response cache size and contents"""
+    from clozify_llm.predict import ResponseCache
+
+    cache_stats = ResponseCache(path).stats()
+    for key in ["path", "entries", "size_bytes", "total_tokens"]:
+        click.echo(f"{key}: {cache_stats[key]}")
+
+
+@cache_group.command()
+@click.option("--path", default=DEFAULT_RESPONSE_CACHE_PATH, help="Response cache location.")
+@click.option("--max-age-days", type=float, default=None, help="Evict entries older than this.")
+@click.option("--max-mb", type=float, default=None, help="Evict oldest entries until cache is at most this size.")
+def prune(path, max_age_days, max_mb):
+    """Evict old entries from response cache"""
+    max_age = max_age_days * 24 * 60 * 60 if max_age_days is not None else None
+    max_bytes = int(max_mb * 1024 * 1024) if max_mb is not None else None
+    from clozify_llm.predict import ResponseCache
+
+    evicted = ResponseCache(path).prune(max_age=max_age, max_bytes=max_bytes)
+    click.echo(f"evicted {evicted} entries from {path}")
+
+
+@cache_group.command(name="emb-stats")
+@click.option("--cache-dir", default=DEFAULT_EMB_CACHE_DIR, help="Embedding cache location.")
+def emb_stats(cache_dir):
+    """Show embedding cache size and contents"""
+    from clozify_llm.embed_cache import EmbeddingCache
 
+    cache_stats = EmbeddingCache(cache_dir).stats()
+    for key in ["path", "entries", "rows", "dim", "size_bytes"]:
+        click.echo(f"{key}: {cache_stats[key]}")
 
-def write_output(cloze_texts: list[str], output_loc: str):
-    """Given a list of texts, write to file at specified location.
+
+@cache_group.command(name="emb-compact")
+@click.option("--cache-dir", default=DEFAULT_EMB_CACHE_DIR, help="Embedding cache location.")
+@click.option("--max-entries", type=click.IntRange(min=0), default=None, help="Keep this many most recently used.")
+def emb_compact(cache_dir, max_entries):
+    """Evict least recently used embeddings and reclaim space"""
+    from clozify_llm.embed_cache import EmbeddingCache
+
+    evicted = EmbeddingCache(cache_dir).compact(max_entries)
+    click.echo(f"evicted {evicted} entries from {cache_dir}")
+
+
+def iter_chat_inputs(word: str, file: str) -> Iterator[tuple[str, str]]:
+    """Lazily read (word, defn) inputs for chat, from WORD or each line in FILE"""
+    if word:
+        yield word, ""
+        return
+    with click.open_file(file, "r") as f:
+        for line in f:
+            yield line.rstrip("\r\n"), ""
+
+
+def iter_complete_inputs(word: str, defn: str, file: str) -> Iterator[tuple[str, str]]:
+    """Lazily read (word, defn) inputs for complete, from WORD and DEFN or chunks of FILE"""
+    if word and defn:
+        yield word, defn
+        return
+    import pandas as pd
+
+    with click.open_file(file, "r") as f:
+        for df_chunk in pd.read_csv(f, chunksize=DEFAULT_CSV_CHUNK_SIZE):
+            yield from zip(df_chunk[WORD_COL], df_chunk[DEFN_COL])
+
+
+def iter_cloze_texts(
+    completer, inputs: Iterable[tuple[str, str]], concurrency: int, chunk_size: int, **kwargs
+) -> Iterator[str]:
+    """Yield cloze texts in input order as soon as they are ready
+
+    Inputs are consumed in chunks of chunk_size (ideally one request's worth), with up to `concurrency` chunks in
+    flight at once, so memory use is bounded no matter how many inputs there are. Additional kwargs (e.g.
+    batch_size) are passed through to the completer.
+    """
+    inputs = iter(inputs)
+    chunks = iter(lambda: list(islice(inputs, chunk_size)), [])
+    if concurrency == 1:
+        for chunk in chunks:
+            words, defns = zip(*chunk)
+            yield from completer.get_cloze_texts(list(words), list(defns), **kwargs)
+        return
+
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    pending = deque()
+    try:
+        for chunk in chunks:
+            words, defns = zip(*chunk)
+            pending.append(loop.create_task(completer.aget_cloze_texts(list(words), list(defns), **kwargs)))
+            if len(pending) == concurrency:
+                # All pending chunks make progress while waiting on the oldest one
+                yield from loop.run_until_complete(pending.popleft())
+        while pending:
+            yield from loop.run_until_complete(pending.popleft())
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+def write_output(cloze_texts: Iterable[str], output_loc: str) -> int:
+    """Given texts, write each to file at specified location as soon as it is available. Returns number written.
 
     This is expected to be CSV, but depends on how cooperative ChatGPT is being.
     """
+    n_written = 0
     with click.open_file(output_loc, "w") as f:
-        f.writelines(cloze_line + "\n" for cloze_line in cloze_texts)
+        for cloze_line in cloze_texts:
+            f.write(cloze_line + "\n")
+            f.flush()
+            n_written += 1
+    return n_written
 
 
 def get_help_recursive(command, parent_name=""):
@@ -17,11 +17,63 @@ STARTING_MESSAGE = [
 DEFAULT_CHAT_MODEL = "gpt-3.5-turbo"
 DEFAULT_CHAT_TEMPERATURE = 0.2
 DEFAULT_CHAT_MAX_TOKENS = 256
+DEFAULT_CONCURRENCY = 1
+DEFAULT_CSV_CHUNK_SIZE = 1000
+OUTPUT_FORMATS = ("csv", "parquet")
+# Rows of clozes written at a time when parsing JSON dumps
+DEFAULT_PARSE_CHUNK_ROWS = 50_000
+# Rows of training data read and formatted at a time
+DEFAULT_TRAINING_CHUNK_ROWS = 50_000
+DEFAULT_BATCH_MAX_ATTEMPTS = 3
 DEFAULT_EMB_ENG = "text-embedding-ada-002"
+DEFAULT_EMB_BATCH_SIZE = 500
+DEFAULT_MAX_EMB_BATCH_TOKENS = 50_000
 CLOZE_COL = "cloze"
 WORD_COL = "word"
 DEFN_COL = "defn"
+DEFAULT_TOP_K = 1
+# Memory budget for each block of the cloze x vocab similarity matrix
+DEFAULT_SIM_BLOCK_BYTES = 256 * 2**20
+DEFAULT_N_PROBE = 8
+# Character n-gram lengths of local embeddings
+NGRAM_RANGE = (2, 4)
+EMBEDDING_BACKENDS = ("openai", "local")
+DEFAULT_KMEANS_ITERS = 20
+REDUCTION_METHODS = ("pca", "random")
+DEFAULT_REDUCED_DIMS = 256
+DEFAULT_REPORT_DIMS = (64, 128, 256, 512)
 DEFAULT_COMPLETION_MODEL = "curie"
+# Epochs fine-tuning runs for unless set otherwise, used to estimate training cost
+DEFAULT_FINETUNE_EPOCHS = 4
+# USD per 1000 training tokens by base model
+FINETUNE_PRICES = {
+    "ada": 0.0004,
+    "babbage": 0.0006,
+    "curie": 0.003,
+    "davinci": 0.03,
+}
+DW_BASE_URL = "https://learngerman.dw.com"
+DEFAULT_FETCH_CONCURRENCY = 8
+# Seconds to wait for connecting to and reading from the DW site
+DEFAULT_FETCH_TIMEOUT = 30
+DEFAULT_FETCH_RETRIES = 3
+# Seconds to back off before retrying, doubled on each further retry
+DEFAULT_FETCH_BACKOFF = 0.5
+DEFAULT_COMPLETION_BATCH_SIZE = 20
+DEFAULT_MAX_BATCH_PROMPT_TOKENS = 2048
+CHARS_PER_TOKEN = 4
+DEFAULT_RESPONSE_CACHE_PATH = "~/.cache/clozify/responses.sqlite3"
+DEFAULT_EMB_CACHE_DIR = "~/.cache/clozify/embeddings"
+DEFAULT_UPLOAD_LEDGER_PATH = "~/.cache/clozify/uploads.sqlite3"
 END_STR = " END"
 PROMPT_SEPARATOR = "\n\n###\n\n"
 QUOTECHAR = '"'
+# Default (requests per minute, tokens per minute) budgets by base model
+RATE_LIMITS = {
+    "gpt-3.5-turbo": (3_500, 90_000),
+    "gpt-4": (200, 40_000),
+    "text-embedding-ada-002": (3_000, 1_000_000),
+    "curie": (3_000, 250_000),
+    "davinci": (3_000, 250_000),
+}
+DEFAULT_RATE_LIMIT = (3_000, 250_000)
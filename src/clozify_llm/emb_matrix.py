@@ -0,0 +1,155 @@
+"""emb_matrix.py Contiguous embedding matrix aligned to a DataFrame
+"""
+from ast import literal_eval
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+INT8_MAX = 127
+
+
+class EmbeddingMatrix:
+    """Embeddings stored as one contiguous float32 or int8 array, one row per DataFrame row
+
+    Replaces object columns of per-row lists, which take many times the memory and must be stacked before any
+    computation. Row norms are computed once and cached. int8 matrices hold per-row scales, so that each row is
+    approximately `values[i] * scales[i]`. Rows without an embedding are NaN.
+
+    Works wherever a float32 array is expected (`np.asarray(matrix)` dequantizes), and slicing or indexing rows returns
+    an EmbeddingMatrix with the matching rows of the index.
+
+    Sample usage
+    ```
+    embs = EmbeddingMatrix.from_column(df["word_embedding"])
+    embs.quantize().save("vocab-embeds.word_embedding.npy")
+    unit_rows = EmbeddingMatrix.load("vocab-embeds.word_embedding.npy").normalized()
+    ```
+
+    Parameters
+    ----------
+    values : np.ndarray
+      float32 embeddings, or int8 quantized embeddings if scales is set. May be memory-mapped.
+    index : pd.Index, optional
+      Index of the DataFrame the rows belong to. Defaults to a RangeIndex.
+    scales : np.ndarray, optional
+      Per-row scale of int8 values.
+    """
+
+    def __init__(self, values: np.ndarray, index: Optional[pd.Index] = None, scales: Optional[np.ndarray] = None):
+        if values.ndim != 2:
+            raise ValueError(f"values must be 2D, got shape {values.shape}")
+        if (scales is not None) != (values.dtype == np.int8):
+            raise ValueError("scales must be given for, and only for, int8 values")
+        if values.dtype not in (np.float32, np.int8):
+            values = values.astype(np.float32)
+        self.values = values
+        self.scales = scales
+        self.index = pd.RangeIndex(len(values)) if index is None else index
+        if len(self.index) != len(values):
+            raise ValueError(f"index has {len(self.index)} entries but there are {len(values)} rows")
+        self._norms: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_column(cls, embs: pd.Series) -> "EmbeddingMatrix":
+        """Stack a column of per-row embeddings, aligned to the index of the column
+
+        Handles str of list (common if embedding dataframes loaded from legacy csv). Rows without an embedding (e.g.
+        skipped by add_emb) are NaN.
+        """
+        missing = embs.isna().to_numpy()
+        present = embs[~missing]
+        if len(present) and isinstance(present.iloc[0], str):
+            present = present.apply(literal_eval)
+        matrix = np.array(present.tolist(), dtype=np.float32)
+        if missing.any():
+            full = np.full((len(embs), matrix.shape[1] if matrix.ndim == 2 else 0), np.nan, dtype=np.float32)
+            full[~missing] = matrix
+            matrix = full
+        if matrix.ndim != 2:
+            matrix = matrix.reshape(len(embs), 0)
+        return cls(matrix, index=embs.index)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.values.shape
+
+    @property
+    def quantized(self) -> bool:
+        return self.scales is not None
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + (self.scales.nbytes if self.quantized else 0)
+
+    def __getitem__(self, rows) -> "EmbeddingMatrix":
+        """Rows by position: a slice, array of positions or boolean mask"""
+        if isinstance(rows, (int, np.integer)):
+            rows = [rows]
+        scales = self.scales[rows] if self.quantized else None
+        subset = EmbeddingMatrix(self.values[rows], index=self.index[rows], scales=scales)
+        if self._norms is not None:
+            subset._norms = self._norms[rows]
+        return subset
+
+    def to_float32(self) -> np.ndarray:
+        """float32 array of embeddings, dequantized if int8. Not a copy for float32 matrices."""
+        if self.quantized:
+            return self.values.astype(np.float32) * self.scales[:, None]
+        return np.asarray(self.values)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        values = self.to_float32()
+        return values if dtype is None else values.astype(dtype)
+
+    @property
+    def norms(self) -> np.ndarray:
+        """Euclidean norm of each row, computed on first use"""
+        if self._norms is None:
+            self._norms = np.linalg.norm(self.to_float32(), axis=1)
+        return self._norms
+
+    def normalized(self) -> np.ndarray:
+        """float32 rows scaled to unit length using the cached norms, with all-zero rows left as zeros"""
+        norms = self.norms.copy()
+        norms[norms == 0] = 1
+        return self.to_float32() / norms[:, None]
+
+    def quantize(self) -> "EmbeddingMatrix":
+        """int8 copy with per-row scales, a quarter of the size of float32"""
+        if self.quantized:
+            return self
+        values = self.to_float32()
+        scales = np.abs(values).max(axis=1) / INT8_MAX if len(values) else np.empty(0, dtype=np.float32)
+        scales = scales.astype(np.float32)
+        safe_scales = np.where((scales > 0) & np.isfinite(scales), scales, 1)
+        quantized = np.nan_to_num(np.round(values / safe_scales[:, None])).astype(np.int8)
+        return EmbeddingMatrix(quantized, index=self.index, scales=scales)
+
+    def to_column(self) -> list[list[float]]:
+        """Per-row lists, for writing embeddings into CSV cells (legacy format)"""
+        return [None if np.isnan(row).any() else row.tolist() for row in self.to_float32()]
+
+    @staticmethod
+    def scales_path(path: Union[str, Path]) -> Path:
+        path = Path(path)
+        return path.with_name(f"{path.stem}.scales.npy")
+
+    def save(self, path: Union[str, Path]):
+        """Write values as .npy file at path, and per-row scales of int8 values next to it"""
+        np.save(path, self.values)
+        if self.quantized:
+            np.save(self.scales_path(path), self.scales)
+        else:
+            self.scales_path(path).unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], index: Optional[pd.Index] = None) -> "EmbeddingMatrix":
+        """Read matrix written by save(), memory-mapping the values"""
+        values = np.load(path, mmap_mode="r")
+        scales = np.load(cls.scales_path(path)) if values.dtype == np.int8 else None
+        return cls(values, index=index, scales=scales)
@@ -1,34 +1,198 @@
 """embed.py Generate embeddings from embedding model
 """
-from typing import Optional
+import re
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
 
-from clozify_llm.constants import CLOZE_COL, WORD_COL
+from clozify_llm.constants import CLOZE_COL, NGRAM_RANGE, WORD_COL
+from clozify_llm.emb_matrix import EmbeddingMatrix
+from clozify_llm.embed_cache import EmbeddingCache
 from clozify_llm.utils import get_embs
 
 
-def add_emb(df: pd.DataFrame, input_col: Optional[str] = None) -> pd.DataFrame:
+def emb_input_col(df: pd.DataFrame, input_col: Optional[str] = None) -> str:
+    """Column of df to embed: input_col if provided, otherwise WORD_COL or CLOZE_COL"""
+    if input_col is not None:
+        return input_col
+    elif WORD_COL in df.columns:
+        return WORD_COL
+    elif CLOZE_COL in df.columns:
+        return CLOZE_COL
+    raise ValueError(f"input_col must be set or input dataframe must contain {WORD_COL} or {CLOZE_COL}")
+
+
+def embed_matrix(
+    df: pd.DataFrame,
+    input_col: Optional[str] = None,
+    cache: Optional[EmbeddingCache] = None,
+    skip: Optional[np.ndarray] = None,
+) -> EmbeddingMatrix:
+    """Return float32 embedding matrix aligned to the index of df
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+      DataFrame containing str column to embed.
+    input_col : str, optional, default None
+      If provided, column in df to get embeddings for. Otherwise use WORD_COL or CLOZE_COL.
+    cache : EmbeddingCache, optional
+      If provided, reuse cached embeddings and only call the API for inputs not in cache.
+    skip : np.ndarray, optional
+      Boolean mask of rows not to embed, e.g. clozes already matched lexically. Their rows are NaN.
+
+    Note this sends all rows to the embedding API, in batches of multiple rows per request.
+    """
+    to_embed = emb_input_col(df, input_col)
+    texts = df[to_embed] if skip is None else df.loc[~skip, to_embed]
+    embs = np.asarray(get_embs(texts.tolist(), cache=cache), dtype=np.float32).reshape(len(texts), -1)
+    if skip is not None:
+        full = np.full((len(df), embs.shape[1]), np.nan, dtype=np.float32)
+        full[~skip] = embs
+        embs = full
+    return EmbeddingMatrix(embs, index=df.index)
+
+
+def add_emb(
+    df: pd.DataFrame,
+    input_col: Optional[str] = None,
+    cache: Optional[EmbeddingCache] = None,
+    skip: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
     """Return copy of input dataframe with new embedding column
 
+    Each embedding is stored as a list of floats, as needed to write embeddings into CSV cells. Use embed_matrix()
+    to keep embeddings in a contiguous matrix instead.
+
     Parameters
     ----------
     df : pd.DataFrame
       DataFrame containing str column to embed.
     input_col : str, optional, default None
       If provided, column in df to get embeddings for. Otherwise use WORD_COL or CLOZE_COL.
+    cache : EmbeddingCache, optional
+      If provided, reuse cached embeddings and only call the API for inputs not in cache.
+    skip : np.ndarray, optional
+      Boolean mask of rows not to embed, e.g. clozes already matched lexically. Their embedding is left empty.
 
-    Note this calls the embedding API len(df) times.
+    Note this sends all rows to the embedding API, in batches of multiple rows per request.
     """
-    if input_col is not None:
-        to_embed = input_col
-    elif WORD_COL in df.columns:
-        to_embed = WORD_COL
-    elif CLOZE_COL in df.columns:
-        to_embed = CLOZE_COL
-    else:
-        raise ValueError(f"input_col must be set or input dataframe must contain {WORD_COL} or {CLOZE_COL}")
+    to_embed = emb_input_col(df, input_col)
     output_col = f"{to_embed}_embedding"
     df_out = df.copy()
-    df_out[output_col] = get_embs(df_out[to_embed].tolist())
+    if skip is None:
+        df_out[output_col] = get_embs(df_out[to_embed].tolist(), cache=cache)
+    else:
+        embs = pd.Series([None] * len(df_out), index=df_out.index, dtype=object)
+        embs[~skip] = pd.Series(get_embs(df_out.loc[~skip, to_embed].tolist(), cache=cache), dtype=object).values
+        df_out[output_col] = embs
     return df_out
+
+
+def emb_sidecar_path(csv_path: Union[str, Path], emb_col: str) -> Path:
+    """Location of binary sidecar holding emb_col for the CSV at csv_path"""
+    csv_path = Path(csv_path)
+    return csv_path.with_name(f"{csv_path.stem}.{emb_col}.npy")
+
+
+def remove_emb_sidecar(csv_path: Union[str, Path], emb_col: str):
+    """Delete .npy sidecar of emb_col for csv_path and its int8 scales, if any
+
+    A sidecar takes precedence over the embedding column when reading (see read_emb_matrix), so one left from an
+    earlier run would shadow embeddings written into the CSV.
+    """
+    sidecar = emb_sidecar_path(csv_path, emb_col)
+    sidecar.unlink(missing_ok=True)
+    EmbeddingMatrix.scales_path(sidecar).unlink(missing_ok=True)
+
+
+def write_emb_output(df_emb: pd.DataFrame, output_csv: Union[str, Path], emb_cols: list[str], emb_format: str = "csv"):
+    """Write dataframe with embedding columns to output_csv
+
+    With emb_format "csv", embeddings are written into CSV cells as list strings (legacy format). With "npy", the
+    embedding columns are left out of the CSV and each is written as a float32 matrix to a .npy sidecar file, with
+    rows in the same order as the CSV (see EmbeddingMatrix.save). Sidecars of the embedding columns left from earlier
+    runs are removed when writing csv.
+    """
+    if emb_format == "csv":
+        df_emb.to_csv(output_csv, index=False)
+        for emb_col in emb_cols:
+            remove_emb_sidecar(output_csv, emb_col)
+    elif emb_format == "npy":
+        df_emb.drop(columns=emb_cols).to_csv(output_csv, index=False)
+        for emb_col in emb_cols:
+            EmbeddingMatrix.from_column(df_emb[emb_col]).save(emb_sidecar_path(output_csv, emb_col))
+    else:
+        raise ValueError(f"unknown emb_format {emb_format}")
+
+
+def load_emb_sidecar(
+    csv_path: Union[str, Path], emb_col: str, index: Optional[pd.Index] = None
+) -> Optional[EmbeddingMatrix]:
+    """Memory-map the .npy sidecar of emb_col for csv_path, or return None if there is none
+
+    Rows are labelled with index (the index of the dataframe read from csv_path) if given.
+    """
+    sidecar = emb_sidecar_path(csv_path, emb_col)
+    if not sidecar.exists():
+        return None
+    return EmbeddingMatrix.load(sidecar, index=index)
+
+
+def read_emb_matrix(csv_path: Union[str, Path], df: pd.DataFrame, emb_col: str) -> EmbeddingMatrix:
+    """Embeddings for rows of df read from csv_path, from .npy sidecar if present, otherwise from emb_col of df"""
+    embs = load_emb_sidecar(csv_path, emb_col, index=df.index)
+    if embs is not None:
+        return embs
+    if emb_col not in df.columns:
+        raise ValueError(f"no embedding sidecar or column {emb_col} for {csv_path}")
+    return EmbeddingMatrix.from_column(df[emb_col])
+
+
+class CharNgramEmbedder:
+    """Local sparse embeddings of short texts as TF-IDF weighted character n-grams
+
+    An offline alternative to the embedding API for matching words: similar spellings (e.g. inflections) share most
+    n-grams. Vectors are only comparable between texts transformed by the same fitted embedder, so fit it on the
+    texts of both sides of a match. Annotations in parentheses or after a comma, as in DW vocab entries like
+    "Ausrede, -n (f.)", are dropped.
+
+    Sample usage
+    ```
+    embs = CharNgramEmbedder().fit_transform(clozes + words)
+    cloze_embs, word_embs = embs[: len(clozes)], embs[len(clozes) :]
+    ```
+
+    Parameters
+    ----------
+    ngram_range : tuple[int, int]
+      Smallest and largest n-gram length.
+    """
+
+    def __init__(self, ngram_range: tuple[int, int] = NGRAM_RANGE):
+        self.vectorizer = TfidfVectorizer(
+            analyzer="char_wb", ngram_range=ngram_range, sublinear_tf=True, dtype=np.float32
+        )
+
+    @staticmethod
+    def clean_text(text) -> str:
+        if not isinstance(text, str):
+            return ""
+        return re.sub(r"\(.*?\)", "", text).split(",")[0].strip()
+
+    def fit(self, texts: Iterable[str]) -> "CharNgramEmbedder":
+        self.vectorizer.fit([self.clean_text(text) for text in texts])
+        return self
+
+    def transform(self, texts: Iterable[str]) -> sparse.csr_matrix:
+        """Unit-length sparse vector of each text"""
+        return self.vectorizer.transform([self.clean_text(text) for text in texts]).tocsr()
+
+    def fit_transform(self, texts: Iterable[str]) -> sparse.csr_matrix:
+        """Fit on texts and return their vectors, in one pass"""
+        return self.vectorizer.fit_transform([self.clean_text(text) for text in texts]).tocsr()
@@ -0,0 +1,227 @@
+"""embed_cache.py Persistent content-addressed cache of embeddings
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from collections.abc import Iterable
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Union
+from unicodedata import normalize
+
+import numpy as np
+
+from clozify_llm.constants import DEFAULT_EMB_CACHE_DIR, DEFAULT_EMB_ENG
+
+# Max number of parameters in one SQLite query
+SQLITE_MAX_PARAMS = 900
+
+
+class EmbeddingCache:
+    """On-disk cache of embedding vectors for one embedding engine
+
+    Vectors are keyed by a hash of the normalized input text and stored as float32 rows appended to a single binary
+    file, which is memory-mapped for lookups so only the requested rows are read. An SQLite index file maps each key
+    to its row and records when it was last used.
+
+    Appending only ever adds rows. `compact()` evicts least recently used entries and rewrites the vector file
+    without them. Writers hold SQLite's write lock from reading the vector file size until their rows are indexed, so
+    several processes can share one cache.
+
+    Sample usage
+    ```
+    cache = EmbeddingCache()
+    embs = cache.get_many(texts)  # None for each miss
+    cache.put_many(missing_texts, missing_embs)
+    ```
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+      Base directory of cache. Each engine is stored in its own subdirectory.
+    engine : str
+      Embedding engine the cached vectors come from.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path] = DEFAULT_EMB_CACHE_DIR, engine: str = DEFAULT_EMB_ENG):
+        self.engine = engine
+        self.dir = Path(cache_dir).expanduser() / engine
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.dir / "index.sqlite3"
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+        self._read_meta()
+
+    @contextmanager
+    def _transaction(self, immediate: bool = False):
+        """Run block in a transaction, taking the write lock at the start if immediate"""
+        self._conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _read_meta(self):
+        """Read dim and vector file generation, which another writer may have set or changed since"""
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        self.dim: Optional[int] = int(meta["dim"]) if "dim" in meta else None
+        self._generation = int(meta.get("generation", 0))
+        self.vectors_path = self._vectors_path_for(self._generation)
+
+    def _vectors_path_for(self, generation: int) -> Path:
+        return self.dir / f"vectors.{generation}.f32"
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """Normalize unicode form and whitespace, so trivially different inputs share an entry"""
+        return " ".join(normalize("NFC", text).split())
+
+    @classmethod
+    def make_key(cls, text: str) -> str:
+        """Hash of normalized text"""
+        return hashlib.sha256(cls.normalize_text(text).encode("utf-8")).hexdigest()
+
+    @property
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float32).itemsize
+
+    def _n_rows(self) -> int:
+        if self.dim is None or not self.vectors_path.exists():
+            return 0
+        return self.vectors_path.stat().st_size // self._row_bytes
+
+    def _truncate_partial_row(self):
+        """Drop an incomplete row left by a crash mid-append, which is only safe while holding the write lock"""
+        if self.dim is not None and self.vectors_path.exists():
+            size = self.vectors_path.stat().st_size
+            if size % self._row_bytes:
+                os.truncate(self.vectors_path, size - size % self._row_bytes)
+
+    def _vectors(self) -> np.ndarray:
+        n_rows = self._n_rows()
+        if n_rows == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim))
+
+    def _lookup_rows(self, keys: Iterable[str]) -> dict[str, int]:
+        unique_keys = list(set(keys))
+        rows = {}
+        for start in range(0, len(unique_keys), SQLITE_MAX_PARAMS):
+            chunk = unique_keys[start : start + SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            query = f"SELECT key, row FROM entries WHERE key IN ({placeholders})"
+            rows.update(self._conn.execute(query, chunk).fetchall())
+        return rows
+
+    def get_many(self, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """Return cached float32 vector for each text, or None for misses"""
+        keys = [self.make_key(text) for text in texts]
+        rows = self._lookup_rows(keys)
+        if rows:
+            now = time.time()
+            with self._transaction():
+                self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in rows])
+        hit_positions = [i for i, key in enumerate(keys) if key in rows]
+        embs: list[Optional[np.ndarray]] = [None] * len(keys)
+        if hit_positions:
+            # Single gather from the memory map, reading only the rows needed
+            hit_vectors = np.asarray(self._vectors()[[rows[keys[i]] for i in hit_positions]])
+            for i, vector in zip(hit_positions, hit_vectors):
+                embs[i] = vector
+        n_hits = len(hit_positions)
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        return embs
+
+    def put_many(self, texts: list[str], embs: list[list[float]]):
+        """Add embeddings for texts that are not already cached
+
+        The write lock is held from reading the vector file size through appending and indexing the new rows, so
+        concurrent writers append and index distinct rows.
+        """
+        if not texts:
+            return
+        vectors = np.asarray(embs, dtype=np.float32)
+        keys = [self.make_key(text) for text in texts]
+        with self._transaction(immediate=True):
+            self._read_meta()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (self.dim,))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"embedding dim {vectors.shape[1]} does not match cache dim {self.dim}")
+            existing = self._lookup_rows(keys)
+            new_positions = {}
+            for i, key in enumerate(keys):
+                if key not in existing and key not in new_positions:
+                    new_positions[key] = i
+            if not new_positions:
+                return
+            self._truncate_partial_row()
+            start_row = self._n_rows()
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors[list(new_positions.values())]).tobytes())
+            now = time.time()
+            self._conn.executemany(
+                "INSERT INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                [(key, start_row + offset, now) for offset, key in enumerate(new_positions)],
+            )
+
+    def stats(self) -> dict:
+        """Summarize cache contents and hit/miss counts of this instance"""
+        entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "path": str(self.dir),
+            "engine": self.engine,
+            "entries": entries,
+            "rows": self._n_rows(),
+            "dim": self.dim,
+            "size_bytes": self.vectors_path.stat().st_size if self.vectors_path.exists() else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def compact(self, max_entries: Optional[int] = None) -> int:
+        """Rewrite vector file with only the max_entries most recently used entries (all entries if None)
+
+        The new vector file and index are switched over in one transaction, holding the write lock throughout, so an
+        interrupted compaction leaves the cache as it was. Returns number of entries evicted.
+        """
+        with self._transaction(immediate=True):
+            self._read_meta()
+            n_entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            kept = self._conn.execute(
+                "SELECT key, row, last_used FROM entries ORDER BY last_used DESC, row DESC LIMIT ?",
+                (n_entries if max_entries is None else max_entries,),
+            ).fetchall()
+            old_vectors_path = self.vectors_path
+            new_generation = self._generation + 1
+            new_vectors_path = self._vectors_path_for(new_generation)
+            vectors = self._vectors()
+            with open(new_vectors_path, "wb") as f:
+                for start in range(0, len(kept), SQLITE_MAX_PARAMS):
+                    rows = [row for _, row, _ in kept[start : start + SQLITE_MAX_PARAMS]]
+                    f.write(np.ascontiguousarray(vectors[rows]).tobytes())
+            del vectors
+            self._conn.execute("DELETE FROM entries")
+            self._conn.executemany(
+                "INSERT INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                [(key, new_row, last_used) for new_row, (key, _, last_used) in enumerate(kept)],
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (new_generation,))
+        self._generation = new_generation
+        self.vectors_path = new_vectors_path
+        old_vectors_path.unlink(missing_ok=True)
+        return n_entries - len(kept)
+
+    def close(self):
+        self._conn.close()
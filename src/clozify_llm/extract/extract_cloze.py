@@ -1,8 +1,20 @@
 """extract-cloze.py Utility for extracting tabular cloze data from raw json
 """
+import json
+import re
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from pathlib import Path
+from typing import IO, Any, Optional, Union
+
+import numpy as np
 import pandas as pd
 
-from clozify_llm.constants import CLOZE_COL
+from clozify_llm.constants import CLOZE_COL, DEFAULT_PARSE_CHUNK_ROWS, OUTPUT_FORMATS
+
+CLOZE_PATTERN = re.compile(r"\{\{(?P<cloze>\w*)\}\}")
+# Characters read from the JSON file at a time
+JSON_READ_SIZE = 2**20
 
 
 def extract_cloze(raw_input: list[dict]) -> pd.DataFrame:
@@ -14,12 +26,207 @@ def extract_cloze(raw_input: list[dict]) -> pd.DataFrame:
     "translation", "cloze" (detected from {{ }} via regex), and "collection"
     (extracted from "collection.name").
     """
-    df = pd.json_normalize(
-        raw_input,
-        record_path="collectionClozeSentences",
-        meta=["collection"],
-    )
-    df["collection"] = df["collection"].apply(lambda x: x["name"])
-    cloze_finder = r"\{\{(?P<cloze>\w*)\}\}"
-    df[CLOZE_COL] = df["text"].str.extract(cloze_finder)
-    return df
+    df = pd.DataFrame(iter_cloze_records(raw_input))
+    return df[cloze_columns(df.columns)]
+
+
+def cloze_columns(fields: Iterable[str]) -> list[str]:
+    """Fields in order of first appearance, with "collection" and CLOZE_COL last, as pd.json_normalize of pages had"""
+    fields = list(fields)
+    last = [field for field in ("collection", CLOZE_COL) if field in fields]
+    return [field for field in fields if field not in last] + last
+
+
+def iter_cloze_records(pages: Iterable[dict]) -> Iterator[dict]:
+    """Yield one flat dict per sentence of each page, with its "collection" name and "cloze"
+
+    Nested fields of sentences are flattened to "parent.child" keys, as pd.json_normalize does.
+    """
+    for page in pages:
+        collection = page["collection"]["name"]
+        for sentence in page["collectionClozeSentences"]:
+            record = _flatten(sentence)
+            record["collection"] = collection
+            cloze_match = CLOZE_PATTERN.search(record["text"]) if isinstance(record.get("text"), str) else None
+            record[CLOZE_COL] = cloze_match.group("cloze") if cloze_match else np.nan
+            yield record
+
+
+def _flatten(record: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def iter_json_values(f: IO[str], read_size: int = JSON_READ_SIZE) -> Iterator[Any]:
+    """Yield elements of a top-level JSON array in f one at a time, reading only as much of f as needed
+
+    Also accepts a sequence of top-level values (e.g. JSON Lines). Memory use is bounded by the largest element
+    rather than the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    in_array = None
+
+    def fill(min_size: int) -> bool:
+        """Read at least min_size more characters into buffer, dropping consumed ones. False at end of file."""
+        nonlocal buffer, pos, eof
+        chunk = f.read(max(read_size, min_size))
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return bool(chunk)
+
+    while True:
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or (in_array and buffer[pos] == ",")):
+                pos += 1
+            if pos < len(buffer) or not fill(read_size):
+                break
+        if pos >= len(buffer):
+            if in_array:
+                raise ValueError("unterminated JSON array")
+            return
+        if in_array is None:
+            in_array = buffer[pos] == "["
+            if in_array:
+                pos += 1
+                continue
+        if in_array and buffer[pos] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+            # A value ending exactly at the end of the buffer (e.g. a number) may continue in the file
+            complete = end < len(buffer) or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            # Read as much again as the partial element, so total decoding work stays linear in its size
+            fill(len(buffer) - pos)
+            continue
+        pos = end
+        yield value
+
+
+def write_cloze_chunks(
+    records: Iterable[dict],
+    output: Union[str, Path],
+    output_format: str = "csv",
+    chunk_rows: int = DEFAULT_PARSE_CHUNK_ROWS,
+) -> int:
+    """Write records to output in chunks of chunk_rows rows, returning number of rows written
+
+    Columns are all fields of the records, ordered as by extract_cloze. If a chunk has fields no earlier chunk had,
+    the output written so far is rewritten with the new columns, empty for earlier rows. Parquet output requires
+    pyarrow, and has every column as strings (values as csv output would have them), so that chunks with missing or
+    differently typed values share one schema.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output_format {output_format}, must be one of {OUTPUT_FORMATS}")
+    records = iter(records)
+    columns: list[str] = []
+    writer = None
+    n_written = 0
+    try:
+        while True:
+            # Object dtype keeps ints in columns with missing values as written, rather than casting to float
+            chunk = pd.DataFrame(
+                list(islice(records, chunk_rows)), dtype=object if output_format == "parquet" else None
+            )
+            if n_written and not len(chunk):
+                break
+            new_columns = cloze_columns(columns + [column for column in chunk.columns if column not in columns])
+            if n_written and new_columns != columns:
+                if output_format == "csv":
+                    _rewrite_csv_columns(output, new_columns, chunk_rows)
+                else:
+                    writer = _rewrite_parquet_columns(output, writer, new_columns)
+            columns = new_columns
+            chunk = chunk.reindex(columns=columns)
+            if output_format == "csv":
+                chunk.to_csv(output, mode="w" if n_written == 0 else "a", header=n_written == 0, index=False)
+            else:
+                writer = _write_parquet_chunk(chunk, output, writer)
+            n_written += len(chunk)
+            if len(chunk) < chunk_rows:
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_written
+
+
+def _partial_path(output: Union[str, Path]) -> Path:
+    output = Path(output)
+    return output.with_name(f"{output.name}.partial")
+
+
+def _rewrite_csv_columns(output: Union[str, Path], columns: list[str], chunk_rows: int):
+    """Rewrite csv output with columns, reading back the values written so far as text so they are unchanged"""
+    partial = _partial_path(output)
+    Path(output).replace(partial)
+    written = pd.read_csv(partial, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+    for i, written_chunk in enumerate(written):
+        written_chunk.reindex(columns=columns).to_csv(output, mode="w" if i == 0 else "a", header=i == 0, index=False)
+    partial.unlink()
+
+
+def _rewrite_parquet_columns(output: Union[str, Path], writer, columns: list[str]):
+    """Close writer and rewrite parquet output with columns, returning a writer for the new schema
+
+    New columns are null for rows written before.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer.close()
+    partial = _partial_path(output)
+    Path(output).replace(partial)
+    written = pq.ParquetFile(partial)
+    written_names = written.schema_arrow.names
+    schema = _parquet_schema(columns)
+    writer = pq.ParquetWriter(output, schema)
+    for batch in written.iter_batches():
+        arrays = [
+            batch.column(name) if name in written_names else pa.nulls(batch.num_rows, pa.string()) for name in columns
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    written.close()
+    partial.unlink()
+    return writer
+
+
+def _parquet_schema(columns: list[str]):
+    """Schema of parquet output, with every column as strings"""
+    import pyarrow as pa
+
+    return pa.schema([pa.field(name, pa.string()) for name in columns])
+
+
+def _parquet_text(value: Any) -> Optional[str]:
+    """Value as written to parquet: None if missing, else its text"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+def _write_parquet_chunk(chunk: pd.DataFrame, output: Union[str, Path], writer=None):
+    """Append chunk to parquet file at output as strings, opening a writer for the columns of chunk if there is none"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("parquet output requires pyarrow, install it or write csv") from e
+    if writer is None:
+        writer = pq.ParquetWriter(output, _parquet_schema(list(chunk.columns)))
+    arrays = [pa.array([_parquet_text(value) for value in chunk[name]], type=pa.string()) for name in chunk.columns]
+    writer.write_table(pa.Table.from_arrays(arrays, schema=writer.schema))
+    return writer
@@ -1,30 +1,193 @@
 """extract-wortschatz.py helper function to extract word list
 
 Assumes DW Learngerman format"""
+import gzip
+import json
+import os
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional, Union
 from unicodedata import normalize
 
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from clozify_llm.constants import DEFN_COL, WORD_COL
+from clozify_llm.constants import (
+    DEFAULT_FETCH_BACKOFF,
+    DEFAULT_FETCH_CONCURRENCY,
+    DEFAULT_FETCH_RETRIES,
+    DEFAULT_FETCH_TIMEOUT,
+    DEFN_COL,
+    DW_BASE_URL,
+    WORD_COL,
+)
 
+# Match elements by one of their classes, as BeautifulSoup's class_ filter does
+LESSON_ITEM_XPATH = etree.XPath("//li[contains(concat(' ', normalize-space(@class), ' '), ' lesson-item ')]")
+KNOWLEDGE_XPATH = etree.XPath("//*[contains(concat(' ', normalize-space(@class), ' '), ' knowledge-wrapper ')]")
+# Staged lessons parsed per task sent to each worker process
+PARSE_CHUNK_SIZE = 16
 
-def get_all_vocab_from_course_request(course_url: str, local_dir: str) -> pd.DataFrame:
-    """Given URL for course page, collect all vocab
 
-    Writes intermediate files to local_dir
+def make_session(
+    pool_size: int = DEFAULT_FETCH_CONCURRENCY,
+    retries: int = DEFAULT_FETCH_RETRIES,
+    backoff: float = DEFAULT_FETCH_BACKOFF,
+) -> requests.Session:
+    """Session keeping up to pool_size connections open per host, retrying failed and throttled GETs"""
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class LessonCache:
+    """Staging directory of fetched lesson pages, revalidated with conditional requests
+
+    Each page is stored gzip-compressed as {name}.html.gz, with the URL, ETag and Last-Modified validators and the
+    time it was last checked in {name}.meta.json. A page checked within max_age seconds is used as is. An older one is
+    requested with If-None-Match/If-Modified-Since, so an unchanged page costs a 304 response and no download. With
+    max_age None pages are never checked again; with 0 every page is checked. Raw {name}.html files staged by earlier
+    versions are compressed on first use.
+
+    Sample usage
+    ```
+    cache = LessonCache("tmp", max_age=0)
+    html_str, outcome = cache.get("lesson1_l-123", url, session)  # outcome "cached", "not modified" or "downloaded"
+    print(cache.counts)  # Counter of outcomes
+    ```
+
+    Parameters
+    ----------
+    local_dir : str or Path
+      Staging directory. Created if needed.
+    max_age : float, optional
+      Seconds after which a cached page is revalidated.
+    """
+
+    def __init__(self, local_dir: Union[str, Path], max_age: Optional[float] = None):
+        self.dir = Path(local_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _paths(self, name: str) -> tuple[Path, Path]:
+        return self.dir / f"{name}.html.gz", self.dir / f"{name}.meta.json"
+
+    def _write(self, name: str, body: Optional[bytes], meta: Optional[dict]):
+        """Write body and/or meta, each via a temporary file so an interrupted write leaves no partial file"""
+        body_path, meta_path = self._paths(name)
+        for path, content in ((body_path, body), (meta_path, meta)):
+            if content is None:
+                continue
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            data = gzip.compress(content) if path == body_path else json.dumps(content).encode("utf-8")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+    def _read(self, name: str) -> tuple[Optional[bytes], dict]:
+        body_path, meta_path = self._paths(name)
+        if not body_path.exists():
+            raw_path = self.dir / f"{name}.html"
+            if not raw_path.exists():
+                return None, {}
+            # Compress legacy raw page, without validators so it is downloaded again when revalidated
+            self._write(name, raw_path.read_bytes(), {"checked_at": raw_path.stat().st_mtime})
+            raw_path.unlink()
+        meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+        return gzip.decompress(body_path.read_bytes()), meta
+
+    def get(
+        self, name: str, url: str, session: Optional[requests.Session] = None, timeout: float = DEFAULT_FETCH_TIMEOUT
+    ) -> tuple[str, str]:
+        """Return page at url cached as name, requesting it if missing or older than max_age, and the outcome"""
+        body, meta = self._read(name)
+        if body is not None:
+            age = time.time() - meta.get("checked_at", 0)
+            if self.max_age is None or age < self.max_age:
+                return body.decode("utf-8"), self._count("cached")
+        headers = {}
+        if body is not None and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if body is not None and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        get = session.get if session is not None else requests.get
+        response = get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and body is not None:
+            meta["checked_at"] = time.time()
+            meta["etag"] = response.headers.get("ETag", meta.get("etag"))
+            self._write(name, None, meta)
+            return body.decode("utf-8"), self._count("not modified")
+        response.raise_for_status()
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked_at": time.time(),
+        }
+        self._write(name, response.content, meta)
+        return response.content.decode("utf-8"), self._count("downloaded")
+
+    def _count(self, outcome: str) -> str:
+        with self._lock:
+            self.counts[outcome] += 1
+        return outcome
+
+
+def get_all_vocab_from_course_request(
+    course_urls: Union[str, Iterable[str]],
+    local_dir: str,
+    concurrency: int = DEFAULT_FETCH_CONCURRENCY,
+    timeout: float = DEFAULT_FETCH_TIMEOUT,
+    base_url: str = DW_BASE_URL,
+    max_age: Optional[float] = None,
+) -> pd.DataFrame:
+    """Given URL for course page (or several), collect all vocab
+
+    Writes intermediate files to local_dir (see LessonCache), and revalidates those older than max_age seconds.
+    Lessons are fetched with up to concurrency requests at once over one connection pool.
     """
-    response = requests.get(course_url)
-    course_html = response.content.decode("utf-8")
-    print(f"got course_html {course_html[:100]}")
-    df = extract_script(course_html, Path(local_dir))
+    if isinstance(course_urls, str):
+        course_urls = [course_urls]
+    with make_session(pool_size=concurrency) as session:
+        course_htmls = []
+        for course_url in course_urls:
+            response = session.get(course_url, timeout=timeout)
+            response.raise_for_status()
+            course_html = response.content.decode("utf-8")
+            print(f"got course_html {course_html[:100]}")
+            course_htmls.append(course_html)
+        cache = LessonCache(local_dir, max_age=max_age)
+        df = extract_script(
+            course_htmls, cache, session=session, concurrency=concurrency, timeout=timeout, base_url=base_url
+        )
+    if cache.counts:
+        print(", ".join(f"{count} lessons {outcome}" for outcome, count in sorted(cache.counts.items())))
     return df
 
 
-def extract_script(course_html: str, local_dir: Path) -> pd.DataFrame:
-    """Given course page html, collect vocab list from all linked lessons
+def extract_script(
+    course_html: Union[str, list[str]],
+    local_dir: Union[Path, LessonCache],
+    session: Optional[requests.Session] = None,
+    concurrency: int = 1,
+    timeout: float = DEFAULT_FETCH_TIMEOUT,
+    base_url: str = DW_BASE_URL,
+) -> pd.DataFrame:
+    """Given course page html (or several), collect vocab list from all linked lessons
+
+    Lessons linked from several courses are only loaded once. Lessons are loaded with up to concurrency threads,
+    but words are kept in lesson order. local_dir can be a LessonCache to control revalidation.
 
     Drop fully duplicate entries (want to preserve duplicate words with
     different definitions)
@@ -33,49 +196,79 @@ def extract_script(course_html: str, local_dir: Path) -> pd.DataFrame:
     -------
     DataFrame with columns WORD_COL and DEFN_COL
     """
-    lessons = lessons_from_course(course_html)
+    course_htmls = [course_html] if isinstance(course_html, str) else course_html
+    course_lessons = [lessons_from_course(html_str) for html_str in course_htmls]
+    lessons = list(dict.fromkeys(lesson_id for lessons in course_lessons for lesson_id in lessons))
+    n_shared = sum(len(lessons) for lessons in course_lessons) - len(lessons)
+    if n_shared:
+        print(f"skipping {n_shared} lessons shared between courses")
+
+    cache = local_dir if isinstance(local_dir, LessonCache) else LessonCache(local_dir)
+
+    def load(lesson_id: str) -> str:
+        return load_lesson(lesson_id, cache, session=session, timeout=timeout, base_url=base_url)
+
     words = []
-    for lesson_id in lessons:
-        ws_html = load_lesson(lesson_id, local_dir)
-        lesson_words = words_from_wortschatz_html(ws_html)
-        print(f"{lesson_id} - extracted word count {len(lesson_words)}")
-        words.extend(lesson_words)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for lesson_id, ws_html in zip(lessons, executor.map(load, lessons)):
+            lesson_words = words_from_wortschatz_html(ws_html)
+            print(f"{lesson_id} - extracted word count {len(lesson_words)}")
+            words.extend(lesson_words)
     df = pd.DataFrame(words).drop_duplicates()
     return df
 
 
+def parse_html(html_str: str) -> html.HtmlElement:
+    """Parse page with lxml, which is many times faster than BeautifulSoup's html.parser"""
+    if not html_str.strip():
+        return html.fromstring("<html></html>")
+    return html.fromstring(html_str)
+
+
 def lessons_from_course(html_str: str) -> list[str]:
     """Given course page html contents, extract list of lesson ids"""
-    soup = BeautifulSoup(html_str, features="html.parser")
-    lesson_items = soup.find_all("li", "lesson-item")
     lesson_ids = []
-    for li in lesson_items:
-        lesson_href = li.a["href"]
+    for li in LESSON_ITEM_XPATH(parse_html(html_str)):
+        lesson_href = li.find(".//a").get("href")
         # only need last two parts of href to identify
         lesson_id = "/".join(lesson_href.split("/")[-2:])
         lesson_ids.append(lesson_id)
     return lesson_ids
 
 
-def load_lesson(lesson_id: str, local_dir: Path) -> str:
-    """Load lesson from local dir if present, otherwise request and write"""
-    local_path = local_dir / f"{lesson_id.replace('/', '_')}.html"
-    if local_path.exists():
-        print(f"{lesson_id} -- use {local_path}")
-        with open(local_path, "r") as f:
-            ws_html = f.read()
-    else:
-        print(f"{lesson_id} -- request")
-        ws_html = wortschatz_html_from_id(lesson_id)
-        with open(local_path, "w") as f:
-            f.write(ws_html)
-        print(f"{lesson_id} -- written to {local_path}")
+def load_lesson(
+    lesson_id: str,
+    local_dir: Union[Path, LessonCache],
+    session: Optional[requests.Session] = None,
+    timeout: float = DEFAULT_FETCH_TIMEOUT,
+    base_url: str = DW_BASE_URL,
+) -> str:
+    """Load lesson from local dir (or LessonCache) if present and fresh, otherwise request and write"""
+    cache = local_dir if isinstance(local_dir, LessonCache) else LessonCache(local_dir)
+    name = lesson_id.replace("/", "_")
+    ws_html, outcome = cache.get(name, wortschatz_url(lesson_id, base_url), session=session, timeout=timeout)
+    print(f"{lesson_id} -- {outcome}")
     return ws_html
 
 
-def wortschatz_html_from_id(lesson_id: str) -> str:
-    """Issue request for html contents of wortschatz page for lesson"""
-    response = requests.get(f"https://learngerman.dw.com/de/{lesson_id}/lv")
+def wortschatz_url(lesson_id: str, base_url: str = DW_BASE_URL) -> str:
+    """URL of wortschatz page for lesson"""
+    return f"{base_url}/de/{lesson_id}/lv"
+
+
+def wortschatz_html_from_id(
+    lesson_id: str,
+    session: Optional[requests.Session] = None,
+    timeout: float = DEFAULT_FETCH_TIMEOUT,
+    base_url: str = DW_BASE_URL,
+) -> str:
+    """Issue request for html contents of wortschatz page for lesson
+
+    Uses session if provided, to reuse its pooled connections and retries.
+    """
+    get = session.get if session is not None else requests.get
+    response = get(wortschatz_url(lesson_id, base_url), timeout=timeout)
+    response.raise_for_status()
     html_str = response.content.decode("utf-8")
     return html_str
 
@@ -85,15 +278,42 @@ def words_from_wortschatz_html(html_str: str) -> list[dict[str, str]]:
 
     Normalize string contents to avoid stray \xa0 from non-breaking spaces
     """
-    soup = BeautifulSoup(html_str, features="html.parser")
-    knowledge = soup.find(class_="knowledge-wrapper")
-    kdivs = knowledge.find_all("div")
+    knowledge = KNOWLEDGE_XPATH(parse_html(html_str))
+    if not knowledge:
+        raise ValueError("no knowledge-wrapper element in wortschatz page")
     words = []
-    for kdiv in kdivs:
-        word = kdiv.find("strong")
-        def_ = kdiv.find("p")
-        if word and def_:
-            word_text = normalize("NFKD", word.text)
-            def_text = normalize("NFKD", def_.text)
+    for kdiv in knowledge[0].iterdescendants("div"):
+        word = kdiv.find(".//strong")
+        def_ = kdiv.find(".//p")
+        if word is not None and def_ is not None:
+            word_text = normalize("NFKD", word.text_content())
+            def_text = normalize("NFKD", def_.text_content())
             words.append({WORD_COL: word_text, DEFN_COL: def_text})
     return words
+
+
+def read_staged_html(path: Union[str, Path]) -> str:
+    """Read lesson page staged in LessonCache (.html.gz) or by earlier versions (.html)"""
+    data = Path(path).read_bytes()
+    return (gzip.decompress(data) if str(path).endswith(".gz") else data).decode("utf-8")
+
+
+def _words_from_staged_file(path: Path) -> list[dict[str, str]]:
+    return words_from_wortschatz_html(read_staged_html(path))
+
+
+def words_from_staging_dir(local_dir: Union[str, Path], n_workers: int = 1) -> pd.DataFrame:
+    """Extract vocab from all lessons staged in local_dir, without any requests
+
+    Lessons are parsed in file name order, split across n_workers processes. Like extract_script, fully duplicate
+    entries are dropped.
+    """
+    paths = sorted(Path(local_dir).glob("*.html.gz")) + sorted(Path(local_dir).glob("*.html"))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            lesson_words = list(executor.map(_words_from_staged_file, paths, chunksize=PARSE_CHUNK_SIZE))
+    else:
+        lesson_words = [_words_from_staged_file(path) for path in paths]
+    words = [word for words in lesson_words for word in words]
+    print(f"extracted {len(words)} words from {len(paths)} lessons in {local_dir}")
+    return pd.DataFrame(words).drop_duplicates()
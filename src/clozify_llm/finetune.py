@@ -1,7 +1,14 @@
 """finetune.py Functionality to finetune completion LLM with training data
 """
+import hashlib
 import json
+import sqlite3
+import time
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from json.encoder import encode_basestring
 from pathlib import Path
+from typing import Optional, Union
 
 import openai
 import pandas as pd
@@ -9,38 +16,252 @@ import pandas as pd
 from clozify_llm.constants import (
     CLOZE_COL,
     DEFAULT_COMPLETION_MODEL,
+    DEFAULT_FINETUNE_EPOCHS,
+    DEFAULT_TRAINING_CHUNK_ROWS,
+    DEFAULT_UPLOAD_LEDGER_PATH,
     DEFN_COL,
+    FINETUNE_PRICES,
     WORD_COL,
 )
-from clozify_llm.utils import format_completion, format_prompt
+from clozify_llm.utils import estimate_tokens, format_completions, format_prompt
+
+TRAINING_COLS = [WORD_COL, DEFN_COL, "text", "translation", CLOZE_COL]
+# Bytes buffered before each write of the training data file
+WRITE_BUFFER_BYTES = 2**20
+# Bytes of a digest identifying a training example when dropping duplicates
+EXAMPLE_DIGEST_BYTES = 16
+
+
+def summarize_training_file(path: Union[str, Path]) -> dict:
+    """Number of examples, estimated prompt and completion tokens, size and sha256 of a JSONL training data file"""
+    sha256 = hashlib.sha256()
+    examples = 0
+    tokens = 0
+    with open(path, "rb") as f:
+        for line in f:
+            sha256.update(line)
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            examples += 1
+            tokens += estimate_tokens(entry["prompt"]) + estimate_tokens(entry["completion"])
+    return {
+        "path": str(path),
+        "examples": examples,
+        "tokens": tokens,
+        "bytes": Path(path).stat().st_size,
+        "sha256": sha256.hexdigest(),
+    }
+
+
+def estimate_finetune_cost(tokens: int, model: str, n_epochs: int = DEFAULT_FINETUNE_EPOCHS) -> Optional[float]:
+    """Estimated USD cost of fine-tuning model on tokens training tokens for n_epochs, or None if price is unknown"""
+    price = FINETUNE_PRICES.get(model)
+    if price is None:
+        return None
+    return tokens * n_epochs * price / 1000
+
+
+class UploadLedger:
+    """Local record of training data files uploaded for fine-tuning, stored in SQLite
+
+    Uploads are keyed by the sha256 of the file content, so launching fine-tuning again with an identical training
+    data file can reuse the uploaded file id instead of uploading it again.
+
+    Parameters
+    ----------
+    path : str or Path
+      Location of SQLite database file. Parent directories are created if needed.
+    """
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_UPLOAD_LEDGER_PATH):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS uploads (
+                sha256 TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                bytes INTEGER,
+                examples INTEGER,
+                tokens INTEGER,
+                uploaded_at REAL NOT NULL
+            )"""
+        )
+
+    def get(self, sha256: str) -> Optional[str]:
+        """File id of upload with content hash sha256, or None if not uploaded"""
+        row = self._conn.execute("SELECT file_id FROM uploads WHERE sha256 = ?", (sha256,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, summary: dict, file_id: str):
+        """Record upload of training data file described by summarize_training_file as file_id"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO uploads (sha256, file_id, bytes, examples, tokens, uploaded_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (summary["sha256"], file_id, summary["bytes"], summary["examples"], summary["tokens"], time.time()),
+        )
+
+    def forget(self, sha256: str):
+        self._conn.execute("DELETE FROM uploads WHERE sha256 = ?", (sha256,))
+
+    def close(self):
+        self._conn.close()
 
 
 class FineTuner:
-    def __init__(self, df: pd.DataFrame, training_data_path: str, model: str = DEFAULT_COMPLETION_MODEL):
+    """Builds training data file from a training set and starts fine-tuning on it
+
+    The training set is formatted and written in chunks, so a training CSV read with `from_csv` is never held in
+    memory all at once. Identical prompt/completion pairs are written once. Before upload the training data file is
+    summarized and hashed, and a file already recorded in the upload ledger is reused rather than uploaded again.
+
+    Parameters
+    ----------
+    df : pd.DataFrame or Iterable[pd.DataFrame]
+      Training set with WORD_COL, DEFN_COL, "text", "translation" and CLOZE_COL columns, or chunks of it. Chunks
+      from an iterator can only be formatted once.
+    training_data_path : str
+      Location of JSONL training data file.
+    model : str
+      Base model to fine-tune.
+    chunk_rows : int
+      Rows of a training set DataFrame formatted at a time.
+    ledger : UploadLedger, optional
+      Record of uploaded training data files. Defaults to the ledger at DEFAULT_UPLOAD_LEDGER_PATH.
+    """
+
+    def __init__(
+        self,
+        df: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+        training_data_path: str,
+        model: str = DEFAULT_COMPLETION_MODEL,
+        chunk_rows: int = DEFAULT_TRAINING_CHUNK_ROWS,
+        ledger: Optional[UploadLedger] = None,
+    ):
         self.df = df
         self.training_data_path = training_data_path
         self.model = model
+        self.chunk_rows = chunk_rows
+        self.ledger = ledger
+
+    @classmethod
+    def from_csv(
+        cls,
+        csv_path: Union[str, Path],
+        training_data_path: str,
+        model: str = DEFAULT_COMPLETION_MODEL,
+        chunk_rows: int = DEFAULT_TRAINING_CHUNK_ROWS,
+        ledger: Optional[UploadLedger] = None,
+    ) -> "FineTuner":
+        """FineTuner reading the training columns of csv_path in chunks of chunk_rows"""
+        chunks = pd.read_csv(csv_path, usecols=TRAINING_COLS, chunksize=chunk_rows)
+        return cls(chunks, training_data_path, model=model, chunk_rows=chunk_rows, ledger=ledger)
+
+    def iter_chunks(self) -> Iterator[pd.DataFrame]:
+        """Training set in chunks of at most chunk_rows rows"""
+        if isinstance(self.df, pd.DataFrame):
+            for start in range(0, len(self.df), self.chunk_rows):
+                yield self.df.iloc[start : start + self.chunk_rows]
+        else:
+            yield from self.df
+
+    @staticmethod
+    def format_chunk(chunk: pd.DataFrame) -> tuple[list[str], list[str]]:
+        """Prompts and completions of rows of chunk"""
+        prompts = [format_prompt(word, defn) for word, defn in zip(chunk[WORD_COL], chunk[DEFN_COL])]
+        completions = list(format_completions(zip(chunk["text"], chunk["translation"], chunk[CLOZE_COL])))
+        return prompts, completions
+
+    def iter_dataset(self) -> Iterator[dict]:
+        """Yield each training example as a dict with prompt and completion"""
+        for chunk in self.iter_chunks():
+            for prompt, completion in zip(*self.format_chunk(chunk)):
+                yield {"prompt": prompt, "completion": completion}
 
     def create_dataset(self) -> list[dict]:
-        train_rows = []
-        to_iter = self.df[[WORD_COL, DEFN_COL, "text", "translation", CLOZE_COL]]
-        for row in to_iter.itertuples():
-            prompt = format_prompt(getattr(row, WORD_COL), getattr(row, DEFN_COL))
-            completion = format_completion(row.text, row.translation, getattr(row, CLOZE_COL))
-            train_rows.append({"prompt": prompt, "completion": completion})
-        return train_rows
-
-    def write_data(self, dataset, overwrite=False):
-        """Write dataset to local training_data_path.
-
-        Do not overwrite unless instructed"""
+        return list(self.iter_dataset())
+
+    def iter_jsonl(self) -> Iterator[list[str]]:
+        """Yield lines of training data file for each chunk of training examples
+
+        Lines are identical to json.dump of each example with ensure_ascii=False, but built from pre-encoded strings.
+        """
+        for chunk in self.iter_chunks():
+            prompts, completions = self.format_chunk(chunk)
+            yield [
+                f'{{"prompt": {encode_basestring(prompt)}, "completion": {encode_basestring(completion)}}}\n'
+                for prompt, completion in zip(prompts, completions)
+            ]
+
+    def _iter_dataset_jsonl(self, dataset: Iterable[dict]) -> Iterator[list[str]]:
+        entries = iter(dataset)
+        while batch := list(islice(entries, self.chunk_rows)):
+            yield [json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch]
+
+    def write_data(self, dataset: Optional[Iterable[dict]] = None, overwrite=False) -> Optional[dict]:
+        """Write dataset (by default, the formatted training set) to local training_data_path.
+
+        Do not overwrite unless instructed. Duplicate examples are dropped. Returns counts of examples written and
+        duplicates dropped, or None if the file was not written."""
         if Path(self.training_data_path).exists() and not overwrite:
             print(f"{self.training_data_path} exists, skipping write")
-        else:
-            with open(self.training_data_path, "w", encoding="utf-8") as f:
-                for entry in dataset:
-                    json.dump(entry, f, ensure_ascii=False)
-                    f.write("\n")
+            return None
+        chunks = self.iter_jsonl() if dataset is None else self._iter_dataset_jsonl(dataset)
+        seen = set()
+        duplicates = 0
+        with open(self.training_data_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_BYTES) as f:
+            for lines in chunks:
+                unique_lines = []
+                for line in lines:
+                    digest = hashlib.blake2b(line.encode("utf-8"), digest_size=EXAMPLE_DIGEST_BYTES).digest()
+                    if digest in seen:
+                        duplicates += 1
+                    else:
+                        seen.add(digest)
+                        unique_lines.append(line)
+                f.write("".join(unique_lines))
+        return {"examples": len(seen), "duplicates": duplicates}
+
+    def prepare_upload(self, generate_dataset=True, n_epochs: int = DEFAULT_FINETUNE_EPOCHS) -> dict:
+        """Write training data file if generate_dataset, then summarize it and print estimated tokens and cost
+
+        Returns summary from summarize_training_file, with the duplicates dropped and estimated cost in USD (None if
+        the price of model is unknown).
+        """
+        written = self.write_data(overwrite=True) if generate_dataset else None
+        summary = summarize_training_file(self.training_data_path)
+        summary["duplicates"] = written["duplicates"] if written is not None else 0
+        summary["estimated_cost"] = estimate_finetune_cost(summary["tokens"], self.model, n_epochs)
+        cost = "unknown" if summary["estimated_cost"] is None else f"${summary['estimated_cost']:.2f}"
+        print(
+            f"{summary['examples']} examples ({summary['duplicates']} duplicates dropped), "
+            f"~{summary['tokens']} tokens, estimated cost {cost} for {n_epochs} epochs of {self.model}"
+        )
+        return summary
+
+    def upload(self, summary: dict) -> str:
+        """Upload training data file described by summary and return its file id
+
+        Reuses the file id recorded in the ledger for the same content if the file still exists, skipping the upload.
+        """
+        if self.ledger is None:
+            self.ledger = UploadLedger()
+        file_id = self.ledger.get(summary["sha256"])
+        if file_id is not None:
+            try:
+                openai.File.retrieve(file_id)
+                print(f"reusing uploaded file with id {file_id}")
+                return file_id
+            except openai.error.InvalidRequestError:
+                print(f"uploaded file with id {file_id} no longer exists")
+                self.ledger.forget(summary["sha256"])
+        with open(self.training_data_path, "r") as f:
+            file_response = openai.File.create(file=f, purpose="fine-tune")
+        print(f"File.create with id {file_response.id}")
+        self.ledger.record(summary, file_response.id)
+        return file_response.id
 
     def start_finetuning(self, generate_dataset=True):
         """Start finetuning and return response from openai.FineTune.create
@@ -52,15 +273,11 @@ class FineTuner:
         $ openai api fine_tunes.follow -i <FINE_TUNE_ID>
         ```
 
-        where <FINE_TUNE_ID> is the "id" field in the fine_tune.create response.
+        where <FINE_TUNE_ID> is the "id" field in the fine_tune.create response. The training data file is only
+        uploaded if the ledger has no upload of identical content.
         """
-        if generate_dataset:
-            dataset = self.create_dataset()
-            self.write_data(dataset, overwrite=True)
-
-        with open(self.training_data_path, "r") as f:
-            file_response = openai.File.create(file=f, purpose="fine-tune")
-        print(f"File.create with id {file_response.id}")
+        summary = self.prepare_upload(generate_dataset)
+        file_id = self.upload(summary)
 
-        ft_response = openai.FineTune.create(training_file=file_response.id, model=self.model)
+        ft_response = openai.FineTune.create(training_file=file_id, model=self.model)
         return ft_response
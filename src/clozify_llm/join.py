@@ -1,19 +1,131 @@
 """join.py Join existing cloze and vocab for training
 """
-from ast import literal_eval
-from typing import Optional
+import hashlib
+import warnings
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional, Union
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
 
-from clozify_llm.constants import CLOZE_COL, DEFN_COL, WORD_COL
+from clozify_llm.ann import IVFIndex
+from clozify_llm.constants import (
+    CLOZE_COL,
+    DEFAULT_EMB_ENG,
+    DEFAULT_N_PROBE,
+    DEFAULT_SIM_BLOCK_BYTES,
+    DEFAULT_TOP_K,
+    DEFN_COL,
+    EMBEDDING_BACKENDS,
+    WORD_COL,
+)
+from clozify_llm.emb_matrix import EmbeddingMatrix
+from clozify_llm.embed import CharNgramEmbedder
+from clozify_llm.lexical import LexicalMatcher
+from clozify_llm.similarity import merge_top_k, top_k_cosine, top_k_sparse
+
+
+def content_keys(df: pd.DataFrame, cols: list[str]) -> np.ndarray:
+    """Hash of the values in cols for each row of df"""
+    values = df[cols[0]].astype(str).str.cat([df[col].astype(str) for col in cols[1:]], sep="\x1f")
+    return np.array([hashlib.sha1(value.encode("utf-8")).hexdigest()[:16] for value in values], dtype="<U16")
+
+
+def keys_fingerprint(keys: np.ndarray) -> str:
+    """Hash of content keys in order"""
+    return hashlib.sha256("".join(keys).encode("utf-8")).hexdigest()
+
+
+def vocab_fingerprint(df_vocab: pd.DataFrame, word_col: str = WORD_COL, defn_col: str = DEFN_COL) -> str:
+    """Hash of the content and order of vocab rows, as matched by Joiner, identifying the vocab an index belongs to"""
+    return keys_fingerprint(content_keys(df_vocab, [col for col in (word_col, defn_col) if col in df_vocab]))
+
+
+def embedding_space(dim: int, projection_fingerprint: Optional[str] = None, engine: str = DEFAULT_EMB_ENG) -> str:
+    """Identifier of the space of dim dimensional embeddings from engine, reduced by a projection if fingerprint is set
+
+    Similarities are only comparable between embeddings in the same space.
+    """
+    return "/".join([engine] + ([projection_fingerprint] if projection_fingerprint else []) + [str(dim)])
+
+
+def match_state_path(join_csv: Union[str, Path]) -> Path:
+    """Location of MatchState sidecar for candidate join CSV"""
+    join_csv = Path(join_csv)
+    return join_csv.with_name(f"{join_csv.stem}.match.npz")
+
+
+class MatchState:
+    """Top-k matches of a join together with content hashes of the cloze and vocab rows they were computed from
+
+    Saved next to a candidate join so a later `Joiner.join_emb_sim(previous=...)` only needs to score what changed.
+
+    Parameters
+    ----------
+    cloze_keys : np.ndarray
+      Content hash of each cloze row.
+    vocab_keys : np.ndarray
+      Content hash of each vocab row.
+    indices : np.ndarray
+      Top-k vocab rows for each cloze row.
+    scores : np.ndarray
+      Similarities of top-k vocab rows.
+    backend : str
+      Backend the similarities were computed with. Matches are only reused with the same backend.
+    emb_space : str, optional
+      Embedding space the similarities were computed in (see embedding_space), or None if no embeddings were used.
+      Matches are only reused in the same space.
+    """
+
+    def __init__(
+        self,
+        cloze_keys: np.ndarray,
+        vocab_keys: np.ndarray,
+        indices: np.ndarray,
+        scores: np.ndarray,
+        backend: str = "openai",
+        emb_space: Optional[str] = None,
+    ):
+        self.cloze_keys = cloze_keys
+        self.vocab_keys = vocab_keys
+        self.indices = indices
+        self.scores = scores
+        self.backend = backend
+        self.emb_space = emb_space
+
+    @property
+    def k(self) -> int:
+        return self.indices.shape[1]
+
+    def save(self, path: Union[str, Path]):
+        np.savez(
+            path,
+            cloze_keys=self.cloze_keys,
+            vocab_keys=self.vocab_keys,
+            indices=self.indices,
+            scores=self.scores,
+            backend=self.backend,
+            emb_space=self.emb_space or "",
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "MatchState":
+        with np.load(path) as data:
+            backend = str(data["backend"]) if "backend" in data.files else "openai"
+            emb_space = str(data["emb_space"]) or None if "emb_space" in data.files else None
+            return cls(data["cloze_keys"], data["vocab_keys"], data["indices"], data["scores"], backend, emb_space)
 
 
 class Joiner:
     """Joins existing cloze and vocab for training
 
-    Assumes both already have embedding columns
+    Assumes both already have embeddings, either as embedding columns or as matrices passed as cloze_embs and
+    word_embs (e.g. EmbeddingMatrix memory-mapped from the .npy sidecars written by `prep embed --format npy`), with
+    one row per row of df_cloze and df_vocab respectively. An EmbeddingMatrix must be aligned to the dataframe index.
+    When matching several cloze sets against the same vocab, normalize word_embs once with `similarity.normalize_rows`
+    and pass word_embs_normalized=True to skip doing so per join. If the embeddings were reduced, pass the fingerprint
+    of their projection as projection_fingerprint, so match states record the embedding space they were computed in.
     """
 
     def __init__(
@@ -25,9 +137,17 @@ class Joiner:
         defn_col: str = DEFN_COL,
         cloze_emb_col: Optional[str] = None,
         word_emb_col: Optional[str] = None,
+        cloze_embs: Optional[Union[np.ndarray, EmbeddingMatrix]] = None,
+        word_embs: Optional[Union[np.ndarray, EmbeddingMatrix]] = None,
+        word_embs_normalized: bool = False,
+        projection_fingerprint: Optional[str] = None,
     ):
         self.df_cloze = df_cloze
         self.df_vocab = df_vocab
+        self.cloze_embs = cloze_embs
+        self.word_embs = word_embs
+        self.word_embs_normalized = word_embs_normalized and word_embs is not None
+        self.projection_fingerprint = projection_fingerprint
         self.cloze_col = cloze_col
         self.word_col = word_col
         self.defn_col = defn_col
@@ -37,8 +157,21 @@ class Joiner:
             word_emb_col = f"{word_col}_embedding"
         self.cloze_emb_col = cloze_emb_col
         self.word_emb_col = word_emb_col
+        self.match_state: Optional[MatchState] = None
+        self.n_rescored: Optional[int] = None
 
-    def join_emb_sim(self) -> pd.DataFrame:
+    def join_emb_sim(
+        self,
+        top_k: int = DEFAULT_TOP_K,
+        max_block_bytes: int = DEFAULT_SIM_BLOCK_BYTES,
+        n_threads: int = 1,
+        n_workers: int = 1,
+        index: Optional[IVFIndex] = None,
+        n_probe: int = DEFAULT_N_PROBE,
+        previous: Optional[MatchState] = None,
+        lexical: bool = False,
+        backend: str = "openai",
+    ) -> pd.DataFrame:
         """Join df_cloze and df_vocab based on cosine similarity of embedding
         columns
 
@@ -59,32 +192,119 @@ class Joiner:
         Also note each vocab generated zero, one, or more cloze sentences. Each
         cloze sentence corresponds to exactly one vocab (word + definition).
 
+        Similarities are computed in blocks of clozes (see `similarity.top_k_cosine`)
+        so memory use is bounded by max_block_bytes per thread.
+
+        Parameters
+        ----------
+        top_k : int
+          Number of candidate vocab rows kept per cloze. The best match is joined;
+          runner-up candidates are added as vocab_idx_{rank} and match_score_{rank}
+          columns for rank 2 to top_k to help manual review.
+        max_block_bytes : int
+          Memory budget for each block of similarities.
+        n_threads : int
+          Number of blocks computed in parallel.
+        n_workers : int
+          Number of processes sharing the scoring of clozes, with embeddings
+          placed in shared memory.
+        index : IVFIndex, optional
+          Approximate nearest neighbour index of the vocab embeddings. If set, it
+          is searched instead of comparing each cloze with every vocab row, and
+          vocab embeddings are not needed. Raises ValueError if the index
+          fingerprint does not match the vocab rows.
+        n_probe : int
+          Number of index lists searched per cloze when using index.
+        previous : MatchState, optional
+          Match state of an earlier join. Only clozes that are new or changed
+          since are scored against all vocab; unchanged clozes are only scored
+          against vocab rows added since, and their earlier matches are reused.
+          If previous was computed in another embedding space (e.g. with other
+          dimensions or projection), all clozes are rescored with a warning.
+
+        lexical : bool
+          Whether to first match clozes by word form (see `lexical.LexicalMatcher`).
+          Clozes that unambiguously match a vocab entry are joined with
+          match_score 1.0 and need no embedding; the others are matched by
+          embedding similarity. Adds a match_method column.
+        backend : str
+          "openai" to match by the embeddings provided, or "local" to match by
+          character n-gram TF-IDF vectors of the cloze and word text (see
+          `embed.CharNgramEmbedder`), which needs no embeddings.
+
+        After the join, self.match_state holds the state to pass as previous in a
+        later join, and self.n_rescored the number of clozes scored against all
+        vocab.
+
         Returns
         -------
         pd.DataFrame
           DataFrame with proposed join between cloze and vocab
         """
-        if self.cloze_emb_col not in self.df_cloze.columns:
-            raise ValueError(f"cloze_emb_col {self.cloze_emb_col} must be in self.df_cloze")
-        if self.word_emb_col not in self.df_vocab.columns:
-            raise ValueError(f"word_emb_col {self.word_emb_col} must be in self.df_vocab")
-
-        # Handle str of list (common if embedding dataframes loaded from csv)
-        cloze_embs = self.df_cloze[self.cloze_emb_col]
-        if cloze_embs.dtype == object:
-            cloze_embs = cloze_embs.apply(lambda x: literal_eval(x))
-        word_embs = self.df_vocab[self.word_emb_col]
-        if word_embs.dtype == object:
-            word_embs = word_embs.apply(lambda x: literal_eval(x))
-
-        X = np.array(cloze_embs.tolist())
-        Y = np.array(word_embs.tolist())
-        cos_sim_word = cosine_similarity(X, Y)
-        # For each cloze, identify the index of the word with closest embedding
-        match_idx_word = np.argmax(cos_sim_word, axis=1)
-        # Use the matches indices to create a join key
-        join_keys = pd.Series(match_idx_word).reset_index()
-        join_keys.columns = ["cloze_idx", "vocab_idx"]
+        cloze_keys = content_keys(self.df_cloze, [self.cloze_col])
+        vocab_keys = content_keys(
+            self.df_vocab, [col for col in (self.word_col, self.defn_col) if col in self.df_vocab]
+        )
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"unknown backend {backend}")
+        n_clozes = len(self.df_cloze)
+        k = min(top_k, len(self.df_vocab))
+        match_idx = np.full((n_clozes, k), -1, dtype=np.int64)
+        match_score = np.full((n_clozes, k), -np.inf, dtype=np.float32)
+        if lexical:
+            lexical_idx = LexicalMatcher(self.df_vocab[self.word_col]).match_many(self.df_cloze[self.cloze_col])
+        else:
+            lexical_idx = np.full(n_clozes, -1)
+        lexical_rows = lexical_idx >= 0
+        match_idx[lexical_rows, 0] = lexical_idx[lexical_rows]
+        match_score[lexical_rows, 0] = 1.0
+        # For each remaining cloze, identify the indices of the words with closest embeddings
+        dense_rows = np.flatnonzero(~lexical_rows)
+        self.n_rescored = 0
+        emb_space = None
+        if len(dense_rows) and backend == "local":
+            if index is not None or previous is not None:
+                raise ValueError("index and previous match state cannot be used with local backend")
+            # Repeated cloze words are only scored once
+            codes, unique_clozes = pd.factorize(self.df_cloze[self.cloze_col].iloc[dense_rows], use_na_sentinel=False)
+            embs = CharNgramEmbedder().fit_transform(list(unique_clozes) + self.df_vocab[self.word_col].tolist())
+            unique_idx, unique_score = top_k_sparse(
+                embs[: len(unique_clozes)], embs[len(unique_clozes) :], k=k, max_block_bytes=max_block_bytes
+            )
+            match_idx[dense_rows], match_score[dense_rows] = unique_idx[codes], unique_score[codes]
+            self.n_rescored = len(dense_rows)
+        elif len(dense_rows):
+            X = self._get_emb_matrix(self.df_cloze, self.cloze_emb_col, self.cloze_embs)
+            if len(dense_rows) < n_clozes:
+                X = X[dense_rows]
+            if np.isnan(X).any():
+                raise ValueError("some clozes have neither an embedding nor a lexical match")
+            emb_space = embedding_space(X.shape[1], self.projection_fingerprint)
+            match_idx[dense_rows], match_score[dense_rows] = self._dense_top_k(
+                X,
+                cloze_keys[dense_rows],
+                vocab_keys,
+                k,
+                emb_space,
+                max_block_bytes=max_block_bytes,
+                n_threads=n_threads,
+                n_workers=n_workers,
+                index=index,
+                n_probe=n_probe,
+                previous=previous,
+            )
+        self.match_state = MatchState(
+            cloze_keys[dense_rows], vocab_keys, match_idx[dense_rows], match_score[dense_rows], backend, emb_space
+        )
+        # Use the best match indices to create a join key
+        join_keys = pd.DataFrame(
+            {"cloze_idx": np.arange(n_clozes), "vocab_idx": match_idx[:, 0], "match_score": match_score[:, 0]}
+        )
+        if lexical:
+            join_keys["match_method"] = np.where(lexical_rows, "lexical", "embedding")
+        for rank in range(2, match_idx.shape[1] + 1):
+            join_keys[f"vocab_idx_{rank}"] = match_idx[:, rank - 1]
+            join_keys[f"match_score_{rank}"] = match_score[:, rank - 1]
         # Assign join keys to each vocab -- note multiple cloze_idx can map to
         # single vocab_idx
         vocab_with_keys = pd.merge(
@@ -108,6 +328,107 @@ class Joiner:
         )
         return candidate_join
 
+    def _dense_top_k(
+        self,
+        X: np.ndarray,
+        cloze_keys: np.ndarray,
+        vocab_keys: np.ndarray,
+        k: int,
+        emb_space: str,
+        max_block_bytes: int,
+        n_threads: int,
+        n_workers: int,
+        index: Optional[IVFIndex],
+        n_probe: int,
+        previous: Optional[MatchState],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k matches of cloze embeddings X by embedding similarity"""
+        if index is not None:
+            if previous is not None:
+                raise ValueError("previous match state cannot be used with an index")
+            if len(index) != len(self.df_vocab):
+                raise ValueError(f"index has {len(index)} vectors but vocab has {len(self.df_vocab)} rows")
+            if index.vocab_fingerprint is not None and index.vocab_fingerprint != keys_fingerprint(vocab_keys):
+                raise ValueError("index was built from different vocab rows, rebuild the index")
+            self.n_rescored = len(X)
+            return index.search(X, k=k, n_probe=n_probe, max_block_bytes=max_block_bytes)
+        Y = self._get_emb_matrix(self.df_vocab, self.word_emb_col, self.word_embs)
+        sim_kwargs = {
+            "max_block_bytes": max_block_bytes,
+            "n_threads": n_threads,
+            "n_workers": n_workers,
+            "Y_normalized": self.word_embs_normalized,
+        }
+        if previous is not None and previous.k == k and previous.backend == "openai":
+            if previous.emb_space == emb_space:
+                return self._incremental_top_k(X, Y, cloze_keys, vocab_keys, previous, **sim_kwargs)
+            if len(previous.cloze_keys):
+                warnings.warn(
+                    f"previous matches were computed in embedding space {previous.emb_space}, not {emb_space}, "
+                    "rescoring all clozes"
+                )
+        self.n_rescored = len(X)
+        return top_k_cosine(X, Y, k=k, **sim_kwargs)
+
+    def _incremental_top_k(
+        self,
+        X: np.ndarray,
+        Y: np.ndarray,
+        cloze_keys: np.ndarray,
+        vocab_keys: np.ndarray,
+        previous: MatchState,
+        **sim_kwargs,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k matches reusing previous matches for unchanged clozes. sim_kwargs are passed to top_k_cosine."""
+        # Map each previous vocab row to the current row with the same content (nth duplicate to nth duplicate)
+        current_rows = defaultdict(list)
+        for row, key in reversed(list(enumerate(vocab_keys))):
+            current_rows[key].append(row)
+        vocab_remap = np.array([current_rows[key].pop() if current_rows[key] else -1 for key in previous.vocab_keys])
+        new_vocab = np.sort([row for rows in current_rows.values() for row in rows]).astype(np.int64)
+        # Padding -1 stays -1, and a candidate whose vocab row was removed also maps to -1
+        remapped = np.where(previous.indices >= 0, np.append(vocab_remap, -1)[previous.indices], -1)
+
+        previous_rows = {key: row for row, key in enumerate(previous.cloze_keys)}
+        reuse = np.array([key in previous_rows for key in cloze_keys], dtype=bool)
+        reuse_from = np.array([previous_rows[key] for key in cloze_keys[reuse]], dtype=np.int64)
+        # Clozes with a previous candidate that no longer exists are rescored
+        lost = ((remapped[reuse_from] < 0) & (previous.indices[reuse_from] >= 0)).any(axis=1)
+        reuse[np.flatnonzero(reuse)[lost]] = False
+        reuse_from = reuse_from[~lost]
+
+        k = previous.k
+        indices = np.empty((len(X), k), dtype=np.int64)
+        scores = np.empty((len(X), k), dtype=np.float32)
+        reuse_rows = np.flatnonzero(reuse)
+        indices[reuse_rows] = remapped[reuse_from]
+        scores[reuse_rows] = previous.scores[reuse_from]
+        if len(reuse_rows) and len(new_vocab):
+            new_idx, new_scores = top_k_cosine(X[reuse_rows], Y[new_vocab], k=k, **sim_kwargs)
+            indices[reuse_rows], scores[reuse_rows] = merge_top_k(
+                indices[reuse_rows], scores[reuse_rows], new_vocab[new_idx], new_scores, k
+            )
+        rescore_rows = np.flatnonzero(~reuse)
+        if len(rescore_rows):
+            indices[rescore_rows], scores[rescore_rows] = top_k_cosine(X[rescore_rows], Y, k=k, **sim_kwargs)
+        self.n_rescored = len(rescore_rows)
+        return indices, scores
+
+    @staticmethod
+    def _get_emb_matrix(
+        df: pd.DataFrame, emb_col: str, embs: Optional[Union[np.ndarray, EmbeddingMatrix]]
+    ) -> Union[np.ndarray, EmbeddingMatrix]:
+        """Use embedding matrix if provided, otherwise build one from embedding column of df"""
+        if embs is not None:
+            if len(embs) != len(df):
+                raise ValueError(f"embedding matrix has {len(embs)} rows but dataframe has {len(df)}")
+            if isinstance(embs, EmbeddingMatrix) and not embs.index.equals(df.index):
+                raise ValueError("embedding matrix index is not aligned to dataframe index")
+            return embs
+        if emb_col not in df.columns:
+            raise ValueError(f"embedding column {emb_col} must be in dataframe if no embedding matrix is provided")
+        return EmbeddingMatrix.from_column(df[emb_col])
+
     def clean_join_from_review(
         self, candidate_join: pd.DataFrame, manual_review: pd.DataFrame, output_intermediate_cols: bool = False
     ) -> pd.DataFrame:
@@ -130,7 +451,7 @@ class Joiner:
             to_correct, self.df_vocab, left_on="correct_vocab_idx", right_index=True, how="left"
         ).drop(columns=["issue"])
         with_corrections = pd.merge(
-            candidate_join.drop([self.cloze_emb_col, self.word_emb_col], axis="columns"),
+            candidate_join.drop([self.cloze_emb_col, self.word_emb_col], axis="columns", errors="ignore"),
             correction,
             left_on="cloze_idx",
             right_on="cloze_idx",
@@ -150,7 +471,8 @@ class Joiner:
 
         if not output_intermediate_cols:
             with_corrections = with_corrections.drop(
-                columns=["correct_vocab_idx", corrected_word_col, corrected_defn_col, self.word_emb_col]
+                columns=["correct_vocab_idx", corrected_word_col, corrected_defn_col, self.word_emb_col],
+                errors="ignore",
             )
 
         return with_corrections
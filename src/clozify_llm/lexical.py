@@ -0,0 +1,154 @@
+"""lexical.py Match clozes to vocab by word form, without embeddings
+"""
+import re
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import Optional
+from unicodedata import normalize
+
+import numpy as np
+
+ARTICLES = ("der", "die", "das", "ein", "eine", "sich")
+NOUN_ARTICLES = ("der", "die", "das")
+# Endings added to singular nouns when declined (genitive, old dative)
+DECLENSION_ENDINGS = ("e", "es", "s")
+# Endings added to verb stems when conjugated
+CONJUGATION_ENDINGS = ("e", "est", "et", "st", "t", "te", "ten", "test", "tet")
+# Shorter stems are not inflected, since their inflections collide with unrelated words (sei-t, Rat-e, Weg-e)
+MIN_INFLECTED_STEM = 4
+NOUN = "noun"
+VERB = "verb"
+# Gender or plural-only annotation marking a noun, such as "(f.)" or "(Pl.)"
+GENDER_PATTERN = re.compile(r"\(\s*(?:m|f|n|pl)\.?\s*\)", re.IGNORECASE)
+UMLAUTS = {"a": "ä", "o": "ö", "u": "ü"}
+# Plural annotation such as "-n", "-en", "¨-e" or "-¨er". "¨" may be decomposed into a combining diaeresis.
+PLURAL_PATTERN = re.compile(r"^\s*(?P<umlaut1>[¨̈]?)\s*-\s*(?P<umlaut2>[¨̈]?)\s*(?P<suffix>\w*)\s*$")
+
+
+def normalize_form(text: str) -> str:
+    """Compose unicode and casefold so differently encoded or capitalized forms compare equal"""
+    return normalize("NFC", text).casefold().strip()
+
+
+def umlaut(word: str) -> str:
+    """Umlaut the last a, o, u or au in word, as in plurals like Haus -> Häuser"""
+    for position in range(len(word) - 1, -1, -1):
+        if word[position] in "aou":
+            if word[position] == "u" and word[position - 1 : position] == "a":
+                return word[: position - 1] + "äu" + word[position + 1 :]
+            return word[:position] + UMLAUTS[word[position]] + word[position + 1 :]
+    return word
+
+
+def parse_vocab_word(word: str) -> Optional[tuple[str, Optional[str], Optional[str]]]:
+    """Base form, plural form (if annotated) and word class of a DW vocab entry such as "Ausrede, -n (f.)"
+
+    Gender and other parenthesized annotations, leading articles and "sich" are dropped. The word class is NOUN for
+    entries marked by gender, article, plural or capitalization, VERB for other entries ending in -n or -en (or
+    marked by "sich"), and None otherwise. Returns None for entries that are not a single word once stripped
+    (phrases), since clozes are single words.
+    """
+    word = normalize("NFKD", word)
+    has_gender = GENDER_PATTERN.search(word) is not None
+    base, _, annotation = re.sub(r"\(.*?\)", "", word).partition(",")
+    tokens = base.split()
+    articles = []
+    while len(tokens) > 1 and tokens[0].casefold() in ARTICLES:
+        articles.append(tokens.pop(0).casefold())
+    if len(tokens) != 1 or not normalize_form(tokens[0]).isalpha():
+        return None
+    base = normalize_form(tokens[0])
+    plural = None
+    plural_match = PLURAL_PATTERN.match(annotation)
+    if annotation and plural_match:
+        stem = umlaut(base) if plural_match["umlaut1"] or plural_match["umlaut2"] else base
+        plural = normalize_form(stem + plural_match["suffix"])
+    if (
+        has_gender
+        or plural is not None
+        or any(article in NOUN_ARTICLES for article in articles)
+        or tokens[0][0].isupper()
+    ):
+        word_class = NOUN
+    elif "sich" in articles or base.endswith("n"):
+        word_class = VERB
+    else:
+        word_class = None
+    return base, plural, word_class
+
+
+def inflected_forms(base: str, plural: Optional[str] = None, word_class: Optional[str] = None) -> set[str]:
+    """Common German inflections of base form of given word class, excluding base itself
+
+    Nouns get declension endings and their plural, verbs get conjugation endings, and other words (whose inflection
+    cannot be told from the entry) get none. Stems shorter than MIN_INFLECTED_STEM are only inflected by their
+    annotated plural.
+    """
+    forms = set()
+    if word_class == NOUN:
+        if len(base) >= MIN_INFLECTED_STEM:
+            forms.update(base + ending for ending in DECLENSION_ENDINGS)
+        if plural is not None:
+            forms.add(plural)
+            if not plural.endswith(("n", "s")):
+                forms.add(plural + "n")
+    elif word_class == VERB:
+        for infinitive_ending in ("en", "n"):
+            stem = base[: -len(infinitive_ending)]
+            if base.endswith(infinitive_ending) and len(stem) >= MIN_INFLECTED_STEM:
+                forms.update(stem + ending for ending in CONJUGATION_ENDINGS)
+                break
+    forms.discard(base)
+    return forms
+
+
+class LexicalMatcher:
+    """Hash index from word forms to vocab rows
+
+    Each single-word vocab entry is indexed under its normalized base form, and under common inflections and its
+    annotated plural (see inflected_forms). A cloze is matched if its form identifies exactly one vocab row: base
+    forms are looked up first, and inflected forms only if no base form matches. Lowercase clozes are not matched to
+    nouns, which German always capitalizes. Ambiguous forms (e.g. the same word listed with two definitions) are not
+    matched, so they can be left to embedding similarity.
+
+    Sample usage
+    ```
+    matcher = LexicalMatcher(df_vocab[WORD_COL])
+    vocab_idx = matcher.match_many(df_cloze[CLOZE_COL])  # -1 where not matched
+    ```
+
+    Parameters
+    ----------
+    vocab_words : Iterable[str]
+      Vocab entries, in row order.
+    """
+
+    def __init__(self, vocab_words: Iterable[str]):
+        self._base_forms: dict[str, set[int]] = defaultdict(set)
+        self._inflected_forms: dict[str, set[int]] = defaultdict(set)
+        self._noun_rows: set[int] = set()
+        for row, word in enumerate(vocab_words):
+            parsed = parse_vocab_word(word) if isinstance(word, str) else None
+            if parsed is None:
+                continue
+            base, plural, word_class = parsed
+            self._base_forms[base].add(row)
+            for form in inflected_forms(base, plural, word_class):
+                self._inflected_forms[form].add(row)
+            if word_class == NOUN:
+                self._noun_rows.add(row)
+
+    def match(self, cloze: str) -> int:
+        """Vocab row unambiguously matching cloze word, or -1"""
+        if not isinstance(cloze, str):
+            return -1
+        form = normalize_form(cloze)
+        excluded = self._noun_rows if cloze.strip()[:1].islower() else set()
+        rows = self._base_forms.get(form, set()) - excluded or self._inflected_forms.get(form, set()) - excluded
+        if len(rows) != 1:
+            return -1
+        return next(iter(rows))
+
+    def match_many(self, clozes: Iterable[str]) -> np.ndarray:
+        """Vocab row matching each cloze, or -1 where none matches unambiguously"""
+        return np.array([self.match(cloze) for cloze in clozes], dtype=np.int64)
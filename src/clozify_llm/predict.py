@@ -1,6 +1,14 @@
 """predict.py Perform model inference
 """
+import asyncio
+import hashlib
+import json
+import sqlite3
+import sys
+import time
 from abc import abstractmethod
+from pathlib import Path
+from typing import Optional, Union
 
 import openai
 from openai.api_resources.abstract.engine_api_resource import EngineAPIResource
@@ -11,10 +19,125 @@ from clozify_llm.constants import (
     DEFAULT_CHAT_MAX_TOKENS,
     DEFAULT_CHAT_MODEL,
     DEFAULT_CHAT_TEMPERATURE,
+    DEFAULT_COMPLETION_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_MAX_BATCH_PROMPT_TOKENS,
+    DEFAULT_RESPONSE_CACHE_PATH,
     END_STR,
     STARTING_MESSAGE,
 )
-from clozify_llm.utils import format_prompt
+from clozify_llm.ratelimit import RateLimiter, get_rate_limiter
+from clozify_llm.utils import (
+    batch_by_tokens,
+    estimate_request_tokens,
+    estimate_tokens,
+    format_prompt,
+    get_total_tokens,
+)
+
+
+class ResponseCache:
+    """Persistent on-disk cache of API responses, stored in SQLite
+
+    Responses are keyed by a hash of the full request parameters, so a hit is only possible for an identical request
+    (same model, messages or prompt, temperature, max_tokens, ...). The raw response is stored as JSON together with
+    its token usage.
+
+    The database uses write-ahead logging so many readers (e.g. concurrent `clozify` runs) can share one cache file.
+    Reads never write to the database; eviction is explicit via `prune()`, by entry age and/or total stored size,
+    oldest entries first.
+
+    Parameters
+    ----------
+    path : str or Path
+      Location of SQLite database file. Parent directories are created if needed.
+    """
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_RESPONSE_CACHE_PATH):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                total_tokens INTEGER,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+
+    @staticmethod
+    def make_key(params: dict) -> str:
+        """Hash of request parameters, independent of dict ordering"""
+        encoded = json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, params: dict) -> Optional[OpenAIObject]:
+        """Return cached response for request parameters, or None on a miss"""
+        row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (self.make_key(params),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return OpenAIObject.construct_from(json.loads(row[0]))
+
+    def set(self, params: dict, response: dict):
+        """Store response for request parameters, replacing any existing entry"""
+        total_tokens = (response.get("usage") or {}).get("total_tokens")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, total_tokens, created_at) VALUES (?, ?, ?, ?)",
+            (self.make_key(params), json.dumps(response, ensure_ascii=False), total_tokens, time.time()),
+        )
+
+    def stats(self) -> dict:
+        """Summarize cache contents and hit/miss counts of this instance"""
+        entries, size_bytes, total_tokens, oldest, newest = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(response)), 0), COALESCE(SUM(total_tokens), 0),"
+            " MIN(created_at), MAX(created_at) FROM responses"
+        ).fetchone()
+        return {
+            "path": str(self.path),
+            "entries": entries,
+            "size_bytes": size_bytes,
+            "total_tokens": total_tokens,
+            "oldest": oldest,
+            "newest": newest,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def prune(self, max_age: Optional[float] = None, max_bytes: Optional[int] = None) -> int:
+        """Evict entries older than max_age seconds, then oldest entries until stored size is at most max_bytes
+
+        Returns number of entries evicted.
+        """
+        evicted = 0
+        if max_age is not None:
+            cursor = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - max_age,))
+            evicted += cursor.rowcount
+        if max_bytes is not None:
+            # Keep the newest entries whose cumulative size fits within max_bytes
+            cursor = self._conn.execute(
+                """DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(LENGTH(response)) OVER (ORDER BY created_at DESC, key) AS cumulative_bytes
+                        FROM responses
+                    ) WHERE cumulative_bytes > ?
+                )""",
+                (max_bytes,),
+            )
+            evicted += cursor.rowcount
+        if evicted:
+            self._conn.execute("VACUUM")
+        return evicted
+
+    def close(self):
+        self._conn.close()
 
 
 class GenericCompleter:
@@ -32,27 +155,97 @@ class GenericCompleter:
 
     Alternatively `get_completion_response()` can be used to return the raw `OpenAIObject` response.
 
+    Many inputs can be completed concurrently with the async interface, with results returned in input order
+    ```
+    cloze_texts = asyncio.run(completer.aget_cloze_texts(words, defns, concurrency=8))
+    ```
+
     Parameters
     ----------
     openai_resource : EngineAPIResource
       Resource implementing `create()` method that calls openai API
     model_id : str
       Identifier of model being used
+    cache : ResponseCache, optional
+      If provided, responses are looked up in and saved to cache, and only cache misses call the API.
+    rate_limiter : RateLimiter, optional
+      Limiter that paces requests. By default the limiter shared by all requests to model_id.
     """
 
-    def __init__(self, openai_resource: EngineAPIResource, model_id: str):
+    def __init__(
+        self,
+        openai_resource: EngineAPIResource,
+        model_id: str,
+        cache: Optional[ResponseCache] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
         self.openai_resource = openai_resource
         self.model_id = model_id
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+
+    def create(self, **kwargs) -> OpenAIObject:
+        """Send request with params kwargs, returning cached response if available, otherwise calling resource.create
+
+        Requests are paced by the rate limiter and retried on errors (see `_create_with_backoff`).
+        """
+        if self.cache is not None:
+            cached = self.cache.get(kwargs)
+            if cached is not None:
+                return cached
+        response = self._create_with_backoff(**kwargs)
+        if self.cache is not None:
+            self.cache.set(kwargs, response)
+        return response
+
+    async def acreate(self, **kwargs) -> OpenAIObject:
+        """Async version of create()"""
+        if self.cache is not None:
+            cached = self.cache.get(kwargs)
+            if cached is not None:
+                return cached
+        response = await self._acreate_with_backoff(**kwargs)
+        if self.cache is not None:
+            self.cache.set(kwargs, response)
+        return response
+
+    def _get_rate_limiter(self) -> RateLimiter:
+        if self.rate_limiter is not None:
+            return self.rate_limiter
+        return get_rate_limiter(self.model_id)
 
     @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
     def _create_with_backoff(self, **kwargs):
-        """Wrap resource.create call with retry to handle rate limit errors"""
-        return self.openai_resource.create(**kwargs)
+        """Wrap resource.create call with client-side rate limiting, and retry to handle rate limit errors"""
+        rate_limiter = self._get_rate_limiter()
+        reserved = rate_limiter.acquire(estimate_request_tokens(kwargs))
+        response = None
+        try:
+            response = self.openai_resource.create(**kwargs)
+        finally:
+            rate_limiter.settle(reserved, get_total_tokens(response))
+        return response
+
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
+    async def _acreate_with_backoff(self, **kwargs):
+        """Wrap resource.acreate call with client-side rate limiting, and retry to handle rate limit errors"""
+        rate_limiter = self._get_rate_limiter()
+        reserved = await rate_limiter.aacquire(estimate_request_tokens(kwargs))
+        response = None
+        try:
+            response = await self.openai_resource.acreate(**kwargs)
+        finally:
+            rate_limiter.settle(reserved, get_total_tokens(response))
+        return response
 
     @abstractmethod
     def get_completion_response(self, word: str, defn: str, **kwargs) -> OpenAIObject:
         """Get completion response from word and definition.'''"""
 
+    @abstractmethod
+    async def aget_completion_response(self, word: str, defn: str, **kwargs) -> OpenAIObject:
+        """Get completion response from word and definition without blocking the event loop."""
+
     @abstractmethod
     def extract_text_from_response(self, response: OpenAIObject) -> str:
         """Get single text from OpenAI response."""
@@ -61,48 +254,216 @@ class GenericCompleter:
         """Get single cloze completion text from OpenAIObject"""
         completion = self.get_completion_response(word, defn)
         cloze_response = self.extract_text_from_response(completion)
-        print(f"response for {word} received, total usage {completion.get('usage').get('total_tokens')}")
+        print(
+            f"response for {word} received, total usage {completion.get('usage').get('total_tokens')}", file=sys.stderr
+        )
         return cloze_response
 
+    def get_cloze_texts(self, words: list[str], defns: list[str]) -> list[str]:
+        """Get cloze texts for many words, one request per word"""
+        _check_same_length(words, defns)
+        return [self.get_cloze_text(word, defn) for word, defn in zip(words, defns)]
+
+    async def aget_cloze_text(self, word: str, defn: str) -> str:
+        """Async version of get_cloze_text()"""
+        completion = await self.aget_completion_response(word, defn)
+        cloze_response = self.extract_text_from_response(completion)
+        print(
+            f"response for {word} received, total usage {completion.get('usage').get('total_tokens')}", file=sys.stderr
+        )
+        return cloze_response
+
+    async def aget_cloze_texts(
+        self, words: list[str], defns: list[str], concurrency: int = DEFAULT_CONCURRENCY
+    ) -> list[str]:
+        """Get cloze texts for many words, with up to `concurrency` requests in flight at once
+
+        Parameters
+        ----------
+        words : list[str]
+          Words to be clozified.
+        defns : list[str]
+          Definition for each word, same length as words.
+        concurrency : int
+          Maximum number of simultaneous requests.
+
+        Returns
+        -------
+        list[str]
+          Cloze texts in the same order as the input words.
+        """
+        _check_same_length(words, defns)
+        semaphore = _make_semaphore(concurrency)
+
+        async def bounded_get_cloze_text(word: str, defn: str) -> str:
+            async with semaphore:
+                return await self.aget_cloze_text(word, defn)
+
+        return await asyncio.gather(*(bounded_get_cloze_text(word, defn) for word, defn in zip(words, defns)))
+
 
 class Completer(GenericCompleter):
-    """Completer for OpenAI "Completion" model"""
+    """Completer for OpenAI "Completion" model
+
+    The Completion endpoint accepts a list of prompts, so `get_cloze_texts()` and `aget_cloze_texts()` pack up to
+    batch_size prompts (and at most max_batch_tokens estimated prompt tokens) into each request.
+    """
 
-    def __init__(self, model_id: str):
-        super().__init__(openai_resource=openai.Completion, model_id=model_id)
+    def __init__(
+        self, model_id: str, cache: Optional[ResponseCache] = None, rate_limiter: Optional[RateLimiter] = None
+    ):
+        super().__init__(openai_resource=openai.Completion, model_id=model_id, cache=cache, rate_limiter=rate_limiter)
 
     def get_completion_response(self, word: str, defn: str, **kwargs) -> OpenAIObject:
         """Get completion response from word and definition
 
         Includes formatting prompt assumed to be in same way that completion model was fine-tuned.
         """
-        prompt = format_prompt(word, defn)
-        completion_kwargs = {
-            "max_tokens": 200,
-            "temperature": 0.2,
-        }
-        completion_kwargs.update(**kwargs)
-        completion = self._get_completion_with_backoff(
-            model=self.model_id,
-            prompt=prompt,
-            stop=END_STR,
-            **completion_kwargs,
-        )
+        completion_params = self._make_completion_params(format_prompt(word, defn), **kwargs)
+        completion = self._get_completion_with_backoff(**completion_params)
         return completion
 
+    async def aget_completion_response(self, word: str, defn: str, **kwargs) -> OpenAIObject:
+        """Async version of get_completion_response()"""
+        completion_params = self._make_completion_params(format_prompt(word, defn), **kwargs)
+        return await self.acreate(**completion_params)
+
+    def get_cloze_texts(
+        self,
+        words: list[str],
+        defns: list[str],
+        batch_size: int = DEFAULT_COMPLETION_BATCH_SIZE,
+        max_batch_tokens: int = DEFAULT_MAX_BATCH_PROMPT_TOKENS,
+    ) -> list[str]:
+        """Get cloze texts for many words, packing multiple prompts into each request
+
+        Parameters
+        ----------
+        words : list[str]
+          Words to be clozified.
+        defns : list[str]
+          Definition for each word, same length as words.
+        batch_size : int
+          Maximum number of prompts per request.
+        max_batch_tokens : int
+          Maximum estimated prompt tokens per request.
+
+        Returns
+        -------
+        list[str]
+          Cloze texts in the same order as the input words.
+        """
+        _check_same_length(words, defns)
+        prompts = [format_prompt(word, defn) for word, defn in zip(words, defns)]
+        cloze_texts = self._get_cached_texts(words, prompts)
+        for batch in self._batch_uncached(prompts, cloze_texts, batch_size, max_batch_tokens):
+            batch_prompts = [prompts[i] for i in batch]
+            completion = self._create_with_backoff(**self._make_completion_params(batch_prompts))
+            batch_texts = self._split_batch_response(completion, [words[i] for i in batch], batch_prompts)
+            for i, cloze_text in zip(batch, batch_texts):
+                cloze_texts[i] = cloze_text
+        return cloze_texts
+
+    async def aget_cloze_texts(
+        self,
+        words: list[str],
+        defns: list[str],
+        concurrency: int = DEFAULT_CONCURRENCY,
+        batch_size: int = DEFAULT_COMPLETION_BATCH_SIZE,
+        max_batch_tokens: int = DEFAULT_MAX_BATCH_PROMPT_TOKENS,
+    ) -> list[str]:
+        """Async version of get_cloze_texts(), with up to `concurrency` batch requests in flight at once"""
+        _check_same_length(words, defns)
+        semaphore = _make_semaphore(concurrency)
+        prompts = [format_prompt(word, defn) for word, defn in zip(words, defns)]
+        cloze_texts = self._get_cached_texts(words, prompts)
+
+        async def bounded_get_batch(batch: list[int]):
+            batch_prompts = [prompts[i] for i in batch]
+            async with semaphore:
+                completion = await self._acreate_with_backoff(**self._make_completion_params(batch_prompts))
+            batch_texts = self._split_batch_response(completion, [words[i] for i in batch], batch_prompts)
+            for i, cloze_text in zip(batch, batch_texts):
+                cloze_texts[i] = cloze_text
+
+        batches = self._batch_uncached(prompts, cloze_texts, batch_size, max_batch_tokens)
+        await asyncio.gather(*(bounded_get_batch(batch) for batch in batches))
+        return cloze_texts
+
     def extract_text_from_response(self, response: OpenAIObject) -> str:
         return response["choices"][0]["text"].strip()
 
     def _get_completion_with_backoff(self, model: str, prompt: str, stop: str, **kwargs):
         """Call openai.Completion.create with defined params set"""
-        return self._create_with_backoff(model=model, prompt=prompt, stop=stop, **kwargs)
+        return self.create(model=model, prompt=prompt, stop=stop, **kwargs)
+
+    def _get_cached_texts(self, words: list[str], prompts: list[str]) -> list[Optional[str]]:
+        """Look up each prompt as a single-prompt request in cache, with None for misses"""
+        if self.cache is None:
+            return [None] * len(prompts)
+        cloze_texts = []
+        for word, prompt in zip(words, prompts):
+            cached = self.cache.get(self._make_completion_params(prompt))
+            if cached is not None:
+                print(f"response for {word} found in cache", file=sys.stderr)
+                cached = self.extract_text_from_response(cached)
+            cloze_texts.append(cached)
+        return cloze_texts
+
+    @staticmethod
+    def _batch_uncached(
+        prompts: list[str], cloze_texts: list[Optional[str]], batch_size: int, max_batch_tokens: int
+    ) -> list[list[int]]:
+        """Batch the indices of prompts that do not have a cloze text yet"""
+        uncached = [i for i, cloze_text in enumerate(cloze_texts) if cloze_text is None]
+        batches = batch_by_tokens([prompts[i] for i in uncached], batch_size, max_batch_tokens)
+        return [[uncached[j] for j in batch] for batch in batches]
+
+    def _make_completion_params(self, prompt: Union[str, list[str]], **kwargs) -> dict:
+        """Assemble parameters for openai.Completion request, with a single prompt or list of prompts"""
+        completion_kwargs = {
+            "max_tokens": 200,
+            "temperature": 0.2,
+        }
+        completion_kwargs.update(**kwargs)
+        return {"model": self.model_id, "prompt": prompt, "stop": END_STR, **completion_kwargs}
+
+    def _split_batch_response(self, response: OpenAIObject, words: list[str], prompts: list[str]) -> list[str]:
+        """Get one text per prompt from a multi-prompt response, matched by choice index
+
+        The response only reports total usage for the request, so it is split across items in proportion to their
+        estimated prompt and completion tokens.
+        """
+        texts: list[Optional[str]] = [None] * len(prompts)
+        for choice in response["choices"]:
+            texts[choice["index"]] = choice["text"].strip()
+        missing = [word for word, text in zip(words, texts) if text is None]
+        if missing:
+            raise ValueError(f"response missing choices for {missing}")
+        item_tokens = [estimate_tokens(prompt) + estimate_tokens(text) for prompt, text in zip(prompts, texts)]
+        item_usages = _apportion(response.get("usage").get("total_tokens"), item_tokens)
+        for word, usage in zip(words, item_usages):
+            print(f"response for {word} received, estimated usage {usage}", file=sys.stderr)
+        if self.cache is not None:
+            # Cache each item as its own single-prompt response, so hits do not depend on how prompts were batched
+            for prompt, text, usage in zip(prompts, texts, item_usages):
+                item_response = {"choices": [{"text": text, "index": 0}], "usage": {"total_tokens": usage}}
+                self.cache.set(self._make_completion_params(prompt), item_response)
+        return texts
 
 
 class ChatCompleter(GenericCompleter):
     """Completer for OpenAI "ChatCompleter" model"""
 
-    def __init__(self, model_id: str = DEFAULT_CHAT_MODEL):
-        super().__init__(openai_resource=openai.ChatCompletion, model_id=model_id)
+    def __init__(
+        self,
+        model_id: str = DEFAULT_CHAT_MODEL,
+        cache: Optional[ResponseCache] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        super().__init__(
+            openai_resource=openai.ChatCompletion, model_id=model_id, cache=cache, rate_limiter=rate_limiter
+        )
 
     def get_completion_response(self, word: str, defn: str, **kwargs) -> OpenAIObject:
         """Get completion response from word
@@ -119,9 +480,14 @@ class ChatCompleter(GenericCompleter):
           Additional kwargs passed to self._make_chat_params() (temperature, max_tokens).
         """
         chat_params = self._make_chat_params(input_word=word, **kwargs)
-        response = self._create_with_backoff(**chat_params)
+        response = self.create(**chat_params)
         return response
 
+    async def aget_completion_response(self, word: str, defn: str, **kwargs) -> OpenAIObject:
+        """Async version of get_completion_response()"""
+        chat_params = self._make_chat_params(input_word=word, **kwargs)
+        return await self.acreate(**chat_params)
+
     def extract_text_from_response(self, response: OpenAIObject) -> str:
         return response["choices"][0]["message"]["content"].strip()
 
@@ -135,3 +501,22 @@ class ChatCompleter(GenericCompleter):
         prompt_message = {"role": "user", "content": f"Input: {input_word}"}
         messages = STARTING_MESSAGE + [prompt_message]
         return {"model": self.model_id, "temperature": temperature, "max_tokens": max_tokens, "messages": messages}
+
+
+def _check_same_length(words: list[str], defns: list[str]):
+    if len(words) != len(defns):
+        raise ValueError(f"words and defns must be same length, got {len(words)} and {len(defns)}")
+
+
+def _make_semaphore(concurrency: int) -> asyncio.Semaphore:
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    return asyncio.Semaphore(concurrency)
+
+
+def _apportion(total: int, weights: list[int]) -> list[int]:
+    """Split integer total in proportion to weights, with shares summing exactly to total"""
+    weight_sum = sum(weights)
+    shares = [total * weight // weight_sum for weight in weights]
+    shares[-1] += total - sum(shares)
+    return shares
@@ -0,0 +1,127 @@
+"""ratelimit.py Client-side rate limiting of OpenAI API requests
+"""
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from clozify_llm.constants import DEFAULT_RATE_LIMIT, RATE_LIMITS
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests-per-minute and tokens-per-minute budgets
+
+    Each budget is a bucket that holds up to one minute's allowance and refills continuously. Before a request,
+    `acquire()` waits until one request and the estimated tokens are available and reserves them. Once the response
+    is in, `settle()` corrects the token bucket by the difference between the estimate and the `usage.total_tokens`
+    actually reported, so later requests are paced by real usage.
+
+    Sample usage
+    ```
+    limiter = get_rate_limiter("gpt-3.5-turbo")
+    reserved = limiter.acquire(estimated_tokens)
+    response = openai.ChatCompletion.create(...)
+    limiter.settle(reserved, response["usage"]["total_tokens"])
+    ```
+
+    Parameters
+    ----------
+    requests_per_minute : float
+      Maximum requests per minute.
+    tokens_per_minute : float
+      Maximum tokens per minute.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        if requests_per_minute <= 0 or tokens_per_minute <= 0:
+            raise ValueError("requests_per_minute and tokens_per_minute must be positive")
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_refill) / 60
+        self._last_refill = now
+        self._available_requests = min(
+            self.requests_per_minute, self._available_requests + elapsed_minutes * self.requests_per_minute
+        )
+        self._available_tokens = min(
+            self.tokens_per_minute, self._available_tokens + elapsed_minutes * self.tokens_per_minute
+        )
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Reserve a request and tokens if available, returning 0. Otherwise return seconds to wait before retrying."""
+        with self._lock:
+            self._refill()
+            request_shortfall = 1 - self._available_requests
+            token_shortfall = tokens - self._available_tokens
+            if request_shortfall <= 0 and token_shortfall <= 0:
+                self._available_requests -= 1
+                self._available_tokens -= tokens
+                return 0.0
+            return max(request_shortfall / self.requests_per_minute, token_shortfall / self.tokens_per_minute) * 60
+
+    def _cap(self, tokens: int) -> int:
+        # A single request larger than the whole budget would otherwise wait forever
+        return min(max(int(tokens), 0), int(self.tokens_per_minute))
+
+    def acquire(self, tokens: int) -> int:
+        """Block until a request with `tokens` estimated tokens fits within budget. Returns tokens reserved."""
+        tokens = self._cap(tokens)
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+        return tokens
+
+    async def aacquire(self, tokens: int) -> int:
+        """Async version of acquire()"""
+        tokens = self._cap(tokens)
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+        return tokens
+
+    def settle(self, reserved: int, actual: Optional[int]):
+        """Correct token budget once actual usage is known
+
+        If actual is None (e.g. the request failed) the reservation is refunded.
+        """
+        with self._lock:
+            self._available_tokens += reserved - (actual or 0)
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _base_model(model: str) -> str:
+    """Fine-tuned model ids ("curie:ft-personal-...") share limits with their base model"""
+    return model.split(":")[0]
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """Get limiter shared by all requests to model, created from RATE_LIMITS on first use"""
+    key = _base_model(model)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            requests_per_minute, tokens_per_minute = RATE_LIMITS.get(key, DEFAULT_RATE_LIMIT)
+            _rate_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _rate_limiters[key]
+
+
+def configure_rate_limit(
+    model: str, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None
+) -> RateLimiter:
+    """Override the requests-per-minute and/or tokens-per-minute budget for model
+
+    Budgets that are not provided keep their current value.
+    """
+    current = get_rate_limiter(model)
+    limiter = RateLimiter(
+        requests_per_minute or current.requests_per_minute, tokens_per_minute or current.tokens_per_minute
+    )
+    with _rate_limiters_lock:
+        _rate_limiters[_base_model(model)] = limiter
+    return limiter
@@ -0,0 +1,175 @@
+"""reduce.py Reduce dimensionality of embeddings for faster matching and smaller artifacts
+"""
+import hashlib
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from clozify_llm.constants import (
+    DEFAULT_REDUCED_DIMS,
+    DEFAULT_SIM_BLOCK_BYTES,
+    REDUCTION_METHODS,
+)
+from clozify_llm.emb_matrix import EmbeddingMatrix
+from clozify_llm.similarity import normalize_rows, top_k_cosine
+
+# Rows of embeddings projected at a time, bounding memory used for dequantizing and normalizing
+PROJECT_BLOCK_ROWS = 8192
+
+
+def projection_path(csv_path: Union[str, Path]) -> Path:
+    """Location of the projection saved with reduced embeddings of the CSV at csv_path"""
+    csv_path = Path(csv_path)
+    return csv_path.with_name(f"{csv_path.stem}.projection.npz")
+
+
+def saved_projection_fingerprint(csv_path: Union[str, Path]) -> Optional[str]:
+    """Fingerprint of the projection saved with reduced embeddings of csv_path, or None if not reduced"""
+    path = projection_path(csv_path)
+    return Projection.load(path).fingerprint if path.exists() else None
+
+
+class Projection:
+    """Linear map of unit-length embeddings to fewer dimensions
+
+    Either the top principal components of a fitted set of embeddings (e.g. the vocab), or a seeded Gaussian random
+    projection, which needs no fitting and roughly preserves cosine similarities. Cloze and vocab embeddings are only
+    comparable if reduced with the same projection, so it is saved next to each reduced output and identified by its
+    fingerprint.
+
+    Sample usage
+    ```
+    projection = Projection.fit(word_embs, n_dims=256, method="pca")
+    reduced_words, reduced_clozes = projection.transform(word_embs), projection.transform(cloze_embs)
+    ```
+
+    Parameters
+    ----------
+    components : np.ndarray
+      (n_dims, dim) matrix whose rows are the directions projected onto.
+    mean : np.ndarray
+      Mean of unit-length embeddings subtracted before projecting (zeros for random projections).
+    method : str
+      Method the projection was made with, one of REDUCTION_METHODS.
+    """
+
+    def __init__(self, components: np.ndarray, mean: np.ndarray, method: str):
+        self.components = np.asarray(components, dtype=np.float32)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.method = method
+
+    @property
+    def n_dims(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of projection parameters, equal for projections giving the same output"""
+        digest = hashlib.sha1(self.method.encode("utf-8"))
+        digest.update(np.ascontiguousarray(self.components).tobytes())
+        digest.update(np.ascontiguousarray(self.mean).tobytes())
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def fit(
+        cls, embs: Union[np.ndarray, EmbeddingMatrix], n_dims: int = DEFAULT_REDUCED_DIMS, method: str = "pca", seed=0
+    ) -> "Projection":
+        """Make projection of method to n_dims dimensions, fitted on embs for "pca" """
+        if method == "pca":
+            return cls.fit_pca(embs, n_dims)
+        elif method == "random":
+            return cls.random(embs.shape[1], n_dims, seed=seed)
+        raise ValueError(f"unknown method {method}, must be one of {REDUCTION_METHODS}")
+
+    @classmethod
+    def fit_pca(cls, embs: Union[np.ndarray, EmbeddingMatrix], n_dims: int) -> "Projection":
+        """Top n_dims principal components of unit-length embs
+
+        The covariance matrix is accumulated over blocks of rows, so embs can be memory-mapped. Rows with missing
+        (NaN) embeddings are ignored.
+        """
+        dim = embs.shape[1]
+        if not 0 < n_dims <= dim:
+            raise ValueError(f"n_dims must be between 1 and {dim}, got {n_dims}")
+        total = np.zeros(dim, dtype=np.float64)
+        gram = np.zeros((dim, dim), dtype=np.float64)
+        n_rows = 0
+        for start in range(0, len(embs), PROJECT_BLOCK_ROWS):
+            block = normalize_rows(embs[start : start + PROJECT_BLOCK_ROWS])
+            block = block[~np.isnan(block).any(axis=1)].astype(np.float64)
+            total += block.sum(axis=0)
+            gram += block.T @ block
+            n_rows += len(block)
+        if n_rows == 0:
+            raise ValueError("no embeddings to fit")
+        mean = total / n_rows
+        eigenvalues, eigenvectors = np.linalg.eigh(gram / n_rows - np.outer(mean, mean))
+        components = eigenvectors[:, np.argsort(eigenvalues)[::-1][:n_dims]].T
+        # Fix sign of each component so the same data always gives the same projection
+        signs = np.sign(components[np.arange(n_dims), np.abs(components).argmax(axis=1)])
+        return cls(components * signs[:, None], mean, "pca")
+
+    @classmethod
+    def random(cls, dim: int, n_dims: int, seed: int = 0) -> "Projection":
+        """Gaussian random projection from dim to n_dims dimensions, determined by seed"""
+        rng = np.random.default_rng(seed)
+        components = rng.standard_normal((n_dims, dim)) / np.sqrt(n_dims)
+        return cls(components, np.zeros(dim), "random")
+
+    def transform(self, embs: Union[np.ndarray, EmbeddingMatrix]) -> EmbeddingMatrix:
+        """Project unit-length embs, keeping the index of an EmbeddingMatrix. Missing rows stay NaN."""
+        if embs.shape[1] != self.dim:
+            raise ValueError(f"embeddings have {embs.shape[1]} dimensions but projection expects {self.dim}")
+        reduced = np.empty((len(embs), self.n_dims), dtype=np.float32)
+        for start in range(0, len(embs), PROJECT_BLOCK_ROWS):
+            block = normalize_rows(embs[start : start + PROJECT_BLOCK_ROWS])
+            reduced[start : start + len(block)] = (block - self.mean) @ self.components.T
+        return EmbeddingMatrix(reduced, index=embs.index if isinstance(embs, EmbeddingMatrix) else None)
+
+    def save(self, path: Union[str, Path]):
+        np.savez(path, components=self.components, mean=self.mean, method=self.method)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "Projection":
+        with np.load(path) as data:
+            return cls(data["components"], data["mean"], str(data["method"]))
+
+
+def reduction_report(
+    cloze_embs: Union[np.ndarray, EmbeddingMatrix],
+    word_embs: Union[np.ndarray, EmbeddingMatrix],
+    dims: list[int],
+    method: str = "pca",
+    seed: int = 0,
+    max_block_bytes: int = DEFAULT_SIM_BLOCK_BYTES,
+) -> pd.DataFrame:
+    """Count how many best matches change when matching at each number of dims instead of full dimension
+
+    The projection is fitted on word_embs. Clozes without an embedding are left out. Returns a row per dims with
+    columns n_dims, changed (number of clozes whose best vocab match differs), changed_pct, match_seconds and
+    bytes_per_row of the reduced float32 embeddings.
+    """
+    cloze_embs = cloze_embs[~np.isnan(np.asarray(cloze_embs)).any(axis=1)]
+    word_embs_normalized = normalize_rows(word_embs)
+    start_time = time.perf_counter()
+    full_idx, _ = top_k_cosine(
+        cloze_embs, word_embs_normalized, k=1, max_block_bytes=max_block_bytes, Y_normalized=True
+    )
+    rows = [(word_embs.shape[1], 0, time.perf_counter() - start_time)]
+    for n_dims in dims:
+        projection = Projection.fit(word_embs_normalized, n_dims=n_dims, method=method, seed=seed)
+        reduced_clozes, reduced_words = projection.transform(cloze_embs), projection.transform(word_embs_normalized)
+        start_time = time.perf_counter()
+        idx, _ = top_k_cosine(reduced_clozes, reduced_words, k=1, max_block_bytes=max_block_bytes)
+        rows.append((n_dims, int((idx[:, 0] != full_idx[:, 0]).sum()), time.perf_counter() - start_time))
+    report = pd.DataFrame(rows, columns=["n_dims", "changed", "match_seconds"])
+    report["changed_pct"] = 100 * report["changed"] / max(len(cloze_embs), 1)
+    report["bytes_per_row"] = report["n_dims"] * np.dtype(np.float32).itemsize
+    return report[["n_dims", "changed", "changed_pct", "match_seconds", "bytes_per_row"]]
@@ -0,0 +1,216 @@
+"""similarity.py Memory-bounded nearest neighbour search over embeddings
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Union
+
+import numpy as np
+
+from clozify_llm.constants import DEFAULT_SIM_BLOCK_BYTES, DEFAULT_TOP_K
+from clozify_llm.emb_matrix import EmbeddingMatrix
+
+if TYPE_CHECKING:
+    from scipy import sparse
+
+# Cap on size of densified blocks of sparse similarities, small enough to stay in cache
+SPARSE_BLOCK_BYTES = 16 * 2**20
+
+
+def normalize_rows(embs: Union[np.ndarray, EmbeddingMatrix]) -> np.ndarray:
+    """Scale rows to unit length as float32, leaving all-zero rows as zeros (as sklearn's cosine_similarity does)
+
+    Uses the cached norms of an EmbeddingMatrix rather than computing them again.
+    """
+    if isinstance(embs, EmbeddingMatrix):
+        return embs.normalized()
+    embs = np.asarray(embs, dtype=np.float32)
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embs / norms
+
+
+def _block_top_k(sims: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Indices and scores of k largest values per row, in descending order with ties going to the lower index"""
+    if k == 1:
+        idx = np.argmax(sims, axis=1)[:, None]
+    else:
+        idx = np.argpartition(-sims, k - 1, axis=1)[:, :k] if k < sims.shape[1] else np.indices(sims.shape)[1]
+        order = np.lexsort((idx, -np.take_along_axis(sims, idx, axis=1)), axis=1)
+        idx = np.take_along_axis(idx, order, axis=1)
+    return idx, np.take_along_axis(sims, idx, axis=1)
+
+
+def merge_top_k(
+    idx_a: np.ndarray, scores_a: np.ndarray, idx_b: np.ndarray, scores_b: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Combine two sets of candidates per row, keeping the k best with ties going to the lower index"""
+    idx = np.concatenate([idx_a, idx_b], axis=1)
+    scores = np.concatenate([scores_a, scores_b], axis=1)
+    order = np.lexsort((idx, -scores), axis=1)[:, :k]
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def top_k_cosine(
+    X: np.ndarray,
+    Y: np.ndarray,
+    k: int = DEFAULT_TOP_K,
+    max_block_bytes: int = DEFAULT_SIM_BLOCK_BYTES,
+    n_threads: int = 1,
+    Y_normalized: bool = False,
+    n_workers: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find the k rows of Y most cosine-similar to each row of X
+
+    Y is normalized once, then rows of X are normalized and multiplied against it in blocks, so only
+    `max_block_bytes` of similarities per thread are held in memory at a time rather than the full len(X) x len(Y)
+    matrix. X can be a memory-mapped array. Similarities are computed in float32.
+
+    Parameters
+    ----------
+    X : np.ndarray
+      Query embeddings, one per row.
+    Y : np.ndarray
+      Candidate embeddings, one per row.
+    k : int
+      Number of candidates to keep per query. Capped at len(Y).
+    max_block_bytes : int
+      Memory budget for the similarity block computed by each thread.
+    n_threads : int
+      Number of blocks computed at once. NumPy releases the GIL during matrix multiplication.
+    Y_normalized : bool
+      Whether rows of Y already have unit length.
+    n_workers : int
+      If more than 1, split rows of X into shards scored by a pool of processes (see `_top_k_cosine_sharded`).
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+      Indices into Y and cosine similarities, each of shape (len(X), k), best match first.
+    """
+    k = min(k, len(Y))
+    if k < 1:
+        raise ValueError("k must be positive and Y must not be empty")
+    Y_norm = np.asarray(Y, dtype=np.float32) if Y_normalized else normalize_rows(Y)
+    if n_workers > 1 and len(X) > 1:
+        return _top_k_cosine_sharded(X, Y_norm, k, max_block_bytes, n_workers)
+    block_rows = max(1, max_block_bytes // (len(Y) * np.dtype(np.float32).itemsize))
+    indices = np.empty((len(X), k), dtype=np.int64)
+    scores = np.empty((len(X), k), dtype=np.float32)
+
+    def score_block(start: int):
+        stop = min(start + block_rows, len(X))
+        sims = normalize_rows(X[start:stop]) @ Y_norm.T
+        indices[start:stop], scores[start:stop] = _block_top_k(sims, k)
+
+    starts = range(0, len(X), block_rows)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(score_block, starts))
+    else:
+        for start in starts:
+            score_block(start)
+    return indices, scores
+
+
+def top_k_sparse(
+    X: "sparse.csr_matrix",
+    Y: "sparse.csr_matrix",
+    k: int = DEFAULT_TOP_K,
+    max_block_bytes: int = DEFAULT_SIM_BLOCK_BYTES,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find the k rows of Y with the largest dot product with each row of X, for sparse unit-length rows
+
+    Like `top_k_cosine`, rows of X are multiplied against Y in blocks, each densified within max_block_bytes (capped
+    at SPARSE_BLOCK_BYTES, as densifying small blocks is faster).
+    """
+    k = min(k, Y.shape[0])
+    if k < 1:
+        raise ValueError("k must be positive and Y must not be empty")
+    Y_T = Y.T.tocsr()
+    block_bytes = min(max_block_bytes, SPARSE_BLOCK_BYTES)
+    block_rows = max(1, block_bytes // (Y.shape[0] * np.dtype(np.float32).itemsize))
+    indices = np.empty((X.shape[0], k), dtype=np.int64)
+    scores = np.empty((X.shape[0], k), dtype=np.float32)
+    for start in range(0, X.shape[0], block_rows):
+        stop = min(start + block_rows, X.shape[0])
+        sims = (X[start:stop] @ Y_T).toarray()
+        indices[start:stop], scores[start:stop] = _block_top_k(sims, k)
+    return indices, scores
+
+
+# Shards per worker, so workers finishing early pick up remaining work
+SHARDS_PER_WORKER = 4
+
+
+def _to_shared(arr: np.ndarray) -> tuple[SharedMemory, tuple]:
+    """Copy arr into a new shared memory block. Returns the block and a picklable spec to attach to it."""
+    shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach_shared(spec: tuple) -> tuple[SharedMemory, np.ndarray]:
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _score_shard(
+    x_spec: tuple, y_spec: tuple, start: int, stop: int, k: int, max_block_bytes: int
+) -> tuple[int, np.ndarray, np.ndarray]:
+    """Worker task: top-k of rows start:stop of the shared X against shared normalized Y"""
+    try:
+        from threadpoolctl import threadpool_limits
+
+        # One BLAS thread per worker, since the workers already use every core
+        limits = threadpool_limits(1)
+    except ImportError:
+        limits = nullcontext()
+    x_shm, X = _attach_shared(x_spec)
+    y_shm, Y_norm = _attach_shared(y_spec)
+    try:
+        with limits:
+            indices, scores = top_k_cosine(
+                X[start:stop], Y_norm, k=k, max_block_bytes=max_block_bytes, Y_normalized=True
+            )
+        return start, indices, scores
+    finally:
+        del X, Y_norm
+        x_shm.close()
+        y_shm.close()
+
+
+def _top_k_cosine_sharded(
+    X: np.ndarray, Y_norm: np.ndarray, k: int, max_block_bytes: int, n_workers: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Score shards of X rows in a process pool
+
+    X and the normalized Y are placed in shared memory once, and workers attach to them by name rather than
+    receiving pickled copies. Only shard bounds and the per-shard top-k results pass between processes.
+    """
+    shard_rows = -(-len(X) // (n_workers * SHARDS_PER_WORKER))
+    indices = np.empty((len(X), k), dtype=np.int64)
+    scores = np.empty((len(X), k), dtype=np.float32)
+    x_shm, x_spec = _to_shared(np.asarray(X, dtype=np.float32))
+    try:
+        y_shm, y_spec = _to_shared(Y_norm)
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [
+                    executor.submit(
+                        _score_shard, x_spec, y_spec, start, min(start + shard_rows, len(X)), k, max_block_bytes
+                    )
+                    for start in range(0, len(X), shard_rows)
+                ]
+                for future in futures:
+                    start, shard_indices, shard_scores = future.result()
+                    indices[start : start + len(shard_indices)] = shard_indices
+                    scores[start : start + len(shard_scores)] = shard_scores
+        finally:
+            y_shm.close()
+            y_shm.unlink()
+    finally:
+        x_shm.close()
+        x_shm.unlink()
+    return indices, scores
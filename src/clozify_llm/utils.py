@@ -1,36 +1,99 @@
 """utils.py Utility functions
 """
 import csv
+from collections.abc import Iterable, Iterator
 from io import StringIO
+from itertools import islice
+from typing import TYPE_CHECKING, Optional
 
 import openai
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from tenacity import RetryError, retry, stop_after_attempt, wait_random_exponential
 
-from clozify_llm.constants import DEFAULT_EMB_ENG, END_STR, PROMPT_SEPARATOR, QUOTECHAR
+from clozify_llm.constants import (
+    CHARS_PER_TOKEN,
+    DEFAULT_EMB_BATCH_SIZE,
+    DEFAULT_EMB_ENG,
+    DEFAULT_MAX_EMB_BATCH_TOKENS,
+    END_STR,
+    PROMPT_SEPARATOR,
+    QUOTECHAR,
+)
+from clozify_llm.ratelimit import RateLimiter, get_rate_limiter
+
+# Line terminator splitting rows of completions formatted together, never expected inside training data
+RECORD_SEPARATOR = "\x1e"
+COMPLETION_BATCH_ROWS = 10_000
+
+if TYPE_CHECKING:
+    # Only used for type hints, to avoid requiring numpy outside of the prep dependency group
+    from clozify_llm.embed_cache import EmbeddingCache
 
 
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def get_emb(x, embedding_engine=DEFAULT_EMB_ENG):
+def get_emb(x, embedding_engine=DEFAULT_EMB_ENG, rate_limiter: Optional[RateLimiter] = None):
     """Get embedding response for input from OpenAI API
 
-    Wrap with retry to handle rate limit errors"""
-    resp = openai.Embedding.create(input=x, engine=embedding_engine)
+    Paced by rate_limiter (by default the shared limiter for embedding_engine), and wrapped with retry to handle any
+    remaining rate limit errors"""
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter(embedding_engine)
+    reserved = rate_limiter.acquire(estimate_request_tokens({"input": x}))
+    resp = None
+    try:
+        resp = openai.Embedding.create(input=x, engine=embedding_engine)
+    finally:
+        rate_limiter.settle(reserved, get_total_tokens(resp))
     return resp
 
 
-def get_embs(xs: list[str]) -> list[list[float]]:
-    """Get embedding for list of inputs, with handling of rate limiting."""
-    embs = []
+def get_embs(
+    xs: list[str],
+    batch_size: int = DEFAULT_EMB_BATCH_SIZE,
+    max_batch_tokens: int = DEFAULT_MAX_EMB_BATCH_TOKENS,
+    cache: Optional["EmbeddingCache"] = None,
+) -> list[list[float]]:
+    """Get embedding for list of inputs, with handling of rate limiting.
+
+    Inputs are sent in batches of up to batch_size items and max_batch_tokens estimated tokens per request, and
+    results are mapped back to inputs by their index in the response. Each request keeps the retry behavior of
+    get_emb(); if a batch still fails it is split in half and each half is tried again.
+
+    If cache is provided, only inputs missing from cache are sent, and their embeddings are added to cache as each
+    batch completes.
+    """
+    embs: list[Optional[list[float]]] = [None] * len(xs)
+    if cache is not None:
+        for i, cached in enumerate(cache.get_many(xs)):
+            if cached is not None:
+                embs[i] = cached.tolist()
+        n_cached = sum(emb is not None for emb in embs)
+        print(f"INFO - Found {n_cached} of {len(xs)} embeddings in cache")
+    to_get = [i for i, emb in enumerate(embs) if emb is None]
     tokens = 0
-    for x in xs:
-        resp = get_emb(x)
-        emb = resp["data"][0]["embedding"]
-        embs.append(emb)
-        tokens += resp["usage"]["total_tokens"]
-    print(f"INFO - Got {len(embs)} embeddings, total token usage {tokens}")
+    for local_batch in batch_by_tokens([xs[i] for i in to_get], batch_size, max_batch_tokens):
+        batch = [to_get[j] for j in local_batch]
+        tokens += _get_batch_embs(xs, batch, embs)
+        if cache is not None:
+            cache.put_many([xs[i] for i in batch], [embs[i] for i in batch])
+    print(f"INFO - Got {len(to_get)} embeddings, total token usage {tokens}")
     return embs
 
 
+def _get_batch_embs(xs: list[str], batch: list[int], embs: list[Optional[list[float]]]) -> int:
+    """Fill embs at the indices in batch, splitting the batch on failure. Returns total token usage."""
+    try:
+        resp = get_emb([xs[i] for i in batch])
+    except RetryError:
+        if len(batch) == 1:
+            raise
+        print(f"WARNING - batch of {len(batch)} embeddings failed, retrying as two halves")
+        mid = len(batch) // 2
+        return _get_batch_embs(xs, batch[:mid], embs) + _get_batch_embs(xs, batch[mid:], embs)
+    for item in resp["data"]:
+        embs[batch[item["index"]]] = item["embedding"]
+    return resp["usage"]["total_tokens"]
+
+
 def format_prompt(word: str, definition: str) -> str:
     """Format a prompt for fine-tuning following recommended practices
 
@@ -55,8 +118,87 @@ def format_completion(text: str, translation: str, cloze: str) -> str:
     ----------
     https://platform.openai.com/docs/guides/fine-tuning/preparing-your-dataset
     """
+    return next(format_completions([(text, translation, cloze)]))
+
+
+def format_completions(rows: Iterable[tuple[str, str, str]]) -> Iterator[str]:
+    """Format completions of many (text, translation, cloze) rows as format_completion does
+
+    Rows are written in batches by one CSV writer, with a record separator character as line terminator to split the
+    batch back into rows. A batch with that character inside a field is written again row by row.
+    """
+    rows = iter(rows)
     with StringIO() as buf:
-        writer = csv.writer(buf, quoting=csv.QUOTE_ALL, quotechar=QUOTECHAR, doublequote=False, escapechar="\\")
-        writer.writerow([text, translation, cloze])
-        csv_str = buf.getvalue().strip()
-    return " " + csv_str + END_STR
+        writer = csv.writer(
+            buf,
+            quoting=csv.QUOTE_ALL,
+            quotechar=QUOTECHAR,
+            doublequote=False,
+            escapechar="\\",
+            lineterminator=RECORD_SEPARATOR,
+        )
+        while batch := list(islice(rows, COMPLETION_BATCH_ROWS)):
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows(batch)
+            lines = buf.getvalue().split(RECORD_SEPARATOR)[:-1]
+            if len(lines) != len(batch):
+                lines = []
+                for row in batch:
+                    buf.seek(0)
+                    buf.truncate()
+                    writer.writerow(row)
+                    lines.append(buf.getvalue()[: -len(RECORD_SEPARATOR)])
+            for line in lines:
+                yield " " + line.strip() + END_STR
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of text without running a tokenizer
+
+    Uses the rule of thumb of about CHARS_PER_TOKEN characters per token. Always at least 1.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_request_tokens(params: dict) -> int:
+    """Rough token count that a completion, chat or embedding request counts against a tokens-per-minute budget
+
+    Counts the prompt(s), message contents or input(s), plus max_tokens for each completion requested.
+    """
+    texts = []
+    for key in ["prompt", "input"]:
+        value = params.get(key, [])
+        texts.extend([value] if isinstance(value, str) else value)
+    texts.extend(message["content"] for message in params.get("messages", []))
+    n_completions = len(params["prompt"]) if isinstance(params.get("prompt"), list) else 1
+    completion_tokens = params.get("max_tokens", 0) * n_completions if "input" not in params else 0
+    return sum(estimate_tokens(text) for text in texts) + completion_tokens
+
+
+def get_total_tokens(response) -> Optional[int]:
+    """Get total_tokens from response usage, or None if there is no response"""
+    if response is None:
+        return None
+    return response["usage"]["total_tokens"]
+
+
+def batch_by_tokens(texts: list[str], batch_size: int, max_tokens: int) -> Iterator[list[int]]:
+    """Group consecutive texts into batches, yielding the indices of each batch
+
+    A batch is closed once it holds batch_size texts or adding the next text would exceed max_tokens estimated
+    tokens. A single text over max_tokens is still yielded, as a batch of its own.
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+    batch: list[int] = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) == batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
@@ -1,9 +1,120 @@
 """conftest.py Shared test fixtures
 """
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import openai
 import pytest
 from openai.openai_object import OpenAIObject
 
+FAKE_OPENAI_LATENCY = 0.2
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the OpenAI chat and completion endpoints
+
+    Sleeps for server.latency seconds before echoing the input back, so tests can check concurrency.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests_served += 1
+        time.sleep(self.server.latency)
+        if self.path.endswith("/chat/completions"):
+            content = body["messages"][-1]["content"]
+            choices = [{"index": 0, "message": {"role": "assistant", "content": f"echo {content}"}}]
+        else:
+            prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+            choices = [{"index": i, "text": f" echo {prompt.split()[0]}"} for i, prompt in enumerate(prompts)]
+        response = {
+            "object": "chat.completion",
+            "model": body["model"],
+            "choices": choices,
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }
+        payload = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDWHandler(BaseHTTPRequestHandler):
+    """Serves server.pages (path -> html) and counts requests per path
+
+    Responds 503 to the first request of each path in server.fail_once, so tests can check retries. Pages have an
+    ETag, and a request with a matching If-None-Match gets a 304 without body. Statuses sent are in server.statuses.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+            fail = self.path in self.server.fail_once and self.server.requests[self.path] == 1
+        time.sleep(self.server.latency)
+        html_str = self.server.pages.get(self.path)
+        etag = f'"{hashlib.sha1(html_str.encode("utf-8")).hexdigest()}"' if html_str is not None else None
+        if fail:
+            status = 503
+        elif html_str is None:
+            status = 404
+        elif etag == self.headers.get("If-None-Match"):
+            status = 304
+        else:
+            status = 200
+        payload = (html_str or "").encode("utf-8") if status != 304 else b""
+        with self.server.lock:
+            self.server.statuses.append((self.path, status))
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_dw_server():
+    """Serve FakeDWHandler on localhost. Set server.pages before making requests to server.url."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDWHandler)
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    server.pages = {}
+    server.fail_once = set()
+    server.requests = {}
+    server.statuses = []
+    server.latency = 0.0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_openai_server(monkeypatch):
+    """Serve FakeOpenAIHandler on localhost and point openai at it"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    server.latency = FAKE_OPENAI_LATENCY
+    server.requests_served = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai, "api_base", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(openai, "api_key", "sk-fake")
+    yield server
+    server.shutdown()
+    server.server_close()
+
 
 @pytest.fixture
 def embedding_vals():
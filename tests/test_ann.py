@@ -0,0 +1,61 @@
+"""test_ann.py Unit testing of ann.py"""
+import numpy as np
+import pytest
+
+from clozify_llm.ann import IVFIndex, count_recall_misses
+from clozify_llm.similarity import top_k_cosine
+
+
+@pytest.fixture
+def clustered_embs() -> tuple[np.ndarray, np.ndarray]:
+    """Candidate embeddings around a few cluster centres, and noisy copies of some of them as queries"""
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(8, 16))
+    Y = centres[rng.integers(8, size=400)] + 0.3 * rng.normal(size=(400, 16))
+    X = Y[rng.integers(400, size=100)] + 0.05 * rng.normal(size=(100, 16))
+    return X, Y
+
+
+def test_ivf_index_all_lists_is_exact(clustered_embs):
+    """Test probing every list gives the same result as exact search"""
+    X, Y = clustered_embs
+    index = IVFIndex.build(Y, n_lists=10)
+
+    indices, scores = index.search(X, k=3, n_probe=index.n_lists)
+    exact_indices, exact_scores = top_k_cosine(X, Y, k=3)
+
+    np.testing.assert_array_equal(indices, exact_indices)
+    np.testing.assert_allclose(scores, exact_scores, rtol=1e-5)
+
+
+def test_ivf_index_save_load(clustered_embs, tmp_path):
+    """Test saved index loads with memory-mapped vectors and searches the same"""
+    X, Y = clustered_embs
+    index = IVFIndex.build(Y, n_lists=10, vocab_fingerprint="abc")
+    index.save(tmp_path / "vocab.index")
+
+    loaded = IVFIndex.load(tmp_path / "vocab.index")
+
+    assert isinstance(loaded.vectors, np.memmap)
+    assert len(loaded) == len(Y)
+    assert loaded.vocab_fingerprint == "abc"
+    np.testing.assert_array_equal(loaded.search(X, n_probe=2)[0], index.search(X, n_probe=2)[0])
+
+
+def test_count_recall_misses(clustered_embs):
+    """Test recall check finds no misses with a full probe and at most as many with more probes"""
+    X, Y = clustered_embs
+    index = IVFIndex.build(Y, n_lists=20)
+
+    assert count_recall_misses(index, X, Y, n_probe=index.n_lists) == 0
+    assert count_recall_misses(index, X, Y, n_probe=4) <= count_recall_misses(index, X, Y, n_probe=1)
+
+
+def test_ivf_index_fewer_candidates_than_k():
+    """Test missing candidates are padded with -1 and -inf"""
+    index = IVFIndex.build(np.eye(2), n_lists=2)
+
+    indices, scores = index.search(np.array([[1.0, 0.0]]), k=2, n_probe=1)
+
+    assert indices.tolist() == [[0, -1]]
+    assert scores[0, 1] == -np.inf
@@ -0,0 +1,116 @@
+"""test_batch.py Unit testing of batch.py"""
+import json
+from unittest.mock import patch
+
+import pytest
+
+from clozify_llm.batch import (
+    BatchRunner,
+    export_results,
+    make_request,
+    read_jsonl,
+    read_results,
+    request_models,
+    write_requests,
+)
+from clozify_llm.predict import ChatCompleter, Completer
+from clozify_llm.utils import format_prompt
+
+
+@pytest.fixture
+def requests_path(tmp_path) -> str:
+    path = str(tmp_path / "requests.jsonl")
+    write_requests(ChatCompleter(), [("eins", ""), ("zwei", ""), ("drei", "")], path)
+    return path
+
+
+@pytest.fixture
+def results_path(tmp_path) -> str:
+    return str(tmp_path / "results.jsonl")
+
+
+def test_make_request_reuses_completer_params():
+    chat_request = make_request(ChatCompleter(model_id="my_chat_model"), "Wort", "")
+    completion_request = make_request(Completer("my_model_id"), "Wort", "defn")
+
+    assert chat_request["params"] == ChatCompleter(model_id="my_chat_model")._make_chat_params(input_word="Wort")
+    assert chat_request["endpoint"] == "chat"
+    assert completion_request["params"]["prompt"] == format_prompt("Wort", "defn")
+    assert completion_request["endpoint"] == "completion"
+    assert chat_request["id"] != completion_request["id"]
+
+
+def test_write_requests(requests_path):
+    requests = list(read_jsonl(requests_path))
+    assert [request["word"] for request in requests] == ["eins", "zwei", "drei"]
+
+
+def test_read_jsonl_malformed_line(requests_path):
+    """Test a malformed line is skipped by default, as a truncated results line, but raises if strict"""
+    with open(requests_path, "r+", encoding="utf-8") as f:
+        lines = f.readlines()
+        f.seek(0)
+        f.writelines([lines[0], lines[1][:10] + "\n", lines[2]])
+        f.truncate()
+
+    assert [request["word"] for request in read_jsonl(requests_path)] == ["eins", "drei"]
+    with pytest.raises(ValueError, match="line 2"):
+        list(read_jsonl(requests_path, strict=True))
+    with pytest.raises(ValueError, match="line 2"):
+        BatchRunner(requests_path, requests_path + ".results").run()
+
+
+def test_request_models(requests_path, tmp_path):
+    assert request_models(requests_path) == {ChatCompleter().model_id}
+    assert request_models(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_batch_runner_run_and_export(requests_path, results_path, fake_openai_server):
+    counts = BatchRunner(requests_path, results_path, concurrency=3).run()
+
+    assert counts == {"ok": 3, "error": 0, "skipped": 0}
+    assert list(export_results(requests_path, results_path)) == [
+        "echo Input: eins",
+        "echo Input: zwei",
+        "echo Input: drei",
+    ]
+    assert all(result["attempts"] == 1 for result in read_jsonl(results_path))
+
+
+def test_batch_runner_resumes_after_crash(requests_path, results_path, fake_openai_server):
+    """Requests already in results are skipped, and a truncated last line does not break the results file"""
+    first_request = next(read_jsonl(requests_path))
+    done = {"id": first_request["id"], "word": "eins", "attempts": 1, "status": "ok", "text": "earlier eins"}
+    with open(results_path, "w") as f:
+        f.write(json.dumps(done) + "\n" + '{"id": "trunc')
+
+    counts = BatchRunner(requests_path, results_path, concurrency=2).run()
+
+    assert counts == {"ok": 2, "error": 0, "skipped": 1}
+    assert fake_openai_server.requests_served == 2
+    assert list(export_results(requests_path, results_path)) == ["earlier eins", "echo Input: zwei", "echo Input: drei"]
+
+
+def test_batch_runner_records_errors(requests_path, results_path, chat_completion_response):
+    """Failed requests are recorded with attempt counts and retried on later runs up to max_attempts"""
+    calls = []
+
+    async def flaky_acreate(self, **params):
+        word = params["messages"][-1]["content"]
+        calls.append(word)
+        if word == "Input: zwei":
+            raise RuntimeError("server error")
+        return chat_completion_response
+
+    with patch.object(ChatCompleter, "acreate", flaky_acreate):
+        first = BatchRunner(requests_path, results_path, max_attempts=2).run()
+        second = BatchRunner(requests_path, results_path, max_attempts=2).run()
+        third = BatchRunner(requests_path, results_path, max_attempts=2).run()
+
+    assert first == {"ok": 2, "error": 1, "skipped": 0}
+    assert second == {"ok": 0, "error": 1, "skipped": 2}
+    assert third == {"ok": 0, "error": 0, "skipped": 3}
+    assert calls.count("Input: zwei") == 2
+    failed = [result for result in read_results(results_path).values() if result["status"] == "error"]
+    assert failed[0]["attempts"] == 2
+    assert failed[0]["error"] == "RuntimeError: server error"
@@ -1,15 +1,21 @@
 """Test cli.py"""
 
+import json
+import subprocess
+import sys
 from ast import literal_eval
 from pathlib import Path
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
 import pytest
 from click.testing import CliRunner
 from pandas.testing import assert_frame_equal
 
 from clozify_llm.cli import (
+    batch,
+    cache_group,
     chat,
     cli,
     complete,
@@ -18,9 +24,39 @@ from clozify_llm.cli import (
     finetune,
     fix,
     get_help_recursive,
+    index_build,
+    iter_cloze_texts,
     match,
     parse,
+    parse_lessons,
+    reduce_group,
 )
+from clozify_llm.constants import CLOZE_COL, DEFAULT_CHAT_MODEL, DEFN_COL, WORD_COL
+from clozify_llm.predict import ResponseCache
+from clozify_llm.similarity import normalize_rows
+
+# Modules that only commands using them may import, to keep startup fast
+HEAVY_MODULES = ("numpy", "pandas", "sklearn", "scipy", "openai", "lxml", "requests")
+# Cumulative import time budget of the CLI module in microseconds, generous to allow for slow machines
+CLI_IMPORT_BUDGET_US = 300_000
+
+
+def import_times(code: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of each module imported when running code, from python -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:"):
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def imported_packages(times: dict[str, int]) -> set[str]:
+    return {name.split(".")[0] for name in times}
 
 
 @pytest.fixture
@@ -28,7 +64,7 @@ def runner():
     return CliRunner()
 
 
-@patch("clozify_llm.cli.ChatCompleter")
+@patch("clozify_llm.predict.ChatCompleter")
 @patch("clozify_llm.cli.getpass")
 def test_chat_from_word(mock_getpass, mock_completer, runner, tmp_path):
     """Test cli.chat with word input and output written to tmp file location
@@ -36,7 +72,7 @@ def test_chat_from_word(mock_getpass, mock_completer, runner, tmp_path):
     Mock return of completer call.
     """
     mock_completer_instance = mock_completer.return_value
-    mock_completer_instance.get_cloze_text.return_value = "my completion"
+    mock_completer_instance.get_cloze_texts.return_value = ["my completion"]
 
     with runner.isolated_filesystem(temp_dir=tmp_path) as td:
         output_loc = f"{td}/output.csv"
@@ -47,10 +83,81 @@ def test_chat_from_word(mock_getpass, mock_completer, runner, tmp_path):
     assert result.output == f"wrote 1 responses to {output_loc}\n"
     assert result_contents == "my completion\n"
 
-    mock_completer_instance.get_cloze_text.assert_called_once()
+    mock_completer_instance.get_cloze_texts.assert_called_once_with(["Wort"], [""])
+
+
+@patch("clozify_llm.cli.getpass", return_value="sk-fake")
+def test_chat_concurrency_from_file(mock_getpass, runner, fake_openai_server, tmp_path):
+    """Test cli.chat with --concurrency against local fake endpoint, output in input order"""
+    words = ["eins", "zwei", "drei", "vier"]
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        input_loc = Path(td) / "vocab.txt"
+        input_loc.write_text("\n".join(words))
+        output_loc = f"{td}/output.csv"
+        result = runner.invoke(chat, ["-f", str(input_loc), "--concurrency", "4", "--output", output_loc])
+        result_contents = Path(output_loc).read_text()
+
+    assert result.exit_code == 0
+    assert result_contents == "".join(f"echo Input: {word}\n" for word in words)
+
+
+@patch("clozify_llm.cli.getpass", return_value="sk-fake")
+def test_chat_stdin_stdout(mock_getpass, runner, fake_openai_server):
+    """Test cli.chat reading from stdin and writing to stdout"""
+    result = runner.invoke(chat, ["-f", "-", "-c", "2"], input="eins\nzwei\ndrei\n")
+
+    assert result.exit_code == 0
+    assert result.stdout == "echo Input: eins\necho Input: zwei\necho Input: drei\n"
+    assert result.stderr.endswith("wrote 3 responses to -\n")
+
+
+class RecordingCompleter:
+    """Completer stand-in that records how many inputs were consumed when each output is produced"""
+
+    def __init__(self):
+        self.consumed = 0
+
+    def inputs(self, n):
+        for i in range(n):
+            self.consumed += 1
+            yield f"word{i}", ""
 
+    def get_cloze_texts(self, words, defns):
+        return [f"cloze {word}" for word in words]
 
-@patch("clozify_llm.cli.get_all_vocab_from_course_request")
+    async def aget_cloze_texts(self, words, defns):
+        return self.get_cloze_texts(words, defns)
+
+
+@pytest.mark.parametrize("concurrency,chunk_size", ((1, 1), (1, 3), (2, 1), (4, 2)))
+def test_iter_cloze_texts_lazy_and_ordered(concurrency, chunk_size):
+    """Test iter_cloze_texts only reads inputs as needed and yields outputs in input order"""
+    completer = RecordingCompleter()
+    cloze_texts = iter_cloze_texts(completer, completer.inputs(10), concurrency, chunk_size)
+
+    first = next(cloze_texts)
+
+    assert first == "cloze word0"
+    assert completer.consumed <= concurrency * chunk_size
+    assert list(cloze_texts) == [f"cloze word{i}" for i in range(1, 10)]
+
+
+@patch("clozify_llm.cli.DEFAULT_CSV_CHUNK_SIZE", 2)
+@patch("clozify_llm.cli.getpass", return_value="sk-fake")
+def test_complete_stdin_chunked(mock_getpass, runner, fake_openai_server):
+    """Test cli.complete reading CSV from stdin in chunks"""
+    words = [f"wort{i}" for i in range(5)]
+    csv_input = pd.DataFrame({"word": words, "defn": ["defn"] * len(words)}).to_csv(index=False)
+
+    result = runner.invoke(complete, ["-f", "-", "-m", "my-model", "-b", "3"], input=csv_input)
+
+    assert result.exit_code == 0
+    assert result.stdout == "".join(f"echo {word}\n" for word in words)
+    assert result.stderr.endswith("wrote 5 to -\n")
+    assert fake_openai_server.requests_served == 2
+
+
+@patch("clozify_llm.extract.extract_wortschatz.get_all_vocab_from_course_request")
 def test_fetch(mock_get_all_vocab, runner, tmp_path):
     """Test cli.fetch with mocked get_all_vocab call and output written to tmp file
 
@@ -71,31 +178,83 @@ def test_fetch(mock_get_all_vocab, runner, tmp_path):
     mock_get_all_vocab.assert_called_once()
 
 
-@patch("clozify_llm.cli.extract_cloze")
-def test_parse(mock_extract_cloze, runner, tmp_path):
-    """Test cli.parse with mocked extract_cloze call and output written to tmp file
+@patch("clozify_llm.extract.extract_wortschatz.get_all_vocab_from_course_request")
+def test_fetch_many_courses(mock_get_all_vocab, runner, tmp_path):
+    """Test cli.fetch passes all course URLs and fetch settings in one call"""
+    mock_get_all_vocab.return_value = pd.DataFrame({"word": ["apple"]})
 
-    Input file location is created with dummy data but does not correspond to output
-    """
-    dummy_data = "[{}]"
-    df = pd.DataFrame({"cloze": ["Wort"], "collection": ["my-collection"]})
-    mock_extract_cloze.return_value = df
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        args = ["course1.com", "course2.com", "--output", f"{td}/out.csv", "--staging", f"{td}/html", "-c", "2"]
+        result = runner.invoke(fetch, args + ["--timeout", "5"])
+
+    assert result.exit_code == 0
+    mock_get_all_vocab.assert_called_once_with(
+        ["course1.com", "course2.com"], f"{td}/html", concurrency=2, timeout=5, max_age=None
+    )
+
+
+@pytest.mark.parametrize("args,max_age", ((["--refresh"], 0), (["--max-age-days", "2"], 2 * 24 * 3600)))
+@patch("clozify_llm.extract.extract_wortschatz.get_all_vocab_from_course_request")
+def test_fetch_refresh(mock_get_all_vocab, args, max_age, runner, tmp_path):
+    """Test cli.fetch revalidation options set the max age of staged lessons"""
+    mock_get_all_vocab.return_value = pd.DataFrame({"word": ["apple"]})
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        result = runner.invoke(fetch, ["course1.com", "--output", f"{td}/out.csv"] + args)
+
+    assert result.exit_code == 0
+    assert mock_get_all_vocab.call_args.kwargs["max_age"] == max_age
+
+
+@patch("clozify_llm.extract.extract_wortschatz.words_from_staging_dir")
+def test_parse_lessons(mock_words_from_staging_dir, runner, tmp_path):
+    """Test cli.parse_lessons with mocked extraction from staging dir"""
+    df = pd.DataFrame({"word": ["apple"], "defn": ["fruit"]})
+    mock_words_from_staging_dir.return_value = df
+    output_loc = tmp_path / "wortschatz.csv"
+
+    result = runner.invoke(parse_lessons, [str(tmp_path), "--output", str(output_loc), "--workers", "3"])
+
+    assert result.exit_code == 0
+    assert_frame_equal(pd.read_csv(output_loc), df)
+    mock_words_from_staging_dir.assert_called_once_with(str(tmp_path), n_workers=3)
+
+
+@pytest.mark.parametrize("chunk_rows", (1, 2, 1000))
+def test_parse(chunk_rows, runner, tmp_path):
+    """Test cli.parse streams pages from json and writes clozes in chunks to tmp file"""
+    pages = [
+        {
+            "collectionClozeSentences": [{"text": "Ein {{Wort}}.", "translation": "A word."}],
+            "collection": {"name": "a"},
+        },
+        {
+            "collectionClozeSentences": [{"text": "Zwei {{Wörter}}.", "translation": "Two."}],
+            "collection": {"name": "b"},
+        },
+        {"collectionClozeSentences": [{"text": "Kein Wort.", "translation": "No word."}], "collection": {"name": "b"}},
+    ]
+    expected = pd.DataFrame(
+        {
+            "text": ["Ein {{Wort}}.", "Zwei {{Wörter}}.", "Kein Wort."],
+            "translation": ["A word.", "Two.", "No word."],
+            "collection": ["a", "b", "b"],
+            "cloze": ["Wort", "Wörter", np.nan],
+        }
+    )
 
     with runner.isolated_filesystem(temp_dir=tmp_path) as td:
         input_path = Path(td) / "input.json"
-        input_path.write_text(dummy_data)
+        input_path.write_text(json.dumps(pages))
         output_loc = f"{td}/output.csv"
-        result = runner.invoke(parse, [str(input_path), "--output", output_loc])
+        result = runner.invoke(parse, [str(input_path), "--output", output_loc, "--chunk-rows", str(chunk_rows)])
         result_contents = pd.read_csv(output_loc)
 
     assert result.exit_code == 0
-    assert result.output == f"wrote {len(df)} to {output_loc}\n"
-    assert_frame_equal(result_contents, df)
+    assert result.output == f"wrote 3 to {output_loc}\n"
+    assert_frame_equal(result_contents, expected)
 
-    mock_extract_cloze.assert_called_once()
 
-
-@patch("clozify_llm.cli.add_emb")
+@patch("clozify_llm.embed.add_emb")
 @patch("clozify_llm.cli.getpass")
 def test_embed(mock_getpass, mock_add_emb, runner, tmp_path):
     """Test cli.embed with mocked add_emb call and output written to tmp file
@@ -128,7 +287,270 @@ def test_embed(mock_getpass, mock_add_emb, runner, tmp_path):
     mock_add_emb.assert_called_once()
 
 
-@patch("clozify_llm.cli.Joiner")
+@pytest.mark.parametrize("quantize", (False, True))
+@patch("clozify_llm.embed.get_embs")
+@patch("clozify_llm.cli.getpass")
+def test_embed_npy_then_match(mock_getpass, mock_get_embs, quantize, runner, tmp_path):
+    """Test embed --format npy (optionally --int8) writes sidecars that match picks up in place of embedding columns"""
+
+    def fake_get_embs(texts, cache=None):
+        return [[1.0, 0.0], [0.0, 1.0]] if texts[0] == "c0" else [[0.0, 1.0], [1.0, 0.0]]
+
+    mock_get_embs.side_effect = fake_get_embs
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"cloze": ["c0", "c1"]}).to_csv(f"{td}/cloze.csv", index=False)
+        pd.DataFrame({"word": ["w0", "w1"], "defn": ["d0", "d1"]}).to_csv(f"{td}/vocab.csv", index=False)
+        for name in ("cloze", "vocab"):
+            args = [f"{td}/{name}.csv", "--output", td, "--format", "npy"] + (["--int8"] if quantize else [])
+            result = runner.invoke(embed, args)
+            assert result.exit_code == 0
+        assert Path(f"{td}/vocab-embeds.word_embedding.scales.npy").exists() == quantize
+        assert list(pd.read_csv(f"{td}/cloze-embeds.csv").columns) == ["cloze"]
+        assert Path(f"{td}/cloze-embeds.cloze_embedding.npy").exists()
+
+        output_loc = f"{td}/output.csv"
+        result = runner.invoke(match, [f"{td}/cloze-embeds.csv", f"{td}/vocab-embeds.csv", "--output", output_loc])
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert result_contents["word"].tolist() == ["w1", "w0"]
+
+
+@patch("clozify_llm.embed.get_embs")
+@patch("clozify_llm.cli.getpass")
+def test_embed_csv_after_npy_then_match(mock_getpass, mock_get_embs, runner, tmp_path):
+    """Test re-running embed in csv format removes the npy sidecar, so match reads the fresh embedding column"""
+    mock_get_embs.side_effect = [[[1.0, 0.0], [0.0, 1.0]], [[1.0, 0.0], [0.0, 1.0]], [[0.0, 1.0], [1.0, 0.0]]]
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"cloze": ["c0", "c1"]}).to_csv(f"{td}/cloze.csv", index=False)
+        pd.DataFrame({"word": ["w0", "w1"], "defn": ["d0", "d1"]}).to_csv(f"{td}/vocab.csv", index=False)
+        for name, emb_format in (("cloze", "npy"), ("vocab", "csv"), ("cloze", "csv")):
+            result = runner.invoke(embed, [f"{td}/{name}.csv", "--output", td, "--format", emb_format])
+            assert result.exit_code == 0
+        assert not Path(f"{td}/cloze-embeds.cloze_embedding.npy").exists()
+
+        output_loc = f"{td}/output.csv"
+        result = runner.invoke(match, [f"{td}/cloze-embeds.csv", f"{td}/vocab-embeds.csv", "--output", output_loc])
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert result_contents["word"].tolist() == ["w1", "w0"]
+
+
+def test_index_build_then_match(runner, tmp_path):
+    """Test prep index build and prep match --index with recall check"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"cloze": ["c0", "c1"], "cloze_embedding": ["[1, 0.1]", "[0.1, 1]"]}).to_csv(
+            f"{td}/cloze.csv", index=False
+        )
+        pd.DataFrame({"word": ["w0", "w1"], "word_embedding": ["[0, 1]", "[1, 0]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        result = runner.invoke(index_build, [f"{td}/vocab.csv", f"{td}/vocab.index", "--n-lists", "2"])
+        assert result.exit_code == 0
+        assert result.output == f"wrote index of 2 vectors in 2 lists to {td}/vocab.index\n"
+
+        output_loc = f"{td}/output.csv"
+        args = [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", output_loc, "--index", f"{td}/vocab.index"]
+        result = runner.invoke(match, args + ["--n-probe", "2", "--check-recall"])
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert result.output.endswith("0 of 2 index matches differ from exact matching\n")
+    assert result_contents["word"].tolist() == ["w1", "w0"]
+
+
+def test_match_index_skips_vocab_embeddings(runner, tmp_path):
+    """Test prep match --index without --check-recall does not load the vocab embedding sidecar"""
+    from clozify_llm.embed import load_emb_sidecar
+
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"cloze": ["c0", "c1"], "cloze_embedding": ["[1, 0.1]", "[0.1, 1]"]}).to_csv(
+            f"{td}/cloze.csv", index=False
+        )
+        pd.DataFrame({"word": ["w0", "w1"]}).to_csv(f"{td}/vocab.csv", index=False)
+        np.save(f"{td}/vocab.word_embedding.npy", np.array([[0, 1], [1, 0]], dtype=np.float32))
+        runner.invoke(index_build, [f"{td}/vocab.csv", f"{td}/vocab.index", "--n-lists", "2"])
+
+        output_loc = f"{td}/output.csv"
+        args = [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", output_loc, "--index", f"{td}/vocab.index"]
+        with patch("clozify_llm.embed.load_emb_sidecar", wraps=load_emb_sidecar) as mock_load_emb_sidecar:
+            result = runner.invoke(match, args + ["--n-probe", "2"])
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert [call.args[1] for call in mock_load_emb_sidecar.call_args_list] == ["cloze_embedding"]
+    assert result_contents["word"].tolist() == ["w1", "w0"]
+
+
+def test_match_index_rejects_changed_vocab(runner, tmp_path):
+    """Test prep match --index refuses a vocab whose rows changed since the index was built, even at equal length"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"cloze": ["c0"], "cloze_embedding": ["[1, 0.1]"]}).to_csv(f"{td}/cloze.csv", index=False)
+        df_vocab = pd.DataFrame({"word": ["w0", "w1"], "word_embedding": ["[0, 1]", "[1, 0]"]})
+        df_vocab.to_csv(f"{td}/vocab.csv", index=False)
+        runner.invoke(index_build, [f"{td}/vocab.csv", f"{td}/vocab.index", "--n-lists", "2"])
+        df_vocab[::-1].to_csv(f"{td}/vocab.csv", index=False)
+
+        args = [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", f"{td}/output.csv", "--index", f"{td}/vocab.index"]
+        result = runner.invoke(match, args)
+
+    assert result.exit_code == 2
+    assert "rebuild the index" in result.output
+
+
+def test_reduce_fit_apply_then_match(runner, tmp_path):
+    """Test prep reduce fit/apply writes reduced sidecars that match uses, refusing mixed projections"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"cloze": ["c0", "c1"], "cloze_embedding": ["[1, 0.1, 0]", "[0.1, 1, 0]"]}).to_csv(
+            f"{td}/cloze.csv", index=False
+        )
+        pd.DataFrame({"word": ["w0", "w1"], "word_embedding": ["[0, 1, 0.1]", "[1, 0, 0.1]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        result = runner.invoke(reduce_group, ["fit", f"{td}/vocab.csv", f"{td}/proj.npz", "--dims", "2"])
+        assert result.output == f"wrote pca projection from 3 to 2 dims to {td}/proj.npz\n"
+        result = runner.invoke(reduce_group, ["apply", f"{td}/proj.npz", f"{td}/cloze.csv", f"{td}/vocab.csv"])
+        assert result.exit_code == 0
+        assert Path("output/vocab-reduced.word_embedding.npy").exists()
+        assert list(pd.read_csv("output/cloze-reduced.csv").columns) == ["cloze"]
+
+        result = runner.invoke(match, ["output/cloze-reduced.csv", "output/vocab-reduced.csv", "--output", "out.csv"])
+        result_contents = pd.read_csv("out.csv")
+        mixed = runner.invoke(match, [f"{td}/cloze.csv", "output/vocab-reduced.csv", "--output", "mixed.csv"])
+        report = runner.invoke(reduce_group, ["report", f"{td}/cloze.csv", f"{td}/vocab.csv", "--dims", "2"])
+
+    assert result.exit_code == 0
+    assert result_contents["word"].tolist() == ["w1", "w0"]
+    assert mixed.exit_code != 0
+    assert "were not reduced the same way" in mixed.output
+    assert report.exit_code == 0
+    assert report.output.splitlines()[0].split() == [
+        "n_dims",
+        "changed",
+        "changed_pct",
+        "match_seconds",
+        "bytes_per_row",
+    ]
+
+
+def test_match_previous(runner, tmp_path):
+    """Test prep match --previous reuses saved matches and only scores new clozes"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"word": ["w0", "w1"], "word_embedding": ["[0, 1]", "[1, 0]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        pd.DataFrame({"cloze": ["c0"], "cloze_embedding": ["[1, 0.1]"]}).to_csv(f"{td}/cloze.csv", index=False)
+        result = runner.invoke(match, [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", f"{td}/first.csv"])
+        assert result.exit_code == 0
+        assert Path(f"{td}/first.match.npz").exists()
+
+        pd.DataFrame({"cloze": ["c0", "c1"], "cloze_embedding": ["[1, 0.1]", "[0.1, 1]"]}).to_csv(
+            f"{td}/cloze.csv", index=False
+        )
+        args = [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", f"{td}/second.csv", "--previous", f"{td}/first.csv"]
+        result = runner.invoke(match, args)
+        result_contents = pd.read_csv(f"{td}/second.csv")
+
+    assert result.exit_code == 0
+    assert result.output.endswith("scored 1 new or changed of 2 clozes against all vocab\n")
+    assert result_contents["word"].tolist() == ["w1", "w0"]
+
+
+@patch("clozify_llm.similarity.normalize_rows", wraps=normalize_rows)
+def test_match_many_cloze_files(mock_normalize_rows, runner, tmp_path):
+    """Test prep match with a glob of cloze files prepares vocab once and writes combined or per-file outputs"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"word": ["w0", "w1"], "word_embedding": ["[0, 1]", "[1, 0]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        Path(f"{td}/dumps").mkdir()
+        pd.DataFrame({"cloze": ["a0"], "cloze_embedding": ["[1, 0.1]"]}).to_csv(f"{td}/dumps/a.csv", index=False)
+        pd.DataFrame({"cloze": ["b0"], "cloze_embedding": ["[0.1, 1]"]}).to_csv(f"{td}/dumps/b.csv", index=False)
+
+        result = runner.invoke(match, [f"{td}/dumps/*.csv", f"{td}/vocab.csv", "--output", f"{td}/combined.csv"])
+        combined = pd.read_csv(f"{td}/combined.csv")
+        result_dir = runner.invoke(match, [f"{td}/dumps/*.csv", f"{td}/vocab.csv", "--output-dir", f"{td}/out"])
+        output_b = pd.read_csv(f"{td}/out/b-match.csv")
+
+    assert result.exit_code == 0
+    assert f"matched 1 clozes from {td}/dumps/a.csv in " in result.output
+    assert combined["word"].tolist() == ["w1", "w0"]
+    assert combined["cloze_file"].tolist() == [f"{td}/dumps/a.csv", f"{td}/dumps/b.csv"]
+    assert result_dir.exit_code == 0
+    assert output_b["word"].tolist() == ["w0"]
+    # Vocab (2 rows) normalized once per run, clozes (1 row each) once per file
+    normalized_lens = [len(call.args[0]) for call in mock_normalize_rows.call_args_list]
+    assert sorted(normalized_lens) == [1, 1, 1, 1, 2, 2]
+
+
+@patch("clozify_llm.embed.get_embs")
+@patch("clozify_llm.cli.getpass")
+def test_embed_lexical_vocab_then_match_lexical(mock_getpass, mock_get_embs, runner, tmp_path):
+    """Test clozes matched by word form are not embedded and are joined by prep match --lexical"""
+    mock_get_embs.return_value = [[0.1, 1.0]]
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"word": ["Ausrede, -n (f.)", "Wagen (m.)"], "word_embedding": ["[1, 0]", "[0, 1]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        pd.DataFrame({"cloze": ["Ausreden", "Auto"]}).to_csv(f"{td}/cloze.csv", index=False)
+        result = runner.invoke(
+            embed, [f"{td}/cloze.csv", "--output", td, "--format", "npy", "--lexical-vocab", f"{td}/vocab.csv"]
+        )
+        assert result.exit_code == 0
+        assert "skipping 1 clozes matched by word form" in result.output
+        mock_get_embs.assert_called_once_with(["Auto"], cache=None)
+
+        output_loc = f"{td}/output.csv"
+        result = runner.invoke(
+            match, [f"{td}/cloze-embeds.csv", f"{td}/vocab.csv", "--output", output_loc, "--lexical"]
+        )
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert result_contents["word"].tolist() == ["Ausrede, -n (f.)", "Wagen (m.)"]
+    assert result_contents["match_method"].tolist() == ["lexical", "embedding"]
+
+
+def test_match_local_backend_check_agreement(runner, tmp_path):
+    """Test prep match --backend local reports agreement with embedding match"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"word": ["Ausrede, -n (f.)", "Bank (f.)"], "word_embedding": ["[1, 0]", "[0, 1]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        pd.DataFrame({"cloze": ["Ausreden", "Banken"], "cloze_embedding": ["[1, 0.1]", "[1, 0.2]"]}).to_csv(
+            f"{td}/cloze.csv", index=False
+        )
+        output_loc = f"{td}/output.csv"
+        args = [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", output_loc, "--backend", "local", "--check-agreement"]
+        result = runner.invoke(match, args)
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert result.output.endswith("local backend agrees with embedding match on 1 of 2 clozes\n")
+    assert result_contents["word"].tolist() == ["Ausrede, -n (f.)", "Bank (f.)"]
+
+
+@patch("clozify_llm.emb_matrix.EmbeddingMatrix.from_column")
+def test_match_local_backend_skips_embeddings(mock_from_column, runner, tmp_path):
+    """Test prep match --backend local does not parse vocab embeddings it does not use"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        pd.DataFrame({"word": ["Ausrede, -n (f.)", "Bank (f.)"], "word_embedding": ["[1, 0]", "[0, 1]"]}).to_csv(
+            f"{td}/vocab.csv", index=False
+        )
+        pd.DataFrame({"cloze": ["Ausreden", "Banken"]}).to_csv(f"{td}/cloze.csv", index=False)
+        output_loc = f"{td}/output.csv"
+        result = runner.invoke(
+            match, [f"{td}/cloze.csv", f"{td}/vocab.csv", "--output", output_loc, "--backend", "local"]
+        )
+        result_contents = pd.read_csv(output_loc)
+
+    assert result.exit_code == 0
+    assert result_contents["word"].tolist() == ["Ausrede, -n (f.)", "Bank (f.)"]
+    mock_from_column.assert_not_called()
+
+
+@patch("clozify_llm.join.Joiner")
 def test_match(mock_joiner, runner, tmp_path):
     """Test cli.match with mocked Joiner and output written to tmp file"""
     df_cloze = pd.DataFrame({"cloze": ["Wort"]})
@@ -153,7 +575,7 @@ def test_match(mock_joiner, runner, tmp_path):
     mock_joiner_instance.join_emb_sim.assert_called_once()
 
 
-@patch("clozify_llm.cli.Joiner")
+@patch("clozify_llm.join.Joiner")
 def test_fix(mock_joiner, runner, tmp_path):
     """Test cli.fix with mocked Joiner and output written to tmp file"""
     df_join = pd.DataFrame({"word": ["Apfel"]})
@@ -177,18 +599,18 @@ def test_fix(mock_joiner, runner, tmp_path):
     mock_joiner_instance.clean_join_from_review.assert_called_once()
 
 
-@patch("clozify_llm.cli.FineTuner")
+@patch("clozify_llm.finetune.FineTuner")
 @patch("clozify_llm.cli.getpass")
 def test_finetune(mock_getpass, mock_finetuner, runner, finetune_create_response, tmp_path):
     """Test cli.finetune with mocked FineTuner and output written to tmp file location"""
-    mock_finetuner_instance = mock_finetuner.return_value
+    mock_finetuner_instance = mock_finetuner.from_csv.return_value
     mock_finetuner_instance.start_finetuning.return_value = finetune_create_response
 
     with runner.isolated_filesystem(temp_dir=tmp_path) as td:
         input_csv = f"{td}/input.csv"
         pd.DataFrame().to_csv(input_csv)
         output_loc = f"{td}/output.csv"
-        result = runner.invoke(finetune, [input_csv, output_loc])
+        result = runner.invoke(finetune, [input_csv, output_loc, "--ledger", f"{td}/uploads.sqlite3"])
 
     assert result.exit_code == 0
     assert result.output == f"FineTune job created\n{finetune_create_response}\n"
@@ -196,13 +618,34 @@ def test_finetune(mock_getpass, mock_finetuner, runner, finetune_create_response
     mock_finetuner_instance.start_finetuning.assert_called_once()
 
 
-@patch("clozify_llm.cli.Completer")
+@patch("clozify_llm.finetune.openai.File")
+def test_finetune_dry_run(mock_file, runner, tmp_path):
+    """Test cli.finetune --dry-run writes deduplicated training data and estimates cost without uploading"""
+    input_csv = tmp_path / "training.csv"
+    df = pd.DataFrame(
+        {WORD_COL: ["Wort"] * 2, DEFN_COL: ["word"] * 2, "text": ["Das Wort"] * 2, "translation": ["The word"] * 2}
+    )
+    df.assign(**{CLOZE_COL: "Wort"}).to_csv(input_csv, index=False)
+    output_loc = tmp_path / "training.jsonl"
+    ledger_path = tmp_path / "uploads.sqlite3"
+
+    result = runner.invoke(finetune, [str(input_csv), str(output_loc), "--dry-run", "--ledger", str(ledger_path)])
+
+    assert result.exit_code == 0
+    assert not ledger_path.exists()
+    assert "1 examples (1 duplicates dropped)" in result.output
+    assert "estimated cost $" in result.output
+    assert len(output_loc.read_text().splitlines()) == 1
+    mock_file.create.assert_not_called()
+
+
+@patch("clozify_llm.predict.Completer")
 @patch("clozify_llm.cli.getpass")
 def test_complete_from_word_defn(mock_getpass, mock_completer, runner, tmp_path):
     """Test cli.complete with word and defn input, mocked Completer and output written to tmp file location"""
     mock_completer_instance = mock_completer.return_value
     dummy_completion = "my completion,has,fields"
-    mock_completer_instance.get_cloze_text.return_value = dummy_completion
+    mock_completer_instance.get_cloze_texts.return_value = [dummy_completion]
 
     with runner.isolated_filesystem(temp_dir=tmp_path) as td:
         input_csv = f"{td}/input.csv"
@@ -215,7 +658,72 @@ def test_complete_from_word_defn(mock_getpass, mock_completer, runner, tmp_path)
     assert result.output == f"wrote 1 to {output_loc}\n"
     assert result_contents == f"{dummy_completion}\n"
 
-    mock_completer_instance.get_cloze_text.assert_called_once()
+    mock_completer_instance.get_cloze_texts.assert_called_once_with(["myword"], ["my defn"], batch_size=20)
+
+
+@patch("clozify_llm.cli.getpass", return_value="sk-fake")
+def test_complete_batched_from_file(mock_getpass, runner, fake_openai_server, tmp_path):
+    """Test cli.complete packs prompts from input file into batched requests against local fake endpoint"""
+    words = [f"wort{i}" for i in range(5)]
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        input_csv = f"{td}/input.csv"
+        pd.DataFrame({"word": words, "defn": ["defn"] * len(words)}).to_csv(input_csv, index=False)
+        output_loc = f"{td}/output.csv"
+        result = runner.invoke(complete, ["-f", input_csv, "-m", "my-model", "-b", "2", "--output", output_loc])
+        result_contents = Path(output_loc).read_text()
+
+    assert result.exit_code == 0
+    assert result_contents == "".join(f"echo {word}\n" for word in words)
+    assert fake_openai_server.requests_served == 3
+
+
+@patch("clozify_llm.cli.getpass", return_value="sk-fake")
+def test_batch_create_run_export(mock_getpass, runner, fake_openai_server, tmp_path):
+    """Test cli batch create, run (twice, second run skipping everything) and export"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        Path(f"{td}/vocab.txt").write_text("eins\nzwei\n")
+        create_result = runner.invoke(batch, ["create", f"{td}/vocab.txt", f"{td}/requests.jsonl"])
+        run_result = runner.invoke(batch, ["run", f"{td}/requests.jsonl", f"{td}/results.jsonl", "-c", "2"])
+        rerun_result = runner.invoke(batch, ["run", f"{td}/requests.jsonl", f"{td}/results.jsonl"])
+        export_result = runner.invoke(
+            batch, ["export", f"{td}/requests.jsonl", f"{td}/results.jsonl", "-o", f"{td}/out.csv"]
+        )
+        exported = Path(f"{td}/out.csv").read_text()
+
+    assert create_result.output == f"wrote 2 requests to {td}/requests.jsonl\n"
+    assert run_result.output.endswith("succeeded 2, failed 0, skipped 0\n")
+    assert rerun_result.output == "succeeded 0, failed 0, skipped 2\n"
+    assert export_result.exit_code == 0
+    assert exported == "echo Input: eins\necho Input: zwei\n"
+
+
+@patch("clozify_llm.ratelimit.configure_rate_limit")
+@patch("clozify_llm.cli.getpass", return_value="sk-fake")
+def test_batch_run_rate_limit(mock_getpass, mock_configure_rate_limit, runner, fake_openai_server, tmp_path):
+    """Test cli batch run --rpm/--tpm sets the rate limit of the model the requests are sent to"""
+    with runner.isolated_filesystem(temp_dir=tmp_path) as td:
+        Path(f"{td}/vocab.txt").write_text("eins\n")
+        runner.invoke(batch, ["create", f"{td}/vocab.txt", f"{td}/requests.jsonl"])
+        result = runner.invoke(batch, ["run", f"{td}/requests.jsonl", f"{td}/results.jsonl", "--rpm", "60"])
+
+    assert result.exit_code == 0
+    mock_configure_rate_limit.assert_called_once_with(DEFAULT_CHAT_MODEL, 60, None)
+
+
+def test_cache_stats_prune(runner, chat_completion_response, tmp_path):
+    """Test cli cache stats and prune subcommands on a cache with one entry"""
+    cache_path = str(tmp_path / "responses.sqlite3")
+    cache = ResponseCache(cache_path)
+    cache.set({"model": "m"}, chat_completion_response)
+    cache.close()
+
+    stats_result = runner.invoke(cache_group, ["stats", "--path", cache_path])
+    prune_result = runner.invoke(cache_group, ["prune", "--path", cache_path, "--max-mb", "0"])
+
+    assert stats_result.exit_code == 0
+    assert "entries: 1\n" in stats_result.output
+    assert prune_result.exit_code == 0
+    assert prune_result.output == f"evicted 1 entries from {cache_path}\n"
 
 
 def test_get_help_recursive_runs(runner):
@@ -224,3 +732,28 @@ def test_get_help_recursive_runs(runner):
     assert isinstance(result, str)
     assert len(result) > 0
     assert len(result.splitlines()) > 20
+
+
+def test_cli_import_time():
+    """Importing the CLI does not import heavy modules, and stays within the import time budget"""
+    times = import_times("import clozify_llm.cli")
+
+    assert not imported_packages(times) & set(HEAVY_MODULES)
+    assert times["clozify_llm.cli"] < CLI_IMPORT_BUDGET_US
+
+
+@pytest.mark.parametrize(
+    "args",
+    [["--help"], ["chat", "--help"], ["prep", "--help"], ["prep", "match", "--help"], ["cache", "stats", "--help"]],
+)
+def test_help_does_not_import_heavy_modules(args):
+    times = import_times(f"from clozify_llm.cli import cli; cli({args!r}, standalone_mode=False)")
+
+    assert not imported_packages(times) & set(HEAVY_MODULES)
+
+
+def test_chat_does_not_import_prep_modules():
+    """Modules imported by chat do not need the optional prep dependency group"""
+    times = import_times("import clozify_llm.predict, clozify_llm.ratelimit")
+
+    assert not imported_packages(times) & {"pandas", "sklearn", "scipy", "lxml"}
@@ -0,0 +1,70 @@
+"""test_emb_matrix.py Testing of emb_matrix.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from clozify_llm.emb_matrix import EmbeddingMatrix
+
+
+@pytest.fixture
+def sample_matrix():
+    """Float32 embeddings labelled with a non-default index, including an all-zero row"""
+    values = np.array([[3.0, 4.0, 0.0], [0.0, 0.0, 0.0], [-1.0, 2.0, 0.5]], dtype=np.float32)
+    return EmbeddingMatrix(values, index=pd.Index([5, 6, 7]))
+
+
+def test_from_column():
+    """Test legacy str lists, lists and missing rows stack into a float32 matrix keeping the column index"""
+    embs = EmbeddingMatrix.from_column(pd.Series(["[1, 0]", None, "[0.5, 0.5]"], index=[2, 4, 6]))
+
+    assert embs.values.dtype == np.float32
+    assert embs.index.tolist() == [2, 4, 6]
+    np.testing.assert_array_equal(embs.values[[0, 2]], [[1, 0], [0.5, 0.5]])
+    assert np.isnan(embs.values[1]).all()
+    assert embs.to_column() == [[1.0, 0.0], None, [0.5, 0.5]]
+
+
+def test_norms_and_normalized(sample_matrix):
+    """Test norms are cached, kept by row selection, and zero rows stay zero when normalized"""
+    np.testing.assert_allclose(sample_matrix.norms, [5.0, 0.0, 2.2912878], rtol=1e-6)
+    subset = sample_matrix[[2, 0]]
+
+    assert subset.index.tolist() == [7, 5]
+    np.testing.assert_array_equal(subset.norms, sample_matrix.norms[[2, 0]])
+    np.testing.assert_allclose(sample_matrix.normalized()[0], [0.6, 0.8, 0.0], rtol=1e-6)
+    np.testing.assert_array_equal(sample_matrix.normalized()[1], 0.0)
+
+
+def test_quantize(sample_matrix):
+    """Test int8 quantization with per-row scales approximates the float32 rows"""
+    quantized = sample_matrix.quantize()
+
+    assert quantized.values.dtype == np.int8
+    assert quantized.nbytes < sample_matrix.nbytes
+    assert quantized.index.equals(sample_matrix.index)
+    np.testing.assert_allclose(np.asarray(quantized), sample_matrix.values, atol=4.0 / 127)
+    expected_sims = sample_matrix.normalized() @ sample_matrix.normalized().T
+    np.testing.assert_allclose(quantized.normalized() @ sample_matrix.normalized().T, expected_sims, atol=1e-2)
+
+
+@pytest.mark.parametrize("quantize", (False, True))
+def test_save_load(sample_matrix, quantize, tmp_path):
+    """Test saved matrices load memory-mapped with the same values"""
+    embs = sample_matrix.quantize() if quantize else sample_matrix
+    path = tmp_path / "embeds.word_embedding.npy"
+    embs.save(path)
+    loaded = EmbeddingMatrix.load(path, index=sample_matrix.index)
+
+    assert isinstance(loaded.values, np.memmap)
+    assert loaded.quantized == quantize
+    assert (tmp_path / "embeds.word_embedding.scales.npy").exists() == quantize
+    np.testing.assert_array_equal(np.asarray(loaded), np.asarray(embs))
+
+
+def test_init_validation():
+    """Test mismatched index or scales are rejected"""
+    with pytest.raises(ValueError):
+        EmbeddingMatrix(np.zeros((2, 3), dtype=np.float32), index=pd.Index([0]))
+    with pytest.raises(ValueError):
+        EmbeddingMatrix(np.zeros((2, 3), dtype=np.int8))
@@ -2,12 +2,21 @@
 """
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
 import pytest
 from pandas.testing import assert_frame_equal
 
 from clozify_llm.constants import CLOZE_COL, WORD_COL
-from clozify_llm.embed import add_emb
+from clozify_llm.emb_matrix import EmbeddingMatrix
+from clozify_llm.embed import (
+    CharNgramEmbedder,
+    add_emb,
+    emb_sidecar_path,
+    embed_matrix,
+    load_emb_sidecar,
+    write_emb_output,
+)
 
 
 @pytest.mark.parametrize(
@@ -39,3 +48,67 @@ def test_add_emb_input_not_set(mock_get_embs, embedding_vals):
     df = pd.DataFrame({input_col: ["Input str"]})
     with pytest.raises(ValueError):
         add_emb(df)
+
+
+def test_write_emb_output_npy_roundtrip(tmp_path):
+    """Test npy format writes CSV without embeddings and a memory-mappable float32 sidecar in row order"""
+    df_emb = pd.DataFrame({CLOZE_COL: ["a", "b"], f"{CLOZE_COL}_embedding": [[0.1, 0.2], [0.3, 0.4]]})
+    output_csv = tmp_path / "out-embeds.csv"
+    write_emb_output(df_emb, output_csv, [f"{CLOZE_COL}_embedding"], emb_format="npy")
+
+    assert list(pd.read_csv(output_csv).columns) == [CLOZE_COL]
+    assert emb_sidecar_path(output_csv, f"{CLOZE_COL}_embedding") == tmp_path / "out-embeds.cloze_embedding.npy"
+    embs = load_emb_sidecar(output_csv, f"{CLOZE_COL}_embedding")
+    assert isinstance(embs.values, np.memmap)
+    assert embs.values.dtype == np.float32
+    np.testing.assert_allclose(embs, [[0.1, 0.2], [0.3, 0.4]], rtol=1e-6)
+    assert load_emb_sidecar(output_csv, f"{WORD_COL}_embedding") is None
+
+
+def test_emb_matrix_from_column_legacy_str():
+    """Test legacy CSV list strings and in-memory lists give the same matrix"""
+    from_str = EmbeddingMatrix.from_column(pd.Series(["[1, 0]", "[0.5, 0.5]"])).values
+    from_list = EmbeddingMatrix.from_column(pd.Series([[1, 0], [0.5, 0.5]])).values
+    np.testing.assert_array_equal(from_str, from_list)
+    assert from_str.dtype == np.float32
+
+
+@patch("clozify_llm.embed.get_embs")
+def test_add_emb_skip(mock_get_embs, embedding_vals):
+    """Test skipped rows are not sent for embedding and are left empty"""
+    mock_get_embs.return_value = [embedding_vals]
+    df = pd.DataFrame({CLOZE_COL: ["skipped", "embedded"]})
+
+    result = add_emb(df, skip=np.array([True, False]))
+
+    mock_get_embs.assert_called_once_with(["embedded"], cache=None)
+    assert result[f"{CLOZE_COL}_embedding"].tolist() == [None, embedding_vals]
+    matrix = EmbeddingMatrix.from_column(result[f"{CLOZE_COL}_embedding"]).values
+    assert np.isnan(matrix[0]).all()
+    np.testing.assert_allclose(matrix[1], embedding_vals, rtol=1e-6)
+
+
+@patch("clozify_llm.embed.get_embs")
+def test_embed_matrix_skip(mock_get_embs, embedding_vals):
+    """Test embed_matrix returns float32 rows aligned to the dataframe index, NaN for skipped rows"""
+    mock_get_embs.return_value = [embedding_vals]
+    df = pd.DataFrame({CLOZE_COL: ["skipped", "embedded"]}, index=[10, 20])
+
+    result = embed_matrix(df, skip=np.array([True, False]))
+
+    mock_get_embs.assert_called_once_with(["embedded"], cache=None)
+    assert result.index.tolist() == [10, 20]
+    assert result.values.dtype == np.float32
+    assert np.isnan(result.values[0]).all()
+    np.testing.assert_allclose(result.values[1], embedding_vals, rtol=1e-6)
+
+
+def test_char_ngram_embedder():
+    """Test local embeddings are unit length, ignore vocab annotations and rank inflections closest"""
+    words = ["Ausrede, -n (f.)", "Ausflug, ¨-e (m.)", "Bank (f.)"]
+    embs = CharNgramEmbedder().fit_transform(["Ausreden", "Bänke"] + words)
+
+    np.testing.assert_allclose(np.sqrt(embs.multiply(embs).sum(axis=1)).A1, 1.0, rtol=1e-6)
+    sims = (embs[:2] @ embs[2:].T).toarray()
+    assert sims.argmax(axis=1).tolist() == [0, 2]
+    assert CharNgramEmbedder.clean_text("Ausrede, -n (f.)") == "Ausrede"
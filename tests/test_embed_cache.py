@@ -0,0 +1,104 @@
+"""test_embed_cache.py Unit testing of embed_cache.py"""
+import threading
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from clozify_llm.embed_cache import EmbeddingCache
+
+
+@pytest.fixture
+def emb_cache(tmp_path) -> EmbeddingCache:
+    cache = EmbeddingCache(tmp_path / "embeddings", engine="my-engine")
+    yield cache
+    cache.close()
+
+
+def test_put_get_many(emb_cache):
+    emb_cache.put_many(["Apfel", "Birne"], [[1.0, 0.0], [0.0, 1.0]])
+
+    result = emb_cache.get_many(["Birne", "Kirsche", " Apfel "])
+
+    np.testing.assert_array_equal(result[0], np.array([0.0, 1.0], dtype=np.float32))
+    assert result[1] is None
+    # Lookup uses normalized text
+    np.testing.assert_array_equal(result[2], np.array([1.0, 0.0], dtype=np.float32))
+    assert result[0].dtype == np.float32
+    assert (emb_cache.hits, emb_cache.misses) == (2, 1)
+
+
+def test_put_many_skips_existing(emb_cache):
+    emb_cache.put_many(["Apfel", "Apfel"], [[1.0, 0.0], [1.0, 0.0]])
+    emb_cache.put_many(["Apfel", "Birne"], [[1.0, 0.0], [0.0, 1.0]])
+
+    stats = emb_cache.stats()
+    assert stats["entries"] == 2
+    assert stats["rows"] == 2
+    assert stats["size_bytes"] == 2 * 2 * 4
+
+
+def test_put_many_dim_mismatch(emb_cache):
+    emb_cache.put_many(["Apfel"], [[1.0, 0.0]])
+    with pytest.raises(ValueError):
+        emb_cache.put_many(["Birne"], [[1.0, 0.0, 0.5]])
+
+
+def test_put_many_concurrent_writers(tmp_path):
+    """Test writers sharing a cache directory, including one opened before the dim was set, index distinct rows"""
+    n_writers, n_puts = 4, 25
+    opened = threading.Barrier(n_writers)
+
+    def put(writer):
+        cache = EmbeddingCache(tmp_path, engine="my-engine")
+        opened.wait()
+        for i in range(n_puts):
+            cache.put_many([f"w{writer}-{i}"], [[float(writer), float(i)]])
+        cache.close()
+
+    threads = [threading.Thread(target=put, args=(writer,)) for writer in range(n_writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache = EmbeddingCache(tmp_path, engine="my-engine")
+    result = cache.get_many([f"w{writer}-{i}" for writer in range(n_writers) for i in range(n_puts)])
+    expected = [[float(writer), float(i)] for writer in range(n_writers) for i in range(n_puts)]
+    np.testing.assert_array_equal(np.stack(result), expected)
+    assert cache.stats()["rows"] == n_writers * n_puts
+    cache.close()
+
+
+def test_persists_and_drops_partial_row(tmp_path):
+    cache = EmbeddingCache(tmp_path, engine="my-engine")
+    cache.put_many(["Apfel"], [[1.0, 2.0]])
+    cache.close()
+    # Simulate crash part way through appending another row
+    with open(cache.vectors_path, "ab") as f:
+        f.write(b"\x00\x00")
+
+    reopened = EmbeddingCache(tmp_path, engine="my-engine")
+    reopened.put_many(["Birne"], [[3.0, 4.0]])
+
+    np.testing.assert_array_equal(reopened.get_many(["Apfel"])[0], [1.0, 2.0])
+    np.testing.assert_array_equal(reopened.get_many(["Birne"])[0], [3.0, 4.0])
+    reopened.close()
+
+
+def test_compact_keeps_most_recently_used(emb_cache):
+    for i, text in enumerate(["a", "b", "c"]):
+        with patch("clozify_llm.embed_cache.time.time", return_value=1000.0 + i):
+            emb_cache.put_many([text], [[float(i), 0.0]])
+    with patch("clozify_llm.embed_cache.time.time", return_value=2000.0):
+        emb_cache.get_many(["a"])
+
+    evicted = emb_cache.compact(max_entries=2)
+
+    assert evicted == 1
+    result = emb_cache.get_many(["a", "b", "c"])
+    np.testing.assert_array_equal(result[0], [0.0, 0.0])
+    assert result[1] is None
+    np.testing.assert_array_equal(result[2], [2.0, 0.0])
+    assert emb_cache.stats()["rows"] == 2
+    assert len(list(emb_cache.dir.glob("vectors.*.f32"))) == 1
@@ -1,8 +1,16 @@
+import io
+import json
+
 import pandas as pd
 import pytest
 from pandas.testing import assert_frame_equal
 
-from clozify_llm.extract.extract_cloze import extract_cloze
+from clozify_llm.extract.extract_cloze import (
+    extract_cloze,
+    iter_cloze_records,
+    iter_json_values,
+    write_cloze_chunks,
+)
 
 
 @pytest.fixture
@@ -37,3 +45,121 @@ def test_extract_cloze(raw_input):
     df = extract_cloze(raw_input)
 
     assert_frame_equal(df, expected_output)
+
+
+@pytest.mark.parametrize("read_size", (1, 7, 2**20))
+def test_iter_json_values(raw_input, read_size):
+    """Test array elements and JSON Lines values are decoded one at a time whatever the read size"""
+    pages = raw_input + [{"collectionClozeSentences": [], "collection": {"name": "Empty"}}, 12345, "x"]
+
+    from_array = list(iter_json_values(io.StringIO(json.dumps(pages, indent=2)), read_size=read_size))
+    from_lines = list(iter_json_values(io.StringIO("\n".join(json.dumps(page) for page in pages)), read_size=read_size))
+
+    assert from_array == pages
+    assert from_lines == pages
+
+
+def test_iter_json_values_truncated():
+    """Test truncated dumps raise instead of silently dropping pages"""
+    with pytest.raises(ValueError):
+        list(iter_json_values(io.StringIO('[{"collection": {"name": "a"}}, {"collection": '), read_size=4))
+
+
+def test_write_cloze_chunks(raw_input, tmp_path):
+    """Test chunked csv output equals extract_cloze output, and nested fields are flattened like json_normalize"""
+    raw_input[0]["collectionClozeSentences"][0]["extra"] = {"level": 1}
+    output = tmp_path / "clozes.csv"
+
+    n_written = write_cloze_chunks(iter_cloze_records(raw_input), output, chunk_rows=1)
+
+    assert n_written == 2
+    expected = pd.json_normalize(raw_input, record_path="collectionClozeSentences", meta=["collection"])
+    assert list(pd.read_csv(output).columns) == list(expected.columns) + ["cloze"]
+    assert_frame_equal(pd.read_csv(output), extract_cloze(raw_input))
+
+
+def test_write_cloze_chunks_parquet(raw_input, tmp_path):
+    """Test chunked parquet output"""
+    pytest.importorskip("pyarrow")
+    output = tmp_path / "clozes.parquet"
+
+    write_cloze_chunks(iter_cloze_records(raw_input), output, output_format="parquet", chunk_rows=1)
+
+    assert_frame_equal(pd.read_parquet(output), extract_cloze(raw_input))
+
+
+@pytest.fixture
+def raw_input_new_fields(raw_input):
+    """Pages where fields first appear in a later page, and in the second sentence of that page"""
+    return raw_input + [
+        {
+            "collectionClozeSentences": [
+                {"text": "Un {{chat}} noir.", "translation": "A black cat.", "notes": "001"},
+                {"text": "Un {{chien}}.", "translation": "A dog.", "notes": "", "meta": {"lvl": 2}},
+            ],
+            "collection": {"name": "Animals"},
+        }
+    ]
+
+
+def test_extract_cloze_column_order(raw_input_new_fields):
+    """Test fields seen in later pages come before collection and cloze, as with json_normalize"""
+    expected = pd.json_normalize(raw_input_new_fields, record_path="collectionClozeSentences", meta=["collection"])
+
+    df = extract_cloze(raw_input_new_fields)
+
+    assert list(df.columns) == list(expected.columns) + ["cloze"]
+
+
+@pytest.mark.parametrize("chunk_rows", (1, 2, 3, 100))
+def test_write_cloze_chunks_new_fields(raw_input_new_fields, tmp_path, chunk_rows):
+    """Test fields first appearing in a later chunk are kept, with earlier rows rewritten unchanged"""
+    output = tmp_path / "clozes.csv"
+
+    n_written = write_cloze_chunks(iter_cloze_records(raw_input_new_fields), output, chunk_rows=chunk_rows)
+
+    expected_output = tmp_path / "expected.csv"
+    extract_cloze(raw_input_new_fields).to_csv(expected_output, index=False)
+    assert n_written == 4
+    assert_frame_equal(pd.read_csv(output), pd.read_csv(expected_output))
+    assert pd.read_csv(output, dtype=str, keep_default_na=False)["notes"].tolist() == ["", "", "001", ""]
+    assert not (tmp_path / "clozes.csv.partial").exists()
+
+
+@pytest.mark.parametrize("chunk_rows", (1, 3))
+def test_write_cloze_chunks_parquet_new_fields(raw_input_new_fields, tmp_path, chunk_rows):
+    """Test chunked parquet output keeps fields first appearing in a later chunk"""
+    pytest.importorskip("pyarrow")
+    output = tmp_path / "clozes.parquet"
+
+    write_cloze_chunks(iter_cloze_records(raw_input_new_fields), output, output_format="parquet", chunk_rows=chunk_rows)
+
+    result = pd.read_parquet(output)
+    expected = extract_cloze(raw_input_new_fields)
+    assert list(result.columns) == list(expected.columns)
+    assert result["notes"].tolist() == [None, None, "001", ""]
+    assert result["meta.lvl"].tolist() == [None, None, None, "2"]
+
+
+@pytest.mark.parametrize(
+    "sentences",
+    (
+        [{"text": "Kein Cloze."}, {"text": "Ein {{Cloze}}."}],
+        [{"text": "{{a}}", "notes": None}, {"text": "{{b}}", "notes": "note"}],
+        [{"text": "{{a}}", "level": 1}, {"text": "{{b}}", "level": "two"}],
+    ),
+    ids=("cloze_nan_first", "field_none_first", "field_int_then_str"),
+)
+def test_write_cloze_chunks_parquet_chunk_types(sentences, tmp_path):
+    """Test parquet chunks whose values are missing or differently typed in the first chunk are written as strings"""
+    pytest.importorskip("pyarrow")
+    output = tmp_path / "clozes.parquet"
+    raw_input = [{"collectionClozeSentences": sentences, "collection": {"name": "c"}}]
+
+    n_written = write_cloze_chunks(iter_cloze_records(raw_input), output, output_format="parquet", chunk_rows=1)
+
+    result = pd.read_parquet(output)
+    assert n_written == 2
+    assert result["text"].tolist() == [sentence["text"] for sentence in sentences]
+    for column in result.columns:
+        assert result[column].map(lambda value: value is None or isinstance(value, str)).all()
@@ -1,16 +1,23 @@
+import gzip
+import json
+import time
 from pathlib import Path
 from unittest import mock
 
 import pandas as pd
 import pytest
+import requests
 from pandas.testing import assert_frame_equal
 
-from clozify_llm.constants import DEFN_COL, WORD_COL
+from clozify_llm.constants import DEFAULT_FETCH_TIMEOUT, DEFN_COL, WORD_COL
 from clozify_llm.extract.extract_wortschatz import (
+    LessonCache,
     extract_script,
     get_all_vocab_from_course_request,
     lessons_from_course,
     load_lesson,
+    make_session,
+    words_from_staging_dir,
     words_from_wortschatz_html,
     wortschatz_html_from_id,
 )
@@ -58,36 +65,69 @@ def mock_requests_get():
         yield get_mock
 
 
-def test_get_all_vocab_from_course_request(course_html, ws_html, mock_requests_get, tmp_path):
-    """Test complete get_all_vocab_from_course_request behavior with mocked get requests"""
-    course_response_mock = mock.Mock(content=course_html.encode("utf-8"))
-    lesson_response_mock = mock.Mock(content=ws_html.encode("utf-8"))
+@pytest.fixture
+def dw_site(fake_dw_server, course_html, ws_html):
+    """Local server with two courses sharing lesson2, and a 503 on the first request for lesson1"""
+    fake_dw_server.pages = {
+        "/course1": course_html,
+        "/course2": '<li class="lesson-item"><a href="/de/lesson2/l-456">Lesson 2</a></li>'
+        '<li class="lesson-item"><a href="/de/lesson3/l-789">Lesson 3</a></li>',
+        "/de/lesson1/l-123/lv": ws_html,
+        "/de/lesson2/l-456/lv": ws_html.replace("Word 2", "Word 3"),
+        "/de/lesson3/l-789/lv": ws_html.replace("Word 1", "Word 4"),
+    }
+    fake_dw_server.fail_once = {"/de/lesson1/l-123/lv"}
+    return fake_dw_server
+
+
+def test_get_all_vocab_from_course_request(dw_site, tmp_path):
+    """Test vocab of several courses fetched from a local server, with shared lessons fetched once and retries"""
+    expected_df = pd.DataFrame(
+        {
+            WORD_COL: ["Word 1", "Word 2", "Word 3", "Word 4"],
+            DEFN_COL: ["Definition 1", "Definition 2", "Definition 2", "Definition 1"],
+        },
+        index=[0, 1, 3, 4],
+    )
+
+    result_df = get_all_vocab_from_course_request(
+        [f"{dw_site.url}/course1", f"{dw_site.url}/course2"], str(tmp_path), concurrency=3, base_url=dw_site.url
+    )
 
-    # Return the lesson html unless the course html is requested
-    dummy_course_url = "https://example.com/course"
+    assert_frame_equal(result_df, expected_df)
+    assert dw_site.requests == {
+        "/course1": 1,
+        "/course2": 1,
+        "/de/lesson1/l-123/lv": 2,
+        "/de/lesson2/l-456/lv": 1,
+        "/de/lesson3/l-789/lv": 1,
+    }
+    assert (tmp_path / "lesson3_l-789.html.gz").exists()
 
-    def mock_get(url):
-        if url == dummy_course_url:
-            return course_response_mock
-        else:
-            return lesson_response_mock
 
-    mock_requests_get.side_effect = mock_get
+def test_get_all_vocab_concurrent(dw_site, tmp_path):
+    """Test lessons are requested concurrently"""
+    dw_site.fail_once = set()
+    dw_site.latency = 0.2
+    start_time = time.perf_counter()
+    get_all_vocab_from_course_request(
+        [f"{dw_site.url}/course1", f"{dw_site.url}/course2"], str(tmp_path), concurrency=3, base_url=dw_site.url
+    )
 
-    expected_df = pd.DataFrame({WORD_COL: ["Word 1", "Word 2"], DEFN_COL: ["Definition 1", "Definition 2"]})
+    # 2 course pages in sequence, then 3 lessons at once
+    assert time.perf_counter() - start_time < 0.2 * 5
 
-    result_df = get_all_vocab_from_course_request(dummy_course_url, str(tmp_path))
 
-    assert_frame_equal(result_df, expected_df)
-    mock_requests_get.assert_any_call(dummy_course_url)
+def test_wortschatz_html_from_id_timeout(fake_dw_server):
+    """Test requests give up after the timeout"""
+    fake_dw_server.pages = {"/de/lesson1/l-123/lv": "slow"}
+    fake_dw_server.latency = 0.5
+    start_time = time.perf_counter()
+    with make_session(retries=0) as session:
+        with pytest.raises(requests.exceptions.RequestException, match="Read timed out"):
+            wortschatz_html_from_id("lesson1/l-123", session=session, timeout=0.1, base_url=fake_dw_server.url)
 
-    # Verify that lesson URLs were requested
-    expected_lesson_urls = [
-        "https://learngerman.dw.com/de/lesson1/l-123/lv",
-        "https://learngerman.dw.com/de/lesson2/l-456/lv",
-    ]
-    for lesson_url in expected_lesson_urls:
-        mock_requests_get.assert_any_call(lesson_url)
+    assert time.perf_counter() - start_time < 0.5
 
 
 def test_extract_script(course_html, ws_html, mock_requests_get):
@@ -114,22 +154,54 @@ def test_lessons_from_course(course_html):
 def test_load_lesson(mock_requests_get, ws_html, tmp_path):
     """Test load_lesson behavior when local file does not initially exist
 
-    Mock request response with expected lesson html"""
-    response_mock = mock.Mock(content=ws_html.encode("utf-8"))
+    Mock request response with expected lesson html, which is staged compressed with its validators"""
+    response_mock = mock.Mock(content=ws_html.encode("utf-8"), status_code=200, headers={"ETag": '"v1"'})
     mock_requests_get.return_value = response_mock
     local_dir = tmp_path / "lessons"
     local_dir.mkdir()
     lesson_id = "lesson1/l-123"
-    expected_file_path = local_dir / "lesson1_l-123.html"
 
-    with mock.patch("builtins.open", mock.mock_open()) as mock_open:
-        result_html = load_lesson(lesson_id, local_dir)
+    result_html = load_lesson(lesson_id, local_dir)
+    cached_html = load_lesson(lesson_id, local_dir)
 
     assert result_html == ws_html
-    mock_requests_get.assert_called_once_with("https://learngerman.dw.com/de/lesson1/l-123/lv")
-    mock_open.assert_called_once_with(expected_file_path, "w")
-    handle = mock_open()
-    handle.write.assert_called_once_with(ws_html)
+    assert cached_html == ws_html
+    mock_requests_get.assert_called_once_with(
+        "https://learngerman.dw.com/de/lesson1/l-123/lv", headers={}, timeout=DEFAULT_FETCH_TIMEOUT
+    )
+    assert gzip.decompress((local_dir / "lesson1_l-123.html.gz").read_bytes()).decode("utf-8") == ws_html
+    assert json.loads((local_dir / "lesson1_l-123.meta.json").read_text())["etag"] == '"v1"'
+
+
+def test_lesson_cache_revalidate(fake_dw_server, ws_html, tmp_path):
+    """Test stale lessons are revalidated with conditional requests and only downloaded when changed"""
+    path = "/de/lesson1/l-123/lv"
+    url = f"{fake_dw_server.url}{path}"
+    fake_dw_server.pages = {path: ws_html}
+    LessonCache(tmp_path).get("lesson1_l-123", url)
+
+    assert LessonCache(tmp_path).get("lesson1_l-123", url) == (ws_html, "cached")
+    assert LessonCache(tmp_path, max_age=3600).get("lesson1_l-123", url) == (ws_html, "cached")
+    assert LessonCache(tmp_path, max_age=0).get("lesson1_l-123", url) == (ws_html, "not modified")
+    fake_dw_server.pages = {path: ws_html.replace("Word 1", "Wort 1")}
+    refresh = LessonCache(tmp_path, max_age=0)
+    html_str, outcome = refresh.get("lesson1_l-123", url)
+
+    assert outcome == "downloaded"
+    assert "Wort 1" in html_str
+    assert fake_dw_server.statuses == [(path, 200), (path, 304), (path, 200)]
+    assert refresh.counts == {"downloaded": 1}
+
+
+def test_lesson_cache_legacy_raw_html(ws_html, tmp_path):
+    """Test raw html staged by earlier versions is compressed and reused without a request"""
+    (tmp_path / "lesson1_l-123.html").write_text(ws_html)
+
+    html_str, outcome = LessonCache(tmp_path).get("lesson1_l-123", "http://127.0.0.1:1/unreachable")
+
+    assert (html_str, outcome) == (ws_html, "cached")
+    assert not (tmp_path / "lesson1_l-123.html").exists()
+    assert (tmp_path / "lesson1_l-123.html.gz").exists()
 
 
 def test_wortschatz_html_from_id(mock_requests_get):
@@ -140,7 +212,9 @@ def test_wortschatz_html_from_id(mock_requests_get):
     result_html = wortschatz_html_from_id("lesson1/l-123")
 
     assert result_html == expected_html
-    mock_requests_get.assert_called_once_with("https://learngerman.dw.com/de/lesson1/l-123/lv")
+    mock_requests_get.assert_called_once_with(
+        "https://learngerman.dw.com/de/lesson1/l-123/lv", timeout=DEFAULT_FETCH_TIMEOUT
+    )
 
 
 def test_words_from_wortschatz_html(ws_html):
@@ -153,3 +227,31 @@ def test_words_from_wortschatz_html(ws_html):
     result_words = words_from_wortschatz_html(ws_html)
 
     assert result_words == expected_words
+
+
+def test_words_from_wortschatz_html_nested_classes(ws_html):
+    """Test wrapper and lesson items are found among several classes, and text of nested tags is kept"""
+    html_str = ws_html.replace('class="knowledge-wrapper"', 'class="col knowledge-wrapper  wide"').replace(
+        "Definition 1", "Definition <em>eins</em>\xa0(1)"
+    )
+    course_html = '<li class="lesson-item active"><span><a href="/de/kurs/lesson1/l-123">L</a></span></li>'
+
+    assert words_from_wortschatz_html(html_str)[0] == {WORD_COL: "Word 1", DEFN_COL: "Definition eins (1)"}
+    assert lessons_from_course(course_html) == ["lesson1/l-123"]
+    with pytest.raises(ValueError):
+        words_from_wortschatz_html("<html><body><p>moved</p></body></html>")
+
+
+@pytest.mark.parametrize("n_workers", (1, 2))
+def test_words_from_staging_dir(ws_html, n_workers, tmp_path):
+    """Test staged compressed and legacy raw lessons are parsed, with duplicates dropped"""
+    LessonCache(tmp_path)._write("lesson1_l-123", ws_html.encode("utf-8"), {})
+    (tmp_path / "lesson2_l-456.html").write_text(ws_html.replace("Word 2", "Word 3"))
+    expected_df = pd.DataFrame(
+        {WORD_COL: ["Word 1", "Word 2", "Word 3"], DEFN_COL: ["Definition 1", "Definition 2", "Definition 2"]},
+        index=[0, 1, 3],
+    )
+
+    result_df = words_from_staging_dir(tmp_path, n_workers=n_workers)
+
+    assert_frame_equal(result_df, expected_df)
@@ -1,14 +1,22 @@
 """test_finetune.py Unit testing of finetune.py"""
 
+import hashlib
+import json
 from pathlib import Path
 from unittest.mock import patch
 
+import openai
 import pandas as pd
 import pytest
 
 from clozify_llm.constants import CLOZE_COL, DEFN_COL, WORD_COL
-from clozify_llm.finetune import FineTuner
-from clozify_llm.utils import format_completion, format_prompt
+from clozify_llm.finetune import (
+    FineTuner,
+    UploadLedger,
+    estimate_finetune_cost,
+    summarize_training_file,
+)
+from clozify_llm.utils import estimate_tokens, format_completion, format_prompt
 
 
 @pytest.fixture
@@ -45,11 +53,19 @@ def sample_dataset() -> list[dict]:
 
 
 @pytest.fixture
-def sample_finetuner(sample_df, training_file_path) -> FineTuner:
+def ledger(tmp_path) -> UploadLedger:
+    ledger = UploadLedger(tmp_path / "cache" / "uploads.sqlite3")
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture
+def sample_finetuner(sample_df, training_file_path, ledger) -> FineTuner:
     return FineTuner(
         df=sample_df,
         training_data_path=training_file_path,
         model="dummy_completion_model",
+        ledger=ledger,
     )
 
 
@@ -83,3 +99,110 @@ class TestFinetune:
         expected = finetune_create_response
 
         assert result == expected
+
+    def test_finetune_write_data_streams_training_set(self, training_file_path):
+        df = pd.DataFrame(
+            {
+                WORD_COL: ["Wort", 'say "hi"', "back\\slash"],
+                DEFN_COL: ["word", "sagä", "tab\there"],
+                "text": ["Das Wort, bitte", "new\nline", "über \U0001f600"],
+                "translation": ["The word, please", None, "over"],
+                CLOZE_COL: ["Wort", "line", "über"],
+            }
+        )
+        finetuner = FineTuner(df, training_file_path, chunk_rows=2)
+        expected_dataset = [
+            {"prompt": format_prompt(word, defn), "completion": format_completion(text, translation, cloze)}
+            for word, defn, text, translation, cloze in df[
+                [WORD_COL, DEFN_COL, "text", "translation", CLOZE_COL]
+            ].values
+        ]
+
+        finetuner.write_data()
+
+        contents = Path(training_file_path).read_text(encoding="utf-8")
+        assert finetuner.create_dataset() == expected_dataset
+        assert contents == "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in expected_dataset)
+
+    def test_finetune_from_csv(self, sample_df, training_file_path, tmp_path):
+        csv_path = tmp_path / "training.csv"
+        df = pd.concat([sample_df.assign(text=f"use my word {i}") for i in range(5)])
+        df.assign(extra=1).to_csv(csv_path, index=False)
+
+        finetuner = FineTuner.from_csv(csv_path, training_file_path, chunk_rows=2)
+        finetuner.write_data()
+
+        lines = Path(training_file_path).read_text().splitlines()
+        assert [json.loads(line) for line in lines] == FineTuner(df, training_file_path).create_dataset()
+
+    def test_finetune_write_data_drops_duplicates(self, sample_df, training_file_path, sample_dataset):
+        df = pd.concat([sample_df, sample_df.assign(text="other text"), sample_df, sample_df])
+        finetuner = FineTuner(df, training_file_path, chunk_rows=3)
+
+        written = finetuner.write_data()
+
+        lines = Path(training_file_path).read_text().splitlines()
+        assert written == {"examples": 2, "duplicates": 2}
+        assert len(lines) == 2
+        assert json.loads(lines[0]) == sample_dataset[0]
+
+    def test_finetune_prepare_upload(self, sample_df, training_file_path, capsys):
+        finetuner = FineTuner(pd.concat([sample_df] * 3), training_file_path, model="curie")
+
+        summary = finetuner.prepare_upload()
+
+        tokens = estimate_tokens(format_prompt("word", "defn")) + estimate_tokens(
+            format_completion("use my word", "translation with word", "cloze")
+        )
+        assert summary["examples"] == 1
+        assert summary["duplicates"] == 2
+        assert summary["tokens"] == tokens
+        assert summary["sha256"] == hashlib.sha256(Path(training_file_path).read_bytes()).hexdigest()
+        assert summary["estimated_cost"] == pytest.approx(tokens * 4 * 0.003 / 1000)
+        assert "1 examples (2 duplicates dropped)" in capsys.readouterr().out
+
+    @patch("clozify_llm.finetune.openai.FineTune")
+    @patch("clozify_llm.finetune.openai.File")
+    def test_finetune_reuses_upload(
+        self, mock_file, mock_finetune, sample_finetuner, file_create_response, finetune_create_response, capsys
+    ):
+        mock_file.create.return_value = file_create_response
+        mock_finetune.create.return_value = finetune_create_response
+
+        sample_finetuner.start_finetuning()
+        sample_finetuner.start_finetuning()
+
+        mock_file.create.assert_called_once()
+        mock_file.retrieve.assert_called_once_with(file_create_response.id)
+        assert mock_finetune.create.call_count == 2
+        mock_finetune.create.assert_called_with(training_file=file_create_response.id, model="dummy_completion_model")
+        assert f"reusing uploaded file with id {file_create_response.id}" in capsys.readouterr().out
+
+    @patch("clozify_llm.finetune.openai.File")
+    def test_finetune_upload_again_if_deleted(self, mock_file, sample_finetuner, ledger, file_create_response):
+        mock_file.create.return_value = file_create_response
+        summary = sample_finetuner.prepare_upload()
+        ledger.record(summary, "file-deleted")
+        mock_file.retrieve.side_effect = openai.error.InvalidRequestError("No such File object", "id")
+
+        file_id = sample_finetuner.upload(summary)
+
+        assert file_id == file_create_response.id
+        assert ledger.get(summary["sha256"]) == file_create_response.id
+        mock_file.create.assert_called_once()
+
+
+def test_summarize_training_file_empty(tmp_path):
+    path = tmp_path / "training.jsonl"
+    path.write_text("")
+
+    summary = summarize_training_file(path)
+
+    assert summary["examples"] == 0
+    assert summary["tokens"] == 0
+    assert summary["sha256"] == hashlib.sha256(b"").hexdigest()
+
+
+def test_estimate_finetune_cost():
+    assert estimate_finetune_cost(1000, "davinci", n_epochs=2) == pytest.approx(0.06)
+    assert estimate_finetune_cost(1000, "unknown-model") is None
@@ -1,11 +1,14 @@
 """test_join.py Unit testing of join.py"""
 
+import numpy as np
 import pandas as pd
 import pytest
 from pandas.testing import assert_frame_equal
 
+from clozify_llm.ann import IVFIndex
 from clozify_llm.constants import CLOZE_COL, DEFN_COL, WORD_COL
-from clozify_llm.join import Joiner
+from clozify_llm.emb_matrix import EmbeddingMatrix
+from clozify_llm.join import Joiner, MatchState, vocab_fingerprint
 
 
 @pytest.fixture
@@ -58,6 +61,10 @@ def test_joiner_join_emb_sim(sample_joiner, sample_join_result):
     result = sample_joiner.join_emb_sim()
 
     expected = sample_join_result
+    # match_score is cosine similarity of each cloze to its matched word
+    expected_scores = [0.9 / np.sqrt(0.83), 1.8 / np.sqrt(1.63 * 2)]
+    np.testing.assert_allclose(result["match_score"], expected_scores, rtol=1e-6)
+    result = result.drop(columns=["match_score"])
 
     result_sorted = result.reindex(sorted(result.columns), axis=1).reset_index(drop=True)
     expected_sorted = expected.reindex(sorted(expected.columns), axis=1).reset_index(drop=True)
@@ -96,3 +103,167 @@ def test_joiner_view_multi_defn(sample_joiner):
     expected = vocab.loc[[0, 1]]
 
     assert_frame_equal(result, expected)
+
+
+def test_joiner_join_emb_sim_from_matrices(sample_df_cloze, sample_df_vocab, sample_join_result):
+    """Test join using embedding matrices in place of embedding columns gives the same matches"""
+    cloze_embs = np.array([[0.1, 0.9, 0.1], [0.9, 0.1, 0.9]], dtype=np.float32)
+    word_embs = np.array([[1, 0, 1], [0, 1, 0]], dtype=np.float32)
+    joiner = Joiner(
+        df_cloze=sample_df_cloze.drop(columns=[f"{CLOZE_COL}_embedding"]),
+        df_vocab=sample_df_vocab.drop(columns=[f"{WORD_COL}_embedding"]),
+        cloze_embs=cloze_embs,
+        word_embs=word_embs,
+    )
+    result = joiner.join_emb_sim()
+
+    assert result["cloze_idx"].tolist() == sample_join_result["cloze_idx"].tolist()
+    assert result["vocab_idx"].tolist() == sample_join_result["vocab_idx"].tolist()
+
+
+def test_joiner_join_emb_sim_quantized(sample_df_cloze, sample_df_vocab, sample_join_result):
+    """Test join from int8 EmbeddingMatrix inputs gives the same matches, and unaligned matrices are rejected"""
+    cloze_embs = EmbeddingMatrix(np.array([[0.1, 0.9, 0.1], [0.9, 0.1, 0.9]], dtype=np.float32)).quantize()
+    word_embs = EmbeddingMatrix(np.array([[1, 0, 1], [0, 1, 0]], dtype=np.float32)).quantize()
+    df_cloze = sample_df_cloze.drop(columns=[f"{CLOZE_COL}_embedding"])
+    df_vocab = sample_df_vocab.drop(columns=[f"{WORD_COL}_embedding"])
+    result = Joiner(df_cloze, df_vocab, cloze_embs=cloze_embs, word_embs=word_embs).join_emb_sim()
+
+    assert result["vocab_idx"].tolist() == sample_join_result["vocab_idx"].tolist()
+    with pytest.raises(ValueError):
+        Joiner(
+            df_cloze.set_index(df_cloze.index + 1), df_vocab, cloze_embs=cloze_embs, word_embs=word_embs
+        ).join_emb_sim()
+
+
+def test_joiner_emb_matrix_length_mismatch(sample_df_cloze, sample_df_vocab):
+    """Test embedding matrix must have one row per dataframe row"""
+    joiner = Joiner(sample_df_cloze, sample_df_vocab, cloze_embs=np.zeros((3, 3), dtype=np.float32))
+    with pytest.raises(ValueError):
+        joiner.join_emb_sim()
+
+
+def test_joiner_join_emb_sim_top_k(sample_joiner):
+    """Test runner-up candidates are added as extra columns"""
+    result = sample_joiner.join_emb_sim(top_k=2, max_block_bytes=1)
+
+    assert result["vocab_idx"].tolist() == [1, 0]
+    assert result["vocab_idx_2"].tolist() == [0, 1]
+    assert (result["match_score"] > result["match_score_2"]).all()
+
+
+def test_joiner_join_emb_sim_with_index(sample_df_cloze, sample_df_vocab, sample_joiner):
+    """Test join using a vocab index does not need vocab embeddings and matches exact join"""
+    index = IVFIndex.build(np.array([[1, 0, 1], [0, 1, 0]]), n_lists=2)
+    joiner = Joiner(sample_df_cloze, sample_df_vocab.drop(columns=[f"{WORD_COL}_embedding"]))
+
+    result = joiner.join_emb_sim(index=index, n_probe=2)
+
+    assert result["vocab_idx"].tolist() == sample_joiner.join_emb_sim()["vocab_idx"].tolist()
+
+
+def test_joiner_join_emb_sim_index_permuted_vocab(sample_df_cloze, sample_df_vocab):
+    """Test join refuses an index built from vocab rows in another order, though the vocab length is the same"""
+    index = IVFIndex.build(
+        np.array([[1, 0, 1], [0, 1, 0]]), n_lists=2, vocab_fingerprint=vocab_fingerprint(sample_df_vocab)
+    )
+    permuted_vocab = sample_df_vocab[::-1].reset_index(drop=True)
+    joiner = Joiner(sample_df_cloze, permuted_vocab.drop(columns=[f"{WORD_COL}_embedding"]))
+
+    assert vocab_fingerprint(permuted_vocab) != index.vocab_fingerprint
+    with pytest.raises(ValueError, match="rebuild the index"):
+        joiner.join_emb_sim(index=index, n_probe=2)
+
+
+def test_joiner_join_emb_sim_incremental(tmp_path):
+    """Test join reusing previous matches equals full join after clozes and vocab change"""
+    rng = np.random.default_rng(0)
+    word_embs, cloze_embs = rng.normal(size=(60, 8)), rng.normal(size=(100, 8))
+    df_vocab = pd.DataFrame({WORD_COL: [f"w{i}" for i in range(60)], DEFN_COL: "defn"})
+    df_cloze = pd.DataFrame({CLOZE_COL: [f"c{i}" for i in range(100)]})
+    first = Joiner(df_cloze[:80], df_vocab[:50], cloze_embs=cloze_embs[:80], word_embs=word_embs[:50])
+    first.join_emb_sim(top_k=2)
+    first.match_state.save(tmp_path / "state.npz")
+    previous = MatchState.load(tmp_path / "state.npz")
+    # Remove a vocab row, add vocab rows and clozes, and change a cloze
+    keep = [i for i in range(60) if i != 3]
+    df_vocab, word_embs = df_vocab.iloc[keep].reset_index(drop=True), word_embs[keep]
+    df_cloze.loc[5, CLOZE_COL] = "changed"
+    cloze_embs[5] = rng.normal(size=8)
+
+    joiner = Joiner(df_cloze, df_vocab, cloze_embs=cloze_embs, word_embs=word_embs)
+    result = joiner.join_emb_sim(top_k=2, previous=previous)
+    expected = Joiner(df_cloze, df_vocab, cloze_embs=cloze_embs, word_embs=word_embs).join_emb_sim(top_k=2)
+
+    assert_frame_equal(result, expected, rtol=1e-5)
+    # New clozes, the changed cloze, and clozes whose candidates included the removed vocab row are rescored
+    rescored = set(range(80, 100)) | {5} | set(np.flatnonzero((first.match_state.indices == 3).any(axis=1)))
+    assert joiner.n_rescored == len(rescored)
+
+
+@pytest.mark.parametrize("projection_fingerprint,n_dims", ((None, 4), ("abc123", 8)))
+def test_joiner_join_emb_sim_incremental_other_space(tmp_path, projection_fingerprint, n_dims):
+    """Test previous matches from another embedding dim or projection are not reused, rescoring all clozes"""
+    rng = np.random.default_rng(0)
+    df_vocab = pd.DataFrame({WORD_COL: [f"w{i}" for i in range(20)], DEFN_COL: "defn"})
+    df_cloze = pd.DataFrame({CLOZE_COL: [f"c{i}" for i in range(30)]})
+    first = Joiner(df_cloze, df_vocab, cloze_embs=rng.normal(size=(30, 8)), word_embs=rng.normal(size=(20, 8)))
+    first.join_emb_sim(top_k=2)
+    first.match_state.save(tmp_path / "state.npz")
+    previous = MatchState.load(tmp_path / "state.npz")
+    cloze_embs, word_embs = rng.normal(size=(30, n_dims)), rng.normal(size=(20, n_dims))
+
+    joiner = Joiner(
+        df_cloze, df_vocab, cloze_embs=cloze_embs, word_embs=word_embs, projection_fingerprint=projection_fingerprint
+    )
+    with pytest.warns(UserWarning, match="rescoring all clozes"):
+        result = joiner.join_emb_sim(top_k=2, previous=previous)
+    expected = Joiner(df_cloze, df_vocab, cloze_embs=cloze_embs, word_embs=word_embs).join_emb_sim(top_k=2)
+
+    assert previous.emb_space == "text-embedding-ada-002/8"
+    assert joiner.match_state.emb_space != previous.emb_space
+    assert joiner.n_rescored == len(df_cloze)
+    assert_frame_equal(result, expected, rtol=1e-5)
+
+
+def test_joiner_join_emb_sim_workers(sample_joiner, sample_join_result):
+    """Test join with a process pool gives the same matches"""
+    result = sample_joiner.join_emb_sim(n_workers=2)
+
+    assert result["vocab_idx"].tolist() == sample_join_result["vocab_idx"].tolist()
+
+
+def test_joiner_join_emb_sim_lexical():
+    """Test clozes matching a vocab word form are joined without embeddings, the rest by embedding"""
+    df_cloze = pd.DataFrame({CLOZE_COL: ["Ausreden", "Auto"], f"{CLOZE_COL}_embedding": [None, "[0, 1]"]})
+    df_vocab = pd.DataFrame(
+        {
+            WORD_COL: ["Ausrede, -n (f.)", "Wagen (m.)"],
+            DEFN_COL: ["excuse", "car"],
+            f"{WORD_COL}_embedding": ["[1, 0]", "[0.1, 1]"],
+        }
+    )
+    joiner = Joiner(df_cloze, df_vocab)
+
+    result = joiner.join_emb_sim(lexical=True)
+
+    assert result["vocab_idx"].tolist() == [0, 1]
+    assert result["match_method"].tolist() == ["lexical", "embedding"]
+    assert result["match_score"].iloc[0] == 1.0
+    assert joiner.n_rescored == 1
+    with pytest.raises(ValueError):
+        Joiner(df_cloze, df_vocab).join_emb_sim()
+
+
+def test_joiner_join_emb_sim_local_backend():
+    """Test local backend matches by spelling without any embeddings"""
+    df_cloze = pd.DataFrame({CLOZE_COL: ["Ausreden", "Bänke", "Ausreden"]})
+    df_vocab = pd.DataFrame({WORD_COL: ["Ausrede, -n (f.)", "Ausflug, ¨-e (m.)", "Bank (f.)"], DEFN_COL: "defn"})
+    joiner = Joiner(df_cloze, df_vocab)
+
+    result = joiner.join_emb_sim(backend="local", top_k=2)
+
+    assert result["vocab_idx"].tolist() == [0, 2, 0]
+    assert joiner.match_state.backend == "local"
+    with pytest.raises(ValueError):
+        joiner.join_emb_sim(backend="unknown")
@@ -0,0 +1,82 @@
+"""test_lexical.py Unit testing of lexical.py"""
+from unicodedata import normalize
+
+import pytest
+
+from clozify_llm.lexical import (
+    LexicalMatcher,
+    inflected_forms,
+    parse_vocab_word,
+    umlaut,
+)
+
+
+@pytest.mark.parametrize(
+    "word,expected",
+    (
+        ("Ausrede, -n (f.)", ("ausrede", "ausreden", "noun")),
+        ("der Waschbär, -en", ("waschbär", "waschbären", "noun")),
+        ("Haus, ¨-er (n.)", ("haus", "häuser", "noun")),
+        (normalize("NFKD", "Mutter, ¨- (f.)"), ("mutter", "mütter", "noun")),
+        ("sich erholen", ("erholen", None, "verb")),
+        ("Bank (f.)", ("bank", None, "noun")),
+        ("seit", ("seit", None, None)),
+        ("zur Verfügung stellen", None),
+    ),
+)
+def test_parse_vocab_word(word, expected):
+    """Test annotations, articles and reflexive pronoun are stripped and plurals formed"""
+    assert parse_vocab_word(word) == expected
+
+
+def test_umlaut():
+    """Test last vowel is umlauted, including au"""
+    assert [umlaut(word) for word in ("haus", "vogel", "xyz")] == ["häus", "vögel", "xyz"]
+
+
+def test_inflected_forms_verb():
+    """Test conjugated forms of verb stem are included but base is not"""
+    forms = inflected_forms("erholen", word_class="verb")
+    assert {"erhole", "erholst", "erholt", "erholte"} <= forms
+    assert "erholen" not in forms
+
+
+def test_inflected_forms_by_word_class():
+    """Test nouns get only declension endings and plural, unclassified words and short stems no endings"""
+    assert inflected_forms("haus", "häuser", "noun") == {"hause", "hauses", "hauss", "häuser", "häusern"}
+    assert inflected_forms("rat", "räte", "noun") == {"räte", "räten"}
+    assert inflected_forms("sein", word_class="verb") == set()
+    assert inflected_forms("schnell") == set()
+
+
+def test_lexical_matcher():
+    """Test unambiguous forms match, ambiguous and unknown forms do not"""
+    matcher = LexicalMatcher(["Ausrede, -n (f.)", "Bank (f.)", "Bank (f.)", "Haus, ¨-er (n.)", "sich erholen", None])
+
+    result = matcher.match_many(["Ausreden", "Bank", "Häuser", "erholt", "Hause", "Auto", float("nan")])
+
+    assert result.tolist() == [0, -1, 3, 4, 3, -1, -1]
+
+
+def test_lexical_matcher_base_form_first():
+    """Test a base form match wins over an inflected form of another entry"""
+    matcher = LexicalMatcher(["Tisch, -e (m.)", "Tische (f.)"])
+
+    assert matcher.match("Tische") == 1
+    assert matcher.match("Tischen") == 0
+
+
+@pytest.mark.parametrize(
+    "vocab_word,cloze",
+    (
+        ("sein", "seit"),
+        ("Rat, ¨-e (m.)", "Rate"),
+        ("Weg, -e (m.)", "wegen"),
+        ("Weg, -e (m.)", "weg"),
+        ("Haus, ¨-er (n.)", "Hausen"),
+        ("seit", "Seiten"),
+    ),
+)
+def test_lexical_matcher_false_positives(vocab_word, cloze):
+    """Test unrelated words sharing a short stem, and lowercase words spelled like nouns, are not matched"""
+    assert LexicalMatcher([vocab_word]).match(cloze) == -1
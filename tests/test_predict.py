@@ -1,12 +1,21 @@
 """test_finetune.py Unit testing of finetune.py"""
 
+import asyncio
+import time
 from unittest.mock import patch
 
 import openai
+import pytest
 from openai.openai_object import OpenAIObject
 
 from clozify_llm.constants import STARTING_MESSAGE
-from clozify_llm.predict import ChatCompleter, Completer, GenericCompleter
+from clozify_llm.predict import (
+    ChatCompleter,
+    Completer,
+    GenericCompleter,
+    ResponseCache,
+)
+from clozify_llm.utils import format_prompt
 
 
 class TestCompleter:
@@ -28,6 +37,43 @@ class TestCompleter:
         expected = "This is indeed a test"
         assert result == expected
 
+    def test_aget_cloze_texts_fake_server(self, fake_openai_server):
+        """Test Completer.aget_cloze_texts() against local fake endpoint"""
+        completer = Completer("my_model_id")
+        result = asyncio.run(completer.aget_cloze_texts(["eins", "zwei"], ["one", "two"], concurrency=2))
+        assert result == ["echo eins", "echo zwei"]
+
+    @patch("clozify_llm.predict.openai.Completion")
+    def test_get_cloze_texts_batched(self, mock_completion, capsys):
+        """Test Completer.get_cloze_texts() packs prompts and splits choices back by index"""
+
+        def create(prompt, **kwargs):
+            # Return choices out of order to check they are matched by index
+            choices = [{"text": f" {p.split()[0]} cloze", "index": i} for i, p in enumerate(prompt)][::-1]
+            return OpenAIObject.construct_from({"choices": choices, "usage": {"total_tokens": 10 * len(prompt)}})
+
+        mock_completion.create.side_effect = create
+        completer = Completer("my_model_id")
+        words = ["eins", "zwei", "drei"]
+        result = completer.get_cloze_texts(words, ["one", "two", "three"], batch_size=2)
+
+        assert result == ["eins cloze", "zwei cloze", "drei cloze"]
+        assert mock_completion.create.call_count == 2
+        first_prompts = mock_completion.create.call_args_list[0].kwargs["prompt"]
+        assert first_prompts == [format_prompt("eins", "one"), format_prompt("zwei", "two")]
+        usage_lines = capsys.readouterr().err.splitlines()
+        assert len(usage_lines) == 3
+        assert sum(int(line.split()[-1]) for line in usage_lines) == 30
+
+    @patch("clozify_llm.predict.openai.Completion")
+    def test_get_cloze_texts_missing_choice(self, mock_completion):
+        mock_completion.create.return_value = OpenAIObject.construct_from(
+            {"choices": [{"text": " only one", "index": 0}], "usage": {"total_tokens": 10}}
+        )
+        completer = Completer("my_model_id")
+        with pytest.raises(ValueError):
+            completer.get_cloze_texts(["eins", "zwei"], ["one", "two"])
+
 
 class TestChatCompleter:
     @patch("clozify_llm.predict.openai.ChatCompletion")
@@ -61,6 +107,89 @@ class TestChatCompleter:
         }
         assert result == expected
 
+    def test_aget_cloze_texts_concurrent(self, fake_openai_server):
+        """Test ChatCompleter.aget_cloze_texts() keeps input order and overlaps requests to a slow endpoint"""
+        words = [f"wort{i}" for i in range(8)]
+        completer = ChatCompleter()
+        start = time.perf_counter()
+        result = asyncio.run(completer.aget_cloze_texts(words, [""] * len(words), concurrency=8))
+        elapsed = time.perf_counter() - start
+
+        assert result == [f"echo Input: {word}" for word in words]
+        assert fake_openai_server.requests_served == len(words)
+        # Sequential requests would take len(words) * latency
+        assert elapsed < len(words) * fake_openai_server.latency / 2
+
+
+@pytest.fixture
+def response_cache(tmp_path) -> ResponseCache:
+    cache = ResponseCache(tmp_path / "cache" / "responses.sqlite3")
+    yield cache
+    cache.close()
+
+
+class TestResponseCache:
+    def test_get_set(self, response_cache, chat_completion_response):
+        params = {"model": "m", "messages": [{"role": "user", "content": "Input: Wort"}]}
+        assert response_cache.get(params) is None
+
+        response_cache.set(params, chat_completion_response)
+        # Key does not depend on ordering of params
+        result = response_cache.get(dict(reversed(params.items())))
+
+        assert result == chat_completion_response
+        assert response_cache.stats()["entries"] == 1
+        assert response_cache.stats()["total_tokens"] == 21
+        assert (response_cache.hits, response_cache.misses) == (1, 1)
+
+    def test_prune_max_age(self, response_cache, chat_completion_response):
+        response_cache.set({"key": "old"}, chat_completion_response)
+        with patch("clozify_llm.predict.time.time", return_value=time.time() + 100):
+            response_cache.set({"key": "new"}, chat_completion_response)
+            evicted = response_cache.prune(max_age=50)
+
+        assert evicted == 1
+        assert response_cache.get({"key": "old"}) is None
+        assert response_cache.get({"key": "new"}) is not None
+
+    def test_prune_max_bytes(self, response_cache, chat_completion_response):
+        for i in range(3):
+            with patch("clozify_llm.predict.time.time", return_value=1000.0 + i):
+                response_cache.set({"key": i}, chat_completion_response)
+        entry_bytes = response_cache.stats()["size_bytes"] // 3
+
+        evicted = response_cache.prune(max_bytes=2 * entry_bytes)
+
+        assert evicted == 1
+        assert response_cache.get({"key": 0}) is None
+        assert response_cache.get({"key": 2}) is not None
+
+    @patch("clozify_llm.predict.openai.ChatCompletion")
+    def test_chat_completer_uses_cache(self, mock_chat_completion, response_cache, chat_completion_response):
+        mock_chat_completion.create.return_value = chat_completion_response
+        completer = ChatCompleter(cache=response_cache)
+
+        first = completer.get_cloze_text("Wort", "")
+        second = completer.get_cloze_text("Wort", "")
+
+        assert first == second
+        mock_chat_completion.create.assert_called_once()
+
+    @patch("clozify_llm.predict.openai.Completion")
+    def test_completer_batch_uses_cache_per_prompt(self, mock_completion, response_cache):
+        def create(prompt, **kwargs):
+            choices = [{"text": f" {p.split()[0]} cloze", "index": i} for i, p in enumerate(prompt)]
+            return OpenAIObject.construct_from({"choices": choices, "usage": {"total_tokens": 10 * len(prompt)}})
+
+        mock_completion.create.side_effect = create
+        completer = Completer("my_model_id", cache=response_cache)
+        completer.get_cloze_texts(["eins", "zwei"], ["one", "two"])
+        result = completer.get_cloze_texts(["drei", "zwei", "eins"], ["three", "two", "one"])
+
+        assert result == ["drei cloze", "zwei cloze", "eins cloze"]
+        assert mock_completion.create.call_count == 2
+        assert mock_completion.create.call_args.kwargs["prompt"] == [format_prompt("drei", "three")]
+
 
 class DummyCompleter(GenericCompleter):
     """Dummy subclass of GenericCompleter for testing"""
@@ -71,10 +200,29 @@ class DummyCompleter(GenericCompleter):
     def get_completion_response(self, word, defn):
         return OpenAIObject.construct_from({"content": f"{word} means {defn}", "usage": {"total_tokens": 1}})
 
+    async def aget_completion_response(self, word, defn):
+        await asyncio.sleep(0.01 * (ord(word[0]) % 3))
+        return self.get_completion_response(word, defn)
+
     def extract_text_from_response(self, response):
         return response["content"]
 
 
+@pytest.mark.parametrize("concurrency", (1, 3))
+def test_completer_aget_cloze_texts(concurrency):
+    """Test GenericCompleter.aget_cloze_texts() returns results in input order"""
+    completer = DummyCompleter(model_id="my_dummy_completer")
+    result = asyncio.run(completer.aget_cloze_texts(["a", "b", "c", "d"], ["1", "2", "3", "4"], concurrency))
+    expected = ["a means 1", "b means 2", "c means 3", "d means 4"]
+    assert result == expected
+
+
+def test_completer_aget_cloze_texts_length_mismatch():
+    completer = DummyCompleter(model_id="my_dummy_completer")
+    with pytest.raises(ValueError):
+        asyncio.run(completer.aget_cloze_texts(["a", "b"], ["1"]))
+
+
 def test_completer_get_cloze_text():
     completer = DummyCompleter(model_id="my_dummy_completer")
     result = completer.get_cloze_text("apple", "banana")
@@ -0,0 +1,102 @@
+"""test_ratelimit.py Unit testing of ratelimit.py"""
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from clozify_llm.ratelimit import RateLimiter, configure_rate_limit, get_rate_limiter
+
+
+class FakeClock:
+    """Stand-in for time.monotonic and time.sleep, where sleeping advances the clock"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock():
+    clock = FakeClock()
+    with patch("clozify_llm.ratelimit.time.monotonic", clock.monotonic), patch(
+        "clozify_llm.ratelimit.time.sleep", clock.sleep
+    ):
+        yield clock
+
+
+def test_acquire_within_budget_does_not_wait(fake_clock):
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=1000)
+    for _ in range(10):
+        limiter.acquire(100)
+    assert fake_clock.slept == 0
+
+
+def test_acquire_waits_for_requests(fake_clock):
+    """Once the request budget is spent, each further request waits for 1/rpm minutes"""
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1_000_000)
+    for _ in range(60):
+        limiter.acquire(1)
+    limiter.acquire(1)
+    assert fake_clock.slept == pytest.approx(1.0)
+
+
+def test_acquire_waits_for_tokens(fake_clock):
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600)
+    limiter.acquire(600)
+    limiter.acquire(300)
+    assert fake_clock.slept == pytest.approx(30.0)
+
+
+def test_settle_uses_actual_usage(fake_clock):
+    """Overestimated reservation is refunded, underestimated reservation delays later requests"""
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600)
+    reserved = limiter.acquire(600)
+    limiter.settle(reserved, 100)
+    limiter.acquire(500)
+    assert fake_clock.slept == 0
+
+    limiter.settle(0, 600)
+    limiter.acquire(60)
+    assert fake_clock.slept == pytest.approx(66.0)
+
+
+def test_acquire_caps_oversized_request(fake_clock):
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=100)
+    assert limiter.acquire(1000) == 100
+
+
+def test_aacquire(fake_clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        fake_clock.now += seconds
+
+    async def acquire_many():
+        for _ in range(61):
+            await limiter.aacquire(1)
+
+    with patch("clozify_llm.ratelimit.asyncio.sleep", fake_sleep):
+        asyncio.run(acquire_many())
+    assert sum(sleeps) == pytest.approx(1.0)
+
+
+def test_get_rate_limiter_shared_by_base_model():
+    limiter = get_rate_limiter("curie")
+    assert get_rate_limiter("curie:ft-personal-2023-01-01-01-01-01") is limiter
+    assert get_rate_limiter("text-embedding-ada-002") is not limiter
+
+
+def test_configure_rate_limit():
+    configure_rate_limit("my-test-model", requests_per_minute=5, tokens_per_minute=50)
+    limiter = configure_rate_limit("my-test-model", tokens_per_minute=100)
+    assert get_rate_limiter("my-test-model") is limiter
+    assert (limiter.requests_per_minute, limiter.tokens_per_minute) == (5, 100)
@@ -0,0 +1,69 @@
+"""test_reduce.py Testing of reduce.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from clozify_llm.emb_matrix import EmbeddingMatrix
+from clozify_llm.reduce import Projection, reduction_report
+
+
+@pytest.fixture
+def low_rank_embs():
+    """Embeddings lying close to a 4 dimensional subspace of 32 dimensions"""
+    rng = np.random.default_rng(0)
+    basis = rng.normal(size=(4, 32))
+    return (rng.normal(size=(200, 4)) @ basis + 0.01 * rng.normal(size=(200, 32))).astype(np.float32)
+
+
+def test_fit_pca(low_rank_embs):
+    """Test PCA components are orthonormal, deterministic and keep nearly all the variance"""
+    projection = Projection.fit(low_rank_embs, n_dims=4, method="pca")
+    unit_rows = low_rank_embs / np.linalg.norm(low_rank_embs, axis=1, keepdims=True)
+    centered = unit_rows - projection.mean
+    reduced = np.asarray(projection.transform(low_rank_embs))
+
+    np.testing.assert_allclose(projection.components @ projection.components.T, np.eye(4), atol=1e-5)
+    assert projection.fingerprint == Projection.fit(low_rank_embs, n_dims=4, method="pca").fingerprint
+    assert (reduced**2).sum() / (centered**2).sum() > 0.99
+
+
+def test_random_projection_seeded(low_rank_embs):
+    """Test random projections are determined by seed"""
+    assert Projection.fit(low_rank_embs, 8, "random", seed=1).fingerprint == Projection.random(32, 8, 1).fingerprint
+    assert Projection.random(32, 8, seed=1).fingerprint != Projection.random(32, 8, seed=2).fingerprint
+
+
+def test_transform_keeps_index_and_missing(low_rank_embs, tmp_path):
+    """Test transform keeps EmbeddingMatrix index and NaN rows, and saved projections give the same output"""
+    embs = low_rank_embs[:3].copy()
+    embs[1] = np.nan
+    matrix = EmbeddingMatrix(embs, index=pd.Index([7, 8, 9]))
+    projection = Projection.fit(low_rank_embs, n_dims=4)
+    projection.save(tmp_path / "projection.npz")
+    reduced = Projection.load(tmp_path / "projection.npz").transform(matrix)
+
+    assert reduced.shape == (3, 4)
+    assert reduced.index.tolist() == [7, 8, 9]
+    assert np.isnan(reduced.values[1]).all()
+    np.testing.assert_array_equal(reduced.values[[0, 2]], projection.transform(embs[[0, 2]]).values)
+
+
+def test_fit_validation(low_rank_embs):
+    """Test invalid dims and methods are rejected"""
+    with pytest.raises(ValueError):
+        Projection.fit(low_rank_embs, n_dims=33)
+    with pytest.raises(ValueError):
+        Projection.fit(low_rank_embs, n_dims=4, method="svd")
+
+
+def test_reduction_report(low_rank_embs):
+    """Test report has full dimension baseline and one row per dims, with few changes within the subspace"""
+    rng = np.random.default_rng(1)
+    clozes = low_rank_embs[:50] + 0.01 * rng.normal(size=(50, 32)).astype(np.float32)
+    report = reduction_report(clozes, low_rank_embs, dims=[1, 4])
+
+    assert report["n_dims"].tolist() == [32, 1, 4]
+    assert report["changed"].iloc[0] == 0
+    assert report["changed"].iloc[2] <= 2
+    assert report["bytes_per_row"].tolist() == [128, 4, 16]
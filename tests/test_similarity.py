@@ -0,0 +1,69 @@
+"""test_similarity.py Unit testing of similarity.py"""
+import numpy as np
+import pytest
+from scipy import sparse
+from sklearn.metrics.pairwise import cosine_similarity
+
+from clozify_llm.similarity import normalize_rows, top_k_cosine, top_k_sparse
+
+
+@pytest.fixture
+def random_embs() -> tuple[np.ndarray, np.ndarray]:
+    """Random query and candidate embeddings"""
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(103, 16)), rng.normal(size=(37, 16))
+
+
+@pytest.mark.parametrize("max_block_bytes,n_threads", ((1, 1), (37 * 4 * 10, 1), (37 * 4 * 10, 4), (2**20, 1)))
+def test_top_k_cosine_matches_full_matrix(random_embs, max_block_bytes, n_threads):
+    """Test blocked top-k gives the same matches and scores as the full similarity matrix"""
+    X, Y = random_embs
+    full = cosine_similarity(X, Y)
+
+    indices, scores = top_k_cosine(X, Y, k=3, max_block_bytes=max_block_bytes, n_threads=n_threads)
+
+    np.testing.assert_array_equal(indices[:, 0], np.argmax(full, axis=1))
+    np.testing.assert_array_equal(indices, np.argsort(-full, axis=1, kind="stable")[:, :3])
+    np.testing.assert_allclose(scores, np.take_along_axis(full, indices, axis=1), rtol=1e-5)
+
+
+def test_top_k_cosine_ties_and_k_capped():
+    """Test ties go to lower index like argmax, and k larger than candidates is capped"""
+    X = np.array([[1.0, 0.0]])
+    Y = np.array([[0.0, 1.0], [2.0, 0.0], [1.0, 0.0]])
+
+    indices, scores = top_k_cosine(X, Y, k=5)
+
+    assert indices.tolist() == [[1, 2, 0]]
+    np.testing.assert_allclose(scores, [[1.0, 1.0, 0.0]])
+
+
+def test_normalize_rows_zero_row():
+    """Test all-zero rows are left as zeros"""
+    result = normalize_rows(np.array([[3.0, 4.0], [0.0, 0.0]]))
+    np.testing.assert_allclose(result, [[0.6, 0.8], [0.0, 0.0]])
+    assert result.dtype == np.float32
+
+
+def test_top_k_cosine_sharded_matches_serial(random_embs):
+    """Test process pool sharding gives the same result as scoring in one process"""
+    X, Y = random_embs
+
+    indices, scores = top_k_cosine(X, Y, k=3, n_workers=2)
+    serial_indices, serial_scores = top_k_cosine(X, Y, k=3)
+
+    np.testing.assert_array_equal(indices, serial_indices)
+    np.testing.assert_allclose(scores, serial_scores, rtol=1e-6)
+
+
+def test_top_k_sparse_matches_dense(random_embs):
+    """Test sparse top-k of unit-length rows matches dense cosine top-k"""
+    X, Y = (np.where(np.abs(embs) > 1, embs, 0) for embs in random_embs)
+
+    indices, scores = top_k_sparse(
+        sparse.csr_matrix(normalize_rows(X)), sparse.csr_matrix(normalize_rows(Y)), k=3, max_block_bytes=37 * 4 * 10
+    )
+    dense_indices, dense_scores = top_k_cosine(X, Y, k=3)
+
+    np.testing.assert_array_equal(indices, dense_indices)
+    np.testing.assert_allclose(scores, dense_scores, rtol=1e-5, atol=1e-6)
@@ -2,8 +2,21 @@
 """
 from unittest.mock import patch
 
+import pytest
+from tenacity import RetryError
+
 from clozify_llm.constants import END_STR, PROMPT_SEPARATOR
-from clozify_llm.utils import format_completion, format_prompt, get_emb, get_embs
+from clozify_llm.embed_cache import EmbeddingCache
+from clozify_llm.utils import (
+    batch_by_tokens,
+    estimate_request_tokens,
+    estimate_tokens,
+    format_completion,
+    format_completions,
+    format_prompt,
+    get_emb,
+    get_embs,
+)
 
 
 def test_format_completion():
@@ -42,3 +55,119 @@ def test_get_embs(mock_completion, embedding_response, embedding_vals):
     result = get_embs(["Input str"])
     expected = [embedding_vals]
     assert result == expected
+
+
+@patch("clozify_llm.utils.openai.Embedding")
+def test_get_embs_batched(mock_embedding):
+    """Test get_embs sends batches and maps results back by index, even if returned out of order"""
+
+    def create(input, engine):
+        data = [{"embedding": [float(len(x))], "index": i} for i, x in enumerate(input)][::-1]
+        return {"data": data, "usage": {"total_tokens": len(input)}}
+
+    mock_embedding.create.side_effect = create
+    xs = ["a", "bb", "ccc", "dddd", "eeeee"]
+    result = get_embs(xs, batch_size=2)
+
+    assert result == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert mock_embedding.create.call_count == 3
+
+
+@patch("clozify_llm.utils.openai.Embedding")
+def test_get_embs_with_cache(mock_embedding, tmp_path):
+    """Test get_embs only requests inputs missing from cache, and adds them to cache"""
+    mock_embedding.create.side_effect = lambda input, engine: {
+        "data": [{"embedding": [float(len(x)), 0.5], "index": i} for i, x in enumerate(input)],
+        "usage": {"total_tokens": len(input)},
+    }
+    cache = EmbeddingCache(tmp_path)
+    cache.put_many(["bb"], [[2.0, 0.5]])
+
+    first = get_embs(["a", "bb", "ccc"], cache=cache)
+    second = get_embs(["ccc", "a"], cache=cache)
+
+    assert first == [[1.0, 0.5], [2.0, 0.5], [3.0, 0.5]]
+    assert second == [[3.0, 0.5], [1.0, 0.5]]
+    assert mock_embedding.create.call_count == 1
+    assert mock_embedding.create.call_args.kwargs["input"] == ["a", "ccc"]
+
+
+@patch("clozify_llm.utils.get_emb")
+def test_get_embs_splits_failed_batch(mock_get_emb):
+    """Test a batch that fails after retries is split until the failing input is isolated"""
+
+    def get_emb_side_effect(input):
+        if "bad" in input and len(input) > 1:
+            raise RetryError(None)
+        return {"data": [{"embedding": [0.5], "index": i} for i in range(len(input))], "usage": {"total_tokens": 1}}
+
+    mock_get_emb.side_effect = get_emb_side_effect
+    result = get_embs(["a", "b", "bad", "c"], batch_size=4)
+
+    assert result == [[0.5]] * 4
+    assert [len(call.args[0]) for call in mock_get_emb.call_args_list] == [4, 2, 2, 1, 1]
+
+
+@patch("clozify_llm.utils.get_emb")
+def test_get_embs_single_failure_raises(mock_get_emb):
+    mock_get_emb.side_effect = RetryError(None)
+    with pytest.raises(RetryError):
+        get_embs(["a"])
+
+
+@patch("clozify_llm.utils.openai.Embedding")
+def test_get_emb_rate_limited(mock_completion, embedding_response):
+    """Test get_emb reserves from limiter and settles against reported usage"""
+    mock_completion.create.return_value = embedding_response
+    with patch("clozify_llm.ratelimit.RateLimiter.settle") as mock_settle:
+        get_emb("Input str")
+    mock_settle.assert_called_once_with(estimate_tokens("Input str"), 8)
+
+
+@pytest.mark.parametrize(
+    "params,expected",
+    (
+        ({"input": "a" * 8}, 3),
+        ({"input": ["a" * 8, "b"]}, 4),
+        ({"prompt": "a" * 8, "max_tokens": 10}, 13),
+        ({"prompt": ["a" * 8, "b"], "max_tokens": 10}, 24),
+        ({"messages": [{"role": "user", "content": "a" * 8}], "max_tokens": 10}, 13),
+    ),
+)
+def test_estimate_request_tokens(params, expected):
+    assert estimate_request_tokens(params) == expected
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 1
+    assert estimate_tokens("a" * 40) == 11
+
+
+@pytest.mark.parametrize(
+    "texts,batch_size,max_tokens,expected",
+    (
+        (["a", "b", "c"], 2, 100, [[0, 1], [2]]),
+        (["a" * 20, "b" * 20, "c"], 10, 10, [[0], [1, 2]]),
+        (["a" * 100, "b"], 10, 10, [[0], [1]]),
+        ([], 2, 100, []),
+    ),
+)
+def test_batch_by_tokens(texts, batch_size, max_tokens, expected):
+    result = list(batch_by_tokens(texts, batch_size, max_tokens))
+    assert result == expected
+
+
+@pytest.mark.parametrize("batch_rows", [1, 2, 100])
+def test_format_completions(batch_rows):
+    rows = [
+        ('say "hi"', "back\\slash", "x"),
+        ("record\x1eseparator", "new\r\nline", None),
+        ("  spaces  ", "über", float("nan")),
+    ]
+    with patch("clozify_llm.utils.COMPLETION_BATCH_ROWS", batch_rows):
+        result = list(format_completions(rows))
+    assert result == [
+        ' "say \\"hi\\"","back\\\\slash","x"' + END_STR,
+        ' "record\x1eseparator","new\r\nline",""' + END_STR,
+        ' "  spaces  ","über","nan"' + END_STR,
+    ]